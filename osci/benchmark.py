@@ -0,0 +1,139 @@
+from __future__ import print_function
+
+import argparse
+import datetime
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from osci import constants
+from osci.job import Job
+from osci import db
+from osci import time_services
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Time the scheduler's queries against a large job table")
+    parser.add_argument('--dburl', dest='dburl', default=None,
+                        help="Empty database to fill; defaults to a "
+                        "temporary sqlite file")
+    parser.add_argument('--rows', dest='rows', type=int, default=300000,
+                        help="Number of historical jobs to create")
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help="Number of times to run each query")
+    return parser
+
+def populate(database, rows, batch=10000):
+    """Fill the table with mostly finished jobs spread over a year"""
+    now = time_services.now()
+    finished = [constants.FINISHED] * 8 + [constants.OBSOLETE] * 2
+    live = [constants.QUEUED, constants.RUNNING, constants.COLLECTING,
+            constants.COLLECTED]
+    insert = Job.__table__.insert()
+    for start in range(0, rows, batch):
+        values = []
+        for i in range(start, min(start + batch, rows)):
+            recent = i >= rows - 50
+            updated = now - datetime.timedelta(
+                minutes=random.randint(0, 60 if recent else 365*24*60))
+            values.append(dict(
+                project_name='openstack/project%d' % (i % 20),
+                change_num=str(100000 + i / 3),
+                change_ref='refs/changes/%02d/%d/%d' % (i % 100, 100000 + i / 3, i % 3 + 1),
+                state=random.choice(live if recent else finished),
+                created=updated, updated=updated,
+                node_id=random.randint(1, 1000) if recent else 0,
+                result='Passed' if i % 4 else 'Failed',
+                branch='master'))
+        with database.get_session() as session:
+            session.execute(insert, values)
+
+def get_queries():
+    # The queries run every cycle by JobQueue and its threads
+    def keep_failed(database):
+        with database.get_session() as session:
+            return (session.query(Job.id).filter(db.and_(
+                Job.state.in_([constants.COLLECTED, constants.FINISHED,
+                               constants.OBSOLETE]),
+                Job.node_id > 0, Job.result == 'Failed'))
+                .order_by(Job.updated.desc()).limit(3).all())
+
+    return [
+        ('getAllWhere(state=QUEUED)',
+         lambda database: Job.getAllWhere(database, state=constants.QUEUED)),
+        ('getAllWhere(state=RUNNING)',
+         lambda database: Job.getAllWhere(database, state=constants.RUNNING)),
+        ('retrieve(project, change)',
+         lambda database: Job.retrieve(database, 'openstack/project7', '150000')),
+        ('getRecent(24)',
+         lambda database: Job.getRecent(database, 24)),
+        ('failed jobs to keep nodes for', keep_failed),
+    ]
+
+def time_queries(database, repeat):
+    timings = []
+    for name, query in get_queries():
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            query(database)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append((name, best))
+    return timings
+
+def drop_indexes(database):
+    for index in Job.__table__.indexes:
+        index.drop(bind=database.engine)
+
+def analyze(database):
+    # Give the planner the row statistics a long-lived database would have
+    with database.get_session() as session:
+        if database.engine.name == 'sqlite':
+            session.execute('ANALYZE')
+        else:
+            session.execute('ANALYZE TABLE test')
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+
+    logging.basicConfig(
+        format=u'%(asctime)s %(levelname)s %(name)s %(message)s',
+        level=logging.INFO)
+
+    tmpdir = None
+    dburl = options.dburl
+    if dburl is None:
+        tmpdir = tempfile.mkdtemp()
+        dburl = 'sqlite:///%s' % os.path.join(tmpdir, 'benchmark.db')
+
+    try:
+        database = db.DB(dburl)
+        database.create_schema()
+        logging.info('Creating %d jobs', options.rows)
+        populate(database, options.rows)
+
+        drop_indexes(database)
+        without = time_queries(database, options.repeat)
+        database.create_schema()
+        analyze(database)
+        with_indexes = time_queries(database, options.repeat)
+
+        table = PrettyTable(["Query", "No indexes (ms)", "Indexed (ms)"])
+        table.align = 'l'
+        for (name, before), (_, after) in zip(without, with_indexes):
+            table.add_row([name, '%.1f' % (before * 1000), '%.1f' % (after * 1000)])
+        print(table)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ from osci import environment
 from osci import gerrit
 from osci import event_target
 from osci import db
+from osci import job
 from osci import job_queue
 from osci import time_services
 from osci import config as osci_config
@@ -125,6 +126,8 @@ class CreateDBSchema(object):
 
     def __call__(self):
         self.database.create_schema()
+        count = job.FailedTest.backfill(self.database)
+        log.info('Recorded failed tests for %d existing jobs', count)
 
 
 class GerritEventError(Exception):
@@ -136,14 +139,17 @@ class WatchGerrit(object):
     DEFAULT_EVENT_TIME = 600
 
     def __init__(self, env=None):
-        logging.getLogger('sqlalchemy').setLevel(logging.DEBUG)
         env = env or dict()
         self.database = None
-        self.queue = None
+        self.queue = env.get('queue')
 
         dburl = env.get('dburl')
 
-        if dburl:
+        if self.queue is not None:
+            # Sharing the scheduler's queue when running in-process
+            self.database = self.queue.db
+        elif dburl:
+            logging.getLogger('sqlalchemy').setLevel(logging.DEBUG)
             log.info('dburl=%s', dburl)
             self.database = db.DB(dburl)
             self.queue = job_queue.JobQueue(
@@ -207,6 +213,8 @@ class WatchGerrit(object):
         try:
             while self.event_seen_recently():
                 self.do_event_handling()
+                if self.database is not None:
+                    self.database.remove_session()
                 self.sleep()
             log.info("No events seen in %s seconds" % self.recent_event_time)
         except GerritEventError as e:
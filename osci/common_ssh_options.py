@@ -1 +1,32 @@
+from osci.config import Configuration
+
+
 COMMON_SSH_OPTS = '-q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'.split()
+
+
+def connection_sharing_opts():
+    # Let successive ssh calls to the same node share one master
+    # connection, which OpenSSH closes after SSH_CONTROL_PERSIST idle
+    # seconds.  A stale socket is replaced by a new master automatically.
+    # The master is forked from whichever call starts it; its log goes to
+    # /dev/null so it does not hold that call's stderr pipe open until it
+    # exits.
+    if not Configuration().get_bool('SSH_CONNECTION_SHARING'):
+        return []
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=%s' % Configuration().SSH_CONTROL_PATH,
+        '-o', 'ControlPersist=%s' % Configuration().SSH_CONTROL_PERSIST,
+        '-o', 'ServerAliveInterval=%s' % Configuration().SSH_SERVER_ALIVE_INTERVAL,
+        '-E', '/dev/null',
+    ]
+
+
+def node_ssh_command(host, username, keyfile, extra_opts=None):
+    return (
+        ['ssh']
+        + COMMON_SSH_OPTS
+        + connection_sharing_opts()
+        + (extra_opts or [])
+        + ['-i', keyfile, '{0}@{1}'.format(username, host)]
+    )
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+import Queue
+
+
+log = logging.getLogger('citrix.concurrency')
+
+
+class _Task(object):
+    def __init__(self, item):
+        self.item = item
+        self.started = None
+        self.done = False
+        self.failed = False
+        self.abandoned = False
+        self.result = None
+
+    @property
+    def pending(self):
+        return not (self.done or self.abandoned)
+
+
+def _worker(func, tasks, condition, finalizer):
+    while True:
+        try:
+            task = tasks.get_nowait()
+        except Queue.Empty:
+            if finalizer:
+                finalizer()
+            return
+        with condition:
+            if task.abandoned:
+                continue
+            task.started = time.time()
+        try:
+            result = func(task.item)
+            failed = False
+        except Exception, e:
+            log.exception(e)
+            result = None
+            failed = True
+        with condition:
+            task.result = result
+            task.failed = failed
+            task.done = True
+            condition.notify_all()
+
+
+def run_concurrently(func, items, workers, timeout=None, name='worker',
+                     finalizer=None):
+    """Call func(item) for every item on at most `workers` threads.
+
+    Returns a list of (item, result) pairs, in the order of `items`, for
+    the calls that completed.  Calls raising an exception are logged and
+    left out.  Calls still running `timeout` seconds after they started
+    are abandoned on their (daemon) thread and left out as well, so the
+    caller must not hand the same item out again while it may still be
+    in progress.
+
+    `finalizer` is called on each worker thread before it exits, e.g. to
+    release thread-local database sessions.
+    """
+    items = list(items)
+    tasks = Queue.Queue()
+    all_tasks = [_Task(item) for item in items]
+    for task in all_tasks:
+        tasks.put(task)
+
+    condition = threading.Condition()
+    threads = []
+    for i in range(min(max(workers, 1), len(all_tasks))):
+        thread = threading.Thread(target=_worker, name='%s-%d' % (name, i),
+                                  args=(func, tasks, condition, finalizer))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    with condition:
+        while [task for task in all_tasks if task.pending]:
+            now = time.time()
+            for task in all_tasks:
+                if (task.pending and timeout and task.started and
+                        now - task.started > timeout):
+                    log.error('Abandoning %s after %d seconds', task.item, timeout)
+                    task.abandoned = True
+            # Once every live worker is stuck on an abandoned call the
+            # remaining items can never start
+            stuck = len([task for task in all_tasks
+                         if task.abandoned and task.started and not task.done])
+            alive = len([thread for thread in threads if thread.is_alive()])
+            if stuck >= alive:
+                for task in all_tasks:
+                    if task.pending:
+                        log.error('Abandoning %s; no free workers', task.item)
+                        task.abandoned = True
+            condition.wait(1)
+        stuck = [task for task in all_tasks
+                 if task.abandoned and task.started and not task.done]
+
+    # Let the workers run their finalizers, unless some will never return
+    if not stuck:
+        for thread in threads:
+            thread.join()
+
+    return [(task.item, task.result) for task in all_tasks
+            if task.done and not task.failed and not task.abandoned]
+
+
+class TaskPool(object):
+    """Call func(item) on at most `workers` threads for items submitted
+    while the pool is running.
+
+    join() waits for every submitted call and returns the (item, result)
+    pairs of those that completed, in the order they were submitted.  As
+    with run_concurrently, calls raising an exception are logged and left
+    out.
+    """
+
+    def __init__(self, func, workers, name='worker'):
+        self.func = func
+        self.workers = max(workers, 1)
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.submitted = []
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, item):
+        task = _Task(item)
+        with self.lock:
+            self.submitted.append(task)
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='%s-%d' % (self.name, len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.tasks.put(task)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            try:
+                task.result = self.func(task.item)
+            except Exception, e:
+                log.exception(e)
+                task.failed = True
+            task.done = True
+
+    def join(self):
+        with self.lock:
+            threads = list(self.threads)
+        for _ in threads:
+            self.tasks.put(None)
+        for thread in threads:
+            thread.join()
+        return [(task.item, task.result) for task in self.submitted
+                if task.done and not task.failed]
+
+
+def call_in_parallel(calls):
+    """Make each of the argument-less calls on its own thread.
+
+    Returns their results in order once all have finished; if any raised,
+    the first exception (in call order) is raised again instead.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def make_call(index):
+        try:
+            results[index] = calls[index]()
+        except Exception, e:
+            errors[index] = e
+
+    threads = []
+    for index in range(1, len(calls)):
+        thread = threading.Thread(target=make_call, args=(index,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    if calls:
+        make_call(0)
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
@@ -23,23 +23,52 @@ class Configuration(object):
         'GERRIT_USERNAME': 'citrix_xenserver_ci',
         'GERRIT_PORT': '29418',
         'MAX_RUNNING_TIME': str(3*3600+15*60), # 3 hours and 15 minutes
+        'ARCHIVE_AFTER_DAYS': '30',
+        'COLLECT_WORKERS': '4',
+        'COLLECT_TIMEOUT': str(60*60),
+        'COPY_LOGS_WORKERS': '4',
         'DATABASE_URL': 'mysql://root:@127.0.0.1/openstack_ci',
+        'DB_POOL_SIZE': '10',
+        'DB_MAX_OVERFLOW': '10',
+        'DB_POOL_RECYCLE': '3600',
+        'DB_POOL_PRE_PING': 'True',
+        'DISPATCH_WORKERS': '8',
+        'DISPATCH_TIMEOUT': str(15*60),
         'IGNORE_USERNAMES': 'arista-test,brocade_jenkins,brocade-oss-service,bsn,cisco-openstack-ci,citrixjenkins,citrix_xenserver_ci,compass_ci,contrail,designate-jenkins,docker-ci,eci,elasticrecheck,freescale-ci,fuel-ci,fuel-watcher,huawei-ci,hyper-v-ci,ibmdb2,ibmpwrvc,ibmsdnve,ibm-zvm-ci,jaypipes-testing,jenkins,jenkins-magnetodb,launchpadsync,lvstest,mellanox,metaplugintest,midokura,murano-ci,nec-openstack-ci,netapp-ci,NetScalerAts,neutronryu,nicirabot,novaimagebuilder-jenkins,nuage-ci,odl-jenkins,pattabi-ayyasami-ci,plumgrid-ci,powerkvm,puppetceph,puppet-openstack-ci-user,radware3rdpartytesting,raxheatci,reddwarf,redhatci,rocktown,savanna-ci,sfci,smokestack,tailfncs,thstack-ci,trivial-rebase,turbo-hipster,vanillabot,varmourci,vmwareminesweeper,wherenowjenkins',
         'KEEP_FAILED': '3',
         'KEEP_FAILED_TIMEOUT': str(6*3600),
+        'LOG_COLLECTION': 'archive',
+        'LOG_COMPRESSOR': 'gzip',
+        'LOG_COMPRESSION_LEVEL': '6',
         'NODEPOOL_CONFIG': '/etc/nodepool/nodepool.yaml',
         'SECURE_CONFIG': '/etc/nodepool/secure.conf',
         'NODEPOOL_IMAGE': 'XSDSVM',
         'NODE_USERNAME': 'jenkins',
         'NODE_KEY': '.ssh/jenkins',
         'POLL': '30',
+        'PROBE_WORKERS': '16',
+        'PROBE_TIMEOUT': '60',
         'PROJECT_CONFIG': 'openstack/nova,openstack/tempest,openstack-dev/devstack,openstack/xenapi-os-testing,openstack-infra/devstack-gate',
         'RUN_TESTS': 'True',
         'RECHECK_REGEXP': '(citrix recheck|xenserver:? recheck|recheck xenserver)',
         'REVIEW_REPO_NAME': 'review',
+        'SSH_CONNECTION_SHARING': 'True',
+        'SSH_CONTROL_PATH': '/tmp/osci-ssh-%r@%h:%p',
+        'SSH_CONTROL_PERSIST': '300',
+        'SSH_SERVER_ALIVE_INTERVAL': '15',
+        'SSH_IDLE_TIMEOUT': '300',
         'SWIFT_CONTAINER': 'CILogs',
         'SWIFT_USERNAME': 'citrix.nodepool2',
         'SWIFT_UPLOAD_ATTEMPTS': '5',
+        'SWIFT_UPLOAD_BACKOFF': '2',
+        'SWIFT_UPLOAD_WORKERS': '8',
+        'SWIFT_COMPRESS_LOGS': 'True',
+        'SWIFT_COMPRESS_THRESHOLD': str(64*1024),
+        'SWIFT_COMPRESS_LEVEL': '6',
+        'SWIFT_DEDUP': 'False',
+        'SWIFT_DEDUP_INDEX': '/var/lib/osci/swift_dedup_index',
+        'SWIFT_DEDUP_MAX_SIZE': str(1024*1024),
+        'SWIFT_DEDUP_PREFIX': 'objects',
         'SWIFT_API_KEY': ' ',
         'SWIFT_REGION': 'DFW',
         'VOTE': 'True',
@@ -50,6 +79,7 @@ class Configuration(object):
                       "add a review comment with \"xenserver: recheck\". Contact info: openstack@citrix.com.\n" +\
                       "For debugging suggestions, see https://wiki.openstack.org/wiki/Debugging_XenServer_CI_failures\n\n" +\
                       "- check-citrix-xenserver %(log)s : %(result)s in %(duration)s",
+        'WAKEUP_SOCKET': '/tmp/osci-wakeup.sock',
         }
 
     def _conf_file_contents(self):
@@ -1,14 +1,17 @@
 import logging
 import contextlib
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker, scoped_session, defer
 
 # Import these, so that other modules can import it from here
-from sqlalchemy import Column, Integer, String, DateTime, Text, UniqueConstraint
+from sqlalchemy import Column, Integer, Float, String, DateTime, Text, UniqueConstraint, Index
 from sqlalchemy.exc import IntegrityError
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, not_, select, event, func
+
+from osci.config import Configuration
 
 Base = declarative_base()
 
@@ -18,15 +21,75 @@ class DB(object):
 
     def __init__(self, database_url):
         self.database_url = database_url
-        self.engine = create_engine(self.database_url)
+        self.engine = create_engine(self.database_url, **self.pool_args())
         self.conn = None
-        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        # Objects stay readable after the commit that ends get_session,
+        # rather than each reloading itself on first access; queries use
+        # populate_existing to pick up changes made elsewhere
+        self.Session = scoped_session(sessionmaker(bind=self.engine,
+                                                   expire_on_commit=False))
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def pool_args(self):
+        # sqlite uses a connection per thread; there is no pool to size
+        if self.database_url.startswith('sqlite'):
+            return {}
+        return dict(
+            pool_size=Configuration().get_int('DB_POOL_SIZE'),
+            max_overflow=Configuration().get_int('DB_MAX_OVERFLOW'),
+            pool_recycle=Configuration().get_int('DB_POOL_RECYCLE'),
+            pool_pre_ping=Configuration().get_bool('DB_POOL_PRE_PING'))
+
+    def _count(self, event_name):
+        thread_name = threading.current_thread().name
+        with self.stats_lock:
+            counts = self.stats.setdefault(thread_name, dict(
+                sessions=0, commits=0, rollbacks=0, removals=0))
+            counts[event_name] += 1
+
+    def session_stats(self):
+        """Session, commit, rollback and removal counts for each thread"""
+        with self.stats_lock:
+            return dict((name, dict(counts))
+                        for name, counts in self.stats.iteritems())
 
     @contextlib.contextmanager
     def get_session(self):
         session = self.Session()
-        yield session
-        session.commit()
+        self._count('sessions')
+        try:
+            yield session
+            session.commit()
+            self._count('commits')
+        except:
+            session.rollback()
+            self._count('rollbacks')
+            raise
+
+    def remove_session(self):
+        """Close this thread's session, dropping its identity map.
+
+        Objects loaded through it are detached, so long-running threads
+        call this between cycles rather than after each get_session.
+        """
+        self.Session.remove()
+        self._count('removals')
+        self.log.debug('Session stats for %s: %s',
+                       threading.current_thread().name,
+                       self.session_stats().get(threading.current_thread().name))
 
     def create_schema(self):
         Base.metadata.create_all(self.engine)
+        self.create_missing_indexes()
+
+    def create_missing_indexes(self):
+        # create_all leaves existing tables alone, so add any indexes
+        # declared since they were created
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    self.log.info('Creating index %s on %s', index.name, table.name)
+                    index.create(bind=self.engine)
@@ -16,8 +16,9 @@ class PrintExecutor(object):
     def run(self, args):
         print(' '.join(args))
 
-    def pipe_run(self, args1, args2):
+    def pipe_run(self, args1, args2, on_output=None):
         print(' '.join(args1 + ['|'] + args2))
+        return 0, 0
 
 
 class FakeExecutor(object):
@@ -27,8 +28,9 @@ class FakeExecutor(object):
     def run(self, args):
         self.executed_commands.append(args)
 
-    def pipe_run(self, args1, args2):
+    def pipe_run(self, args1, args2, on_output=None):
         self.executed_commands.append(fake_pipe(args1, args2))
+        return 0, 0
 
 
 class RealExecutor(object):
@@ -36,16 +38,29 @@ class RealExecutor(object):
         log.info('Executing %s', args)
         return subprocess.call(args)
 
-    def pipe_run(self, args1, args2):
+    def pipe_run(self, args1, args2, on_output=None):
+        """Run args1 | args2, calling on_output with each line args2 prints.
+
+        Returns the return codes of args1 and args2.
+        """
         log.info('Pipe the output of %s to %s', args1, args2)
+        # close_fds stops pipes running concurrently from holding each
+        # other's ends open, which would hold back their EOFs
         proc1 = subprocess.Popen(
-            args1, stdout=subprocess.PIPE)
-        proc2 = subprocess.Popen(args2, stdin=proc1.stdout)
+            args1, stdout=subprocess.PIPE, close_fds=True)
+        stdout = subprocess.PIPE if on_output else None
+        proc2 = subprocess.Popen(args2, stdin=proc1.stdout, stdout=stdout,
+                                 close_fds=True)
         proc1.stdout.close()
+        if on_output:
+            # Not iterated with "for", which reads ahead in large blocks
+            for line in iter(proc2.stdout.readline, ''):
+                on_output(line)
         proc2.communicate()
         proc1.wait()
         log.info('Producer returned %s', proc1.returncode)
         log.info('Consumer returned %s', proc2.returncode)
+        return proc1.returncode, proc2.returncode
 
 
 def escaped(args):
@@ -0,0 +1,233 @@
+"""Extract the failed tests from a tempest run's output.
+
+The output is read a line (or a subunit packet) at a time, so only the
+failures themselves are held in memory, however large the log is.
+"""
+import gzip
+import logging
+import os
+import re
+
+try:
+    import subunit
+    import testtools
+except ImportError:
+    subunit = None
+
+
+log = logging.getLogger('citrix.failure_parser')
+
+# devstack-gate's tsfilter timestamps every line of run_tests.log, and
+# subunit-trace tags result lines with the worker that ran the test
+LINE_PREFIX = re.compile(r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+ \| )?'
+                         r'(?:\{\d+\}\s+)?')
+# "test_id ... FAIL" from testr, or "test_id [1.234s] ... FAILED" from
+# subunit-trace
+RESULT_LINE = re.compile(r'^(?P<test_id>.+?)'
+                         r'(?:\s+\[(?P<duration>[\d.]+)s\])?'
+                         r'\s+\.\.\.\s+FAIL(?:ED)?\b')
+# The header of a failure's details in unittest style output
+DETAILS_HEADER = re.compile(r'^(?:FAIL|ERROR): (?P<test_id>.+)$')
+# Follows the last details section in unittest style output
+RUN_SUMMARY = re.compile(r'^Ran \d+ tests? in ')
+
+MAX_TRACEBACK = 16 * 1024
+
+SUBUNIT_FILES = ['testrepository.subunit', 'testrepository.subunit.gz']
+RUN_TESTS_LOG = 'run_tests.log'
+
+
+class Failure(object):
+    def __init__(self, test_id, duration=None, line=None):
+        self.test_id = test_id
+        self.duration = duration
+        self.line = line or '%s ... FAIL' % test_id
+        self.traceback = None
+
+    def __repr__(self):
+        return '<Failure %s>' % self.test_id
+
+
+def _is_separator(line, char):
+    return len(line) >= 3 and line == char * len(line)
+
+
+class FailureParser(object):
+    """Collect failures from output fed to it a line at a time.
+
+    Failures are found from their result lines; the details sections
+    printed after the run (by testr or subunit-trace) provide their
+    tracebacks, which are cut at MAX_TRACEBACK characters.
+    """
+
+    def __init__(self):
+        self.failures = []
+        self.by_id = {}
+        # A details header is only recognised by the line underlining it,
+        # so each line is held back until the next one has been seen
+        self.pending = None
+        self.capturing = None
+        self.captured = []
+        self.captured_size = 0
+
+    def _details_header(self, line):
+        match = DETAILS_HEADER.match(line)
+        if match:
+            return match.group('test_id')
+        if line.strip() in self.by_id:
+            return line.strip()
+        return None
+
+    def _add(self, failure):
+        if failure.test_id in self.by_id:
+            return self.by_id[failure.test_id]
+        self.failures.append(failure)
+        self.by_id[failure.test_id] = failure
+        return failure
+
+    def _capture(self, line):
+        if self.capturing is None:
+            return
+        if self.captured_size < MAX_TRACEBACK:
+            self.captured.append(line)
+        self.captured_size += len(line) + 1
+
+    def _finish_capture(self):
+        if self.capturing is None:
+            return
+        traceback = '\n'.join(self.captured).strip('\n')
+        if self.captured_size > MAX_TRACEBACK:
+            traceback = traceback[:MAX_TRACEBACK] + '\n... (truncated)'
+        self.capturing.traceback = traceback
+        self.capturing = None
+        self.captured = []
+        self.captured_size = 0
+
+    def feed(self, line):
+        line = LINE_PREFIX.sub('', line.rstrip('\r\n'), count=1)
+        stripped = line.strip()
+
+        if _is_separator(stripped, '-') and self.pending is not None:
+            test_id = self._details_header(self.pending)
+            if test_id is not None:
+                self._finish_capture()
+                self.capturing = self._add(Failure(test_id))
+                self.pending = None
+                return
+
+        if RUN_SUMMARY.match(stripped):
+            # The separator above the summary is not part of the traceback
+            if (self.pending is not None and
+                    not _is_separator(self.pending.strip(), '-')):
+                self._capture(self.pending)
+            self._finish_capture()
+            self.pending = None
+            return
+
+        if self.pending is not None:
+            self._capture(self.pending)
+        self.pending = line
+
+        if _is_separator(stripped, '='):
+            self._finish_capture()
+            self.pending = None
+            return
+
+        match = RESULT_LINE.match(line)
+        if match:
+            duration = match.group('duration')
+            self._add(Failure(match.group('test_id'),
+                              float(duration) if duration else None,
+                              line))
+
+    def close(self):
+        if self.pending is not None:
+            self._capture(self.pending)
+            self.pending = None
+        self._finish_capture()
+        return self.failures
+
+
+def parse_lines(lines):
+    parser = FailureParser()
+    for line in lines:
+        parser.feed(line)
+    return parser.close()
+
+
+def _duration(timestamps):
+    start, stop = timestamps
+    if start is None or stop is None:
+        return None
+    delta = stop - start
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def parse_subunit(stream):
+    """Failures in a subunit v2 stream"""
+    failures = []
+    tests = [0]
+
+    def on_test(test):
+        tests[0] += 1
+        if test['status'] not in ('fail', 'uxsuccess'):
+            return
+        failure = Failure(test['id'], _duration(test['timestamps']))
+        traceback = test['details'].get('traceback')
+        if traceback is not None:
+            text = ''
+            for chunk in traceback.iter_text():
+                text += chunk
+                if len(text) > MAX_TRACEBACK:
+                    text = text[:MAX_TRACEBACK] + '\n... (truncated)'
+                    break
+            failure.traceback = text.strip('\n')
+        failures.append(failure)
+
+    result = testtools.StreamToDict(on_test)
+    result.startTestRun()
+    try:
+        subunit.ByteStreamToStreamResult(
+            stream, non_subunit_name='stdout').run(result)
+    finally:
+        result.stopTestRun()
+    if not tests[0]:
+        raise ValueError('No tests found in the subunit stream')
+    return failures
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def parse_logs(logs_dir):
+    """Failures of the test run whose logs have been copied to logs_dir.
+
+    The subunit stream is preferred, when it was collected and python-subunit
+    is installed; otherwise run_tests.log is parsed.
+    """
+    if subunit is not None:
+        for name in SUBUNIT_FILES:
+            path = os.path.join(logs_dir, name)
+            if not os.path.exists(path):
+                continue
+            try:
+                with _open(path) as stream:
+                    return parse_subunit(stream)
+            except Exception, e:
+                log.warn('Could not parse %s, using %s: %s',
+                         path, RUN_TESTS_LOG, e)
+            break
+
+    path = os.path.join(logs_dir, RUN_TESTS_LOG)
+    if not os.path.exists(path):
+        return []
+    with _open(path) as log_file:
+        return parse_lines(log_file)
+
+
+def summary(failures):
+    """The result lines of the failures, as stored with the job"""
+    return ''.join('%s\n' % failure.line for failure in failures)
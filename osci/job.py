@@ -1,5 +1,6 @@
 import datetime
 import logging
+import re
 import time
 
 import paramiko
@@ -11,11 +12,32 @@ from osci import utils
 from osci import environment
 from osci import db
 from osci import time_services
+from osci import common_ssh_options
+from osci import concurrency
+from osci import failure_parser
 
 
-class Job(db.Base):
-    __tablename__ = 'test'
+LAUNCH_RUN_TESTS_ENV = (
+    'cat > run_tests_env && chmod +x run_tests_env && '
+    '{ nohup bash -c "source /opt/git/openstack-infra/devstack-gate/functions.sh; tsfilter /home/jenkins/run_tests_env"'
+    ' < /dev/null > run_tests.log 2>&1 & } && sleep 1 && kill -0 $!'
+)
+
+NODE_LOGS = [
+    '/home/jenkins/workspace/testing/logs/*',
+    '/home/jenkins/run_test*',
+    '/etc/nova/*',
+    '/etc/swift/*',
+    '/etc/cinder/*',
+    '/etc/keystone/*',
+]
+
+# The exit status of timeout(1) when it had to kill the command
+PROBE_TIMED_OUT = 124
 
+
+class JobColumns(object):
+    """Columns shared by the live job table and its archive"""
     id = db.Column(db.Integer, primary_key=True)
     project_name = db.Column('project_name', db.String(50))
     change_num = db.Column('change_num', db.String(10))
@@ -34,6 +56,105 @@ class Job(db.Base):
     failed = db.Column('failed', db.Text())
     branch = db.Column('branch', db.String(50))
 
+    def __repr__(self):
+        return "%(id)s (%(project_name)s/%(change_num)s) %(state)s" %self
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+
+class ArchivedJob(JobColumns, db.Base):
+    """Completed jobs moved out of the live table by Job.archive"""
+    __tablename__ = 'test_archive'
+    __table_args__ = (
+        db.Index('ix_test_archive_updated', 'updated'),
+        db.Index('ix_test_archive_change_ref', 'change_ref'),
+    )
+
+
+def failed_test_names(failed):
+    """Names of the tempest tests in a job's failure output.
+
+    JSON and XML variants of a test are treated as the same test, since
+    it is driver failures that are of interest.
+    """
+    names = [m.group(0) for m in re.finditer(r'tempest.[^\s()]+', failed or '')]
+    return [name.replace('JSON', '').replace('XML', '') for name in names]
+
+
+class FailedTest(db.Base):
+    """One failed test of a job, in either the live or archive table"""
+    __tablename__ = 'failed_test'
+    __table_args__ = (
+        db.Index('ix_failed_test_job_id', 'job_id'),
+        db.Index('ix_failed_test_test_name', 'test_name'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column('job_id', db.Integer(), nullable=False)
+    test_name = db.Column('test_name', db.String(250), nullable=False)
+    duration = db.Column('duration', db.Float(), nullable=True)
+    traceback = db.Column('traceback', db.Text(), nullable=True)
+
+    def __init__(self, job_id, test_name, duration=None, traceback=None):
+        self.job_id = job_id
+        self.test_name = test_name
+        self.duration = duration
+        self.traceback = traceback
+
+    @classmethod
+    def record(cls, database, job_id, failures):
+        """Replace the failed tests stored for a job.
+
+        `failures` are failure_parser.Failure objects; failures other than
+        of tempest tests are not recorded.
+        """
+        rows = []
+        for failure in failures:
+            for name in failed_test_names(failure.test_id):
+                rows.append(cls(job_id, name, failure.duration,
+                                failure.traceback))
+        with database.get_session() as session:
+            session.query(cls).filter(cls.job_id == job_id).delete(
+                synchronize_session=False)
+            session.add_all(rows)
+
+    @classmethod
+    def backfill(cls, database):
+        """Record failed tests for jobs collected before this table existed.
+
+        Only tempest failures are recorded, so jobs without any are left
+        alone, and running it again does nothing.  Returns the number of
+        jobs recorded.
+        """
+        count = 0
+        for model in [Job, ArchivedJob]:
+            with database.get_session() as session:
+                recorded = session.query(cls.job_id)
+                jobs = (session.query(model.id, model.failed)
+                               .filter(model.failed.like('%tempest.%'))
+                               .filter(~model.id.in_(recorded)).all())
+            for job_id, failed in jobs:
+                failures = [failure for failure
+                            in failure_parser.parse_lines(failed.splitlines())
+                            if failed_test_names(failure.test_id)]
+                if not failures:
+                    continue
+                cls.record(database, job_id, failures)
+                count += 1
+        return count
+
+
+class Job(JobColumns, db.Base):
+    __tablename__ = 'test'
+    __table_args__ = (
+        # The scheduler's polling queries; see getAllWhere, retrieve,
+        # getRecent and DeleteNodeThread
+        db.Index('ix_test_state_updated', 'state', 'updated'),
+        db.Index('ix_test_project_change', 'project_name', 'change_num'),
+        db.Index('ix_test_node_id', 'node_id'),
+        db.Index('ix_test_updated', 'updated'),
+    )
 
     log = logging.getLogger('citrix.job')
 
@@ -57,34 +178,78 @@ class Job(db.Base):
         return self.state == constants.QUEUED
 
     @classmethod
-    def getAllWhere(cls, db, **kwargs):
+    def getAllWhere(cls, db, include_archive=False, **kwargs):
+        models = [cls, ArchivedJob] if include_archive else [cls]
         with db.get_session() as session:
-            return (
-                session
-                    .query(cls)
-                    .filter_by(**kwargs)
-                    .order_by(cls.updated).all()
-            )
+            jobs = []
+            for model in models:
+                jobs.extend(session.query(model).populate_existing()
+                                   .filter_by(**kwargs)
+                                   .order_by(model.updated).all())
+            if include_archive:
+                jobs.sort(key=lambda job: job.updated)
+            return jobs
 
 
     @classmethod
-    def deleteWhere(cls, db, **kwargs):
+    def deleteWhere(cls, db, include_archive=False, **kwargs):
+        models = [cls, ArchivedJob] if include_archive else [cls]
         with db.get_session() as session:
-            deleteJobs = cls.getAllWhere(db, **kwargs)
-            for job in deleteJobs:
-                session.delete(job)
+            for model in models:
+                deleted = session.query(model.id).filter_by(**kwargs)
+                session.query(FailedTest).filter(
+                    FailedTest.job_id.in_(deleted.subquery())).delete(
+                    synchronize_session=False)
+                session.query(model).filter_by(**kwargs).delete(
+                    synchronize_session=False)
 
 
     @classmethod
-    def getRecent(cls, db, recent=24):
+    def getRecent(cls, db, recent=24, include_archive=False):
         recent_date = time_services.now() - datetime.timedelta(hours=recent)
+        models = [cls, ArchivedJob] if include_archive else [cls]
         with db.get_session() as session:
-            return (
-                session
-                    .query(cls)
-                    .filter(cls.updated > recent_date)
-                    .order_by(cls.updated).all()
-            )
+            jobs = []
+            for model in models:
+                jobs.extend(session.query(model).populate_existing()
+                                   .filter(model.updated > recent_date)
+                                   .order_by(model.updated).all())
+            if include_archive:
+                jobs.sort(key=lambda job: job.updated)
+            return jobs
+
+    @classmethod
+    def archive(cls, database, days, batch=1000):
+        """Move jobs completed over `days` days ago to the archive table.
+
+        Jobs still holding a node are left alone.  Rows are moved in
+        batches with INSERT ... SELECT and DELETE, each batch in its own
+        transaction.  Returns the number of jobs archived.
+        """
+        cutoff = time_services.now() - datetime.timedelta(days=days)
+        live = cls.__table__
+        columns = [column.name for column in live.columns]
+        archived = 0
+        while True:
+            with database.get_session() as session:
+                ids = [row[0] for row in session.execute(
+                    db.select([live.c.id])
+                      .where(db.and_(live.c.state.in_([constants.FINISHED,
+                                                       constants.OBSOLETE]),
+                                     live.c.updated < cutoff,
+                                     db.or_(live.c.node_id == None,
+                                            live.c.node_id == 0)))
+                      .order_by(live.c.id)
+                      .limit(batch))]
+                if not ids:
+                    return archived
+                session.execute(ArchivedJob.__table__.insert().from_select(
+                    columns,
+                    db.select([live.c[name] for name in columns])
+                      .where(live.c.id.in_(ids))))
+                session.execute(live.delete().where(live.c.id.in_(ids)))
+            archived += len(ids)
+            cls.log.info('Archived %d jobs', archived)
 
     @classmethod
     def retrieve(cls, database, project_name, change_num):
@@ -92,6 +257,7 @@ class Job(db.Base):
             results = (
                 session
                     .query(cls)
+                    .populate_existing()
                     .filter(db.and_(cls.project_name==project_name,
                                     cls.change_num==change_num,
                                     cls.state != constants.OBSOLETE))
@@ -99,7 +265,56 @@ class Job(db.Base):
             )
             return results
 
+    @classmethod
+    def updateMany(cls, db, changes):
+        """Apply a list of (job, fields) updates in a single commit."""
+        with db.get_session() as session:
+            for job, fields in changes:
+                for name, value in job.with_timestamps(fields).iteritems():
+                    setattr(job, name, value)
+                session.add(job)
+
+    @classmethod
+    def bulk_transition(cls, database, ids, **fields):
+        """Set fields on every job in ids with set-based UPDATEs.
+
+        Timestamps follow the same rules as update().  Returns the number
+        of jobs updated.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        return cls.bulk_transition_where(database, cls.id.in_(ids), **fields)
+
+    @classmethod
+    def bulk_transition_where(cls, database, criterion, **fields):
+        """As bulk_transition, for every job matching the SQL criterion"""
+        now = time_services.now()
+        table = cls.__table__
+        values = dict(fields, updated=now)
+        state = fields.get('state')
+        if state == constants.RUNNING:
+            values['test_started'] = now
+            values['test_stopped'] = None
+
+        with database.get_session() as session:
+            if state is not None and state != constants.RUNNING:
+                # Stop the clock on jobs leaving RUNNING; done first, as
+                # MySQL would see the new state within a single UPDATE
+                session.execute(table.update()
+                                .where(db.and_(criterion,
+                                               table.c.state == constants.RUNNING))
+                                .values(test_stopped=now))
+            result = session.execute(table.update()
+                                     .where(criterion)
+                                     .values(**values))
+        return result.rowcount
+
     def update(self, db, **kwargs):
+        self.update_database_record(db, **self.with_timestamps(kwargs))
+
+    def with_timestamps(self, kwargs):
+        kwargs = dict(kwargs)
         if self.state == constants.RUNNING and kwargs.get('state', constants.RUNNING) != constants.RUNNING:
             kwargs['test_stopped'] = time_services.now()
 
@@ -108,8 +323,7 @@ class Job(db.Base):
             kwargs['test_stopped'] = None
 
         kwargs['updated'] = time_services.now()
-
-        self.update_database_record(db, **kwargs)
+        return kwargs
 
     def update_database_record(self, db, **kwargs):
         with db.get_session() as session:
@@ -151,24 +365,49 @@ class Job(db.Base):
         instruction_list.append("%s %s"%(" ".join(environment.get_environment(self.project_name, self.change_ref, self.branch)),
                                          " ".join(instructions.execute_test_runner())))
 
-        for instruction in instruction_list:
-            cmd = 'echo "%s" >> run_tests_env' % instruction
-            utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s %s'%(
-                Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip, cmd))
-        cmd = "chmod +x run_tests_env"
-        utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s %s'%(
-            Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip, cmd))
-        # For some reason invoking this immediately fails...
-        time.sleep(5)
-        utils.execute_command('ssh$-q$-o$BatchMode=yes$-o$UserKnownHostsFile=/dev/null$-o$StrictHostKeyChecking=no$-i$%s$%s@%s$'\
-                              'nohup bash -c "source /opt/git/openstack-infra/devstack-gate/functions.sh; tsfilter /home/jenkins/run_tests_env" < /dev/null > run_tests.log 2>&1 &'%(
-                Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip), '$')
+        # Ship the script, make it executable and launch it over a single
+        # connection.  The launch is only confirmed once the gate process
+        # is still alive a second after it was started.
+        script = "\n".join(instruction_list) + "\n"
+        started = utils.execute_command(
+            '$'.join(self.sshCommand(node_ip) + [LAUNCH_RUN_TESTS_ENV]),
+            '$', stdin_data=script)
+        if not started:
+            self.log.error('Failed to start tests on node %s/%s.  Deleting node.'%(node_id, node_ip))
+            nodepool.deleteNode(node_id)
+            self.update(db, node_id=0)
+            return
         self.update(db, state=constants.RUNNING)
 
+    @staticmethod
+    def sshCommand(node_ip, extra_opts=None):
+        return common_ssh_options.node_ssh_command(
+            node_ip, Configuration().NODE_USERNAME, Configuration().NODE_KEY,
+            extra_opts)
+
+    def closeConnections(self):
+        if self.node_ip:
+            utils.close_node_connections(self.node_ip,
+                                         Configuration().NODE_USERNAME,
+                                         Configuration().NODE_KEY)
+
     def isRunning(self, db):
+        running, result = self.checkRunningByAge()
+        if running is None:
+            running, result = self.probeRunning()
+        if result:
+            self.update(db, result=result)
+        return running
+
+    def checkRunningByAge(self):
+        """Decide from the job record alone whether the tests are running.
+
+        Returns (running, result); running is None when the node has to be
+        probed and result, if set, is the abort reason to record.
+        """
         if not self.node_ip:
             self.log.error('Checking job %s is running but no node IP address'%self)
-            return False
+            return False, None
 
         # pylint: disable=E
         updated = time.mktime(self.updated.timetuple())
@@ -176,65 +415,76 @@ class Job(db.Base):
 
         if (time.time() - updated < 300):
             # Allow 5 minutes for the gate PID to exist
-            return True
+            return True, None
 
         # Absolute maximum running time of 2 hours.  Note that if by happy chance the tests have finished
         # this result will be over-written by retrieveResults
         if (time.time() - updated > Configuration().get_int('MAX_RUNNING_TIME')):
             self.log.error('Timed out job %s (Running for %d seconds)'%(self, time.time()-updated))
-            self.update(db, result='Aborted: Timed out')
-            return False
+            return False, 'Aborted: Timed out'
+
+        return None, None
+
+    def probeRunning(self):
+        """Ask the node whether the gate is still running.
 
+        Does not touch the database, so it can be run from any thread once
+        the job has been loaded.  Returns (running, result) as for
+        checkRunningByAge; a node that does not answer within PROBE_TIMEOUT
+        is assumed to be still running, until MAX_RUNNING_TIME.
+        """
+        probe_timeout = Configuration().PROBE_TIMEOUT
         try:
-            success = utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s ps -p `cat /home/jenkins/run_tests.pid`'%(
-                    Configuration().NODE_KEY, Configuration().NODE_USERNAME, self.node_ip), silent=True)
+            # timeout kills ssh if the node stops responding, rather than
+            # leaving it running after the prober has given up on it
+            code, _, _ = utils.execute_command(' '.join(
+                    ['timeout', probe_timeout] +
+                    self.sshCommand(self.node_ip,
+                                    ['-o', 'ConnectTimeout=%s' % probe_timeout])
+                    + ['ps -p `cat /home/jenkins/run_tests.pid`']),
+                    silent=True, return_streams=True)
+            if code == PROBE_TIMED_OUT:
+                self.log.error('Timed out checking whether %s (%s) is running'%(
+                               self, self.node_ip))
+                return True, None
+            success = code == 0
             self.log.info('Gate-is-running on job %s (%s) returned: %s'%(
                           self, self.node_ip, success))
-            return success
+            return success, None
         except Exception, e:
-            self.update(db, result='Aborted: Exception checking for pid')
             self.log.exception(e)
-            return False
+            return False, 'Aborted: Exception checking for pid'
 
-    def retrieveResults(self, dest_path):
+    def retrieveResults(self, dest_path, on_file=None):
+        """Download the node's logs to dest_path and return the result.
+
+        on_file, if given, is called with each node log as soon as it has
+        been downloaded, unless the node has no result yet: the collection
+        is then retried later, so the logs are not worth handing over.
+        """
         if not self.node_ip:
             self.log.error('Attempting to retrieve results for %s but no node IP address'%self)
             return constants.NO_IP
         try:
             code, stdout, stderr = utils.execute_command(
-                'ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null'
-                ' -o StrictHostKeyChecking=no -i %s %s@%s cat result.txt' % (
-                    Configuration().NODE_KEY,
-                    Configuration().NODE_USERNAME,
-                    self.node_ip),
+                ' '.join(self.sshCommand(self.node_ip) + ['cat result.txt']),
                 silent=True,
                 return_streams=True
             )
             self.log.info('Result: %s (Err: %s)'%(stdout, stderr))
-            self.log.info('Downloading logs for %s'%self)
-            utils.copy_logs(
-                [
-                    '/home/jenkins/workspace/testing/logs/*',
-                    '/home/jenkins/run_test*',
-                    '/etc/nova/*',
-                    '/etc/swift/*',
-                    '/etc/cinder/*',
-                    '/etc/keystone/*',
-                ],
-                dest_path,
-                self.node_ip,
-                Configuration().NODE_USERNAME,
-                Configuration().NODE_KEY,
-                upload=False
-            )
-
-            self.log.info('Downloading dom0 logs for %s'%self)
-            utils.copy_dom0_logs(
-                self.node_ip,
-                Configuration().NODE_USERNAME,
-                Configuration().NODE_KEY,
-                dest_path
-            )
+            lines = stdout.splitlines()
+            if code == 0 and lines and not lines[0]:
+                on_file = None
+            self.log.info('Downloading domU and dom0 logs for %s'%self)
+            concurrency.call_in_parallel([
+                lambda: self.copyNodeLogs(dest_path, on_file),
+                lambda: utils.copy_dom0_logs(
+                    self.node_ip,
+                    Configuration().NODE_USERNAME,
+                    Configuration().NODE_KEY,
+                    dest_path
+                ),
+            ])
 
             if code != 0:
                 # This node is broken somehow... Mark it as aborted
@@ -247,8 +497,25 @@ class Job(db.Base):
             self.log.exception(e)
             return constants.COPYFAIL
 
-    def __repr__(self):
-        return "%(id)s (%(project_name)s/%(change_num)s) %(state)s" %self
-
-    def __getitem__(self, item):
-        return getattr(self, item)
+    def copyNodeLogs(self, dest_path, on_file=None):
+        if Configuration().LOG_COLLECTION == 'archive':
+            utils.copy_logs_as_archive(
+                NODE_LOGS,
+                dest_path,
+                self.node_ip,
+                Configuration().NODE_USERNAME,
+                Configuration().NODE_KEY,
+                compressor=Configuration().LOG_COMPRESSOR,
+                level=Configuration().LOG_COMPRESSION_LEVEL,
+                on_file=on_file
+            )
+        else:
+            utils.copy_logs(
+                NODE_LOGS,
+                dest_path,
+                self.node_ip,
+                Configuration().NODE_USERNAME,
+                Configuration().NODE_KEY,
+                upload=False,
+                on_file=on_file
+            )
@@ -1,3 +1,4 @@
+import datetime
 import os
 import logging
 import paramiko
@@ -6,11 +7,14 @@ import threading
 
 from osci.db import DB, and_
 from osci.config import Configuration
-from osci.job import Job
+from osci.job import Job, FailedTest
 from osci import constants
 from osci.utils import execute_command, copy_logs, vote
 from osci import filesystem_services
 from osci import time_services
+from osci import concurrency
+from osci import failure_parser
+from osci import wakeup
 
 
 class DeleteNodeThread(threading.Thread):
@@ -23,42 +27,41 @@ class DeleteNodeThread(threading.Thread):
         self.daemon = True
 
     def update_finished_jobs(self):
-        # Remove the node_id from all finished nodes
+        # Remove the node_id from all finished nodes, except those of the
+        # <KEEP_FAILED> most recent failures
         keep_failed = Configuration().get_int('KEEP_FAILED')
         keep_failed_timeout = Configuration().get_int('KEEP_FAILED_TIMEOUT')
-        earliest_failed = time_services.time() - keep_failed_timeout
-
-        with self.jobQueue.db.get_session() as session:
-            finished_node_jobs = session.query(Job).filter(and_(Job.state.in_([constants.COLLECTED,
-                                                                               constants.FINISHED,
-                                                                               constants.OBSOLETE]),
-                                                           Job.node_id != 0))
-
-            # Construct a list of all jobs that could be kept because they failed
-            keep_jobs = []
-            if keep_failed > 0:
-                for job in finished_node_jobs:
-                    if job.result == 'Failed':
-                        updated = time.mktime(job.updated.timetuple())
-                        if updated < earliest_failed:
-                            self.log.debug('Not keeping %s; too old', job)
-                            continue
-                        keep_jobs.append(job)
-                # Only keep the <KEEP_FAILED> most recent failures
-                keep_jobs.sort(key=lambda x: x.updated)
-                self.log.debug('Keeping %s, discarding %s', keep_jobs[-keep_failed:], keep_jobs[:-keep_failed])
-                keep_jobs = keep_jobs[-keep_failed:]
-
-            for job in finished_node_jobs:
-                if job in keep_jobs:
-                    continue
-                job.update(self.jobQueue.db, node_id=0)
+        now = time_services.now()
+        earliest_failed = now - datetime.timedelta(seconds=keep_failed_timeout)
+
+        finished_with_node = and_(Job.state.in_([constants.COLLECTED,
+                                                 constants.FINISHED,
+                                                 constants.OBSOLETE]),
+                                  Job.node_id > 0)
+        keep_ids = []
+        if keep_failed > 0:
+            with self.jobQueue.db.get_session() as session:
+                keep_ids = [job_id for job_id, in
+                            session.query(Job.id)
+                                .filter(finished_with_node)
+                                .filter(Job.result == 'Failed')
+                                .filter(Job.updated >= earliest_failed)
+                                .order_by(Job.updated.desc())
+                                .limit(keep_failed)]
+            self.log.debug('Keeping the nodes of jobs %s', keep_ids)
+
+        # A job finishing after the SELECT may be a failure it would have
+        # kept, so it is left for the next cycle
+        release = and_(finished_with_node, Job.updated < now)
+        if keep_ids:
+            release = and_(release, ~Job.id.in_(keep_ids))
+        Job.bulk_transition_where(self.jobQueue.db, release, node_id=0)
 
     def get_nodes(self):
         # Find all node IDs that are currently in use
         nodes_in_use = set()
         with self.jobQueue.db.get_session() as session:
-            jobs_with_node = session.query(Job).filter(Job.node_id != 0)
+            jobs_with_node = session.query(Job).populate_existing().filter(Job.node_id > 0)
             for job in jobs_with_node:
                 nodes_in_use.add(job.node_id)
 
@@ -66,6 +69,11 @@ class DeleteNodeThread(threading.Thread):
         held_set = self.pool.getHeldNodes()
         return held_set - nodes_in_use
 
+    def archive_old_jobs(self):
+        days = Configuration().get_int('ARCHIVE_AFTER_DAYS')
+        if days > 0:
+            Job.archive(self.jobQueue.db, days)
+
     def _continue(self):
         return True
 
@@ -77,6 +85,8 @@ class DeleteNodeThread(threading.Thread):
                 self.log.debug('Nodes to delete: %s'%delete_list)
                 for node_id in delete_list:
                     self.pool.deleteNode(node_id)
+                self.archive_old_jobs()
+                self.jobQueue.db.remove_session()
                 time.sleep(60)
             except Exception, e:
                 self.log.exception(e)
@@ -90,25 +100,17 @@ class CollectResultsThread(threading.Thread):
         self.daemon = True
         self.jobQueue = jobQueue
 
-    def get_jobs(self):
-        ret_list = []
-        collectingJobs = Job.getAllWhere(self.jobQueue.db,
-                                         state=constants.COLLECTING)
-        for job in collectingJobs:
-            ret_list.append(job)
-        return ret_list
-
     def _continue(self):
         return True
 
     def run(self):
         while self._continue():
             try:
-                collect_list = self.get_jobs()
-                self.log.debug('Nodes to collect: %s'%collect_list)
-                for job in collect_list:
-                    self.jobQueue.uploadResults(job)
-                time.sleep(10)
+                self.jobQueue.collectResults()
+                self.jobQueue.db.remove_session()
+                # processResults sets this as soon as a job needs collecting
+                self.jobQueue.collect_event.wait(10)
+                self.jobQueue.collect_event.clear()
             except Exception, e:
                 self.log.exception(e)
 
@@ -123,6 +125,13 @@ class JobQueue(object):
         self.filesystem = filesystem
         self.uploader = uploader
         self.executor = executor
+        self.dispatching = set()
+        self.dispatching_lock = threading.Lock()
+        self.collecting = set()
+        self.collecting_lock = threading.Lock()
+        self.probing = set()
+        self.probing_lock = threading.Lock()
+        self.collect_event = threading.Event()
 
     def startCleanupThreads(self):
         if self.collectResultsThread is None:
@@ -142,6 +151,7 @@ class JobQueue(object):
         with self.db.get_session() as session:
             self.log.info("Job for %s queued"%job.change_num)
             session.add(job)
+        wakeup.notify()
 
     def triggerJob(self, job_id):
         allJobs = Job.getAllWhere(self.db, id=job_id)
@@ -154,8 +164,29 @@ class JobQueue(object):
             self.addJob(job.change_ref, job.project_name, job.commit_id)
 
     def triggerJobs(self):
-        for job in self.get_queued_enabled_jobs():
-            job.runJob(self.db, self.nodepool)
+        job_ids = []
+        with self.dispatching_lock:
+            for job in self.get_queued_enabled_jobs():
+                if job.id in self.dispatching:
+                    self.log.info('Job %s is still being dispatched', job)
+                    continue
+                self.dispatching.add(job.id)
+                job_ids.append(job.id)
+
+        concurrency.run_concurrently(self._dispatch, job_ids,
+                                     Configuration().get_int('DISPATCH_WORKERS'),
+                                     Configuration().get_int('DISPATCH_TIMEOUT'),
+                                     name='dispatch',
+                                     finalizer=self.db.remove_session)
+
+    def _dispatch(self, job_id):
+        # Each dispatcher reloads the job so it is only ever modified
+        # through this thread's own session
+        try:
+            self.triggerJob(job_id)
+        finally:
+            with self.dispatching_lock:
+                self.dispatching.discard(job_id)
 
     def get_queued_enabled_jobs(self):
         allJobs = Job.getAllWhere(self.db, state=constants.QUEUED)
@@ -178,40 +209,145 @@ class JobQueue(object):
 
     def uploadResults(self, job):
         tmpPath = self.filesystem.mkdtemp(suffix=job.change_num)
+        release_node = None
 
         try:
             self.filesystem.mkdir('%s/logs'%tmpPath)
-            result = job.retrieveResults('%s/logs'%tmpPath)
-            if not result:
-                logging.info('No result obtained from %s', job)
-                return
-
-            code, fail_stdout, stderr = self.executor('grep$... FAIL$%s/logs/run_tests.log'%tmpPath,
-                                                      delimiter='$',
-                                                      return_streams=True)
-            self.log.info('Result: %s (Err: %s)', fail_stdout, stderr)
-
-            self.log.info('Copying logs for %s', job)
-            result_url = self.uploader.upload(['%s/logs/run_tests.log'%tmpPath, '%s/logs'%tmpPath],
-                                              job.change_ref.replace('refs/changes/','')+'/%s'%job.id)
+            # Each log is uploaded as soon as it has been downloaded, so the
+            # upload overlaps the download rather than following it
+            upload = self.uploader.start_upload(
+                ['%s/logs/run_tests.log'%tmpPath, '%s/logs'%tmpPath],
+                job.change_ref.replace('refs/changes/','')+'/%s'%job.id)
+            try:
+                result = job.retrieveResults('%s/logs'%tmpPath,
+                                             on_file=upload.add_file)
+                if not result:
+                    logging.info('No result obtained from %s', job)
+                    return
+
+                failures = failure_parser.parse_logs('%s/logs'%tmpPath)
+                fail_stdout = failure_parser.summary(failures)
+                self.log.info('Result: %s', fail_stdout)
+
+                self.log.info('Finishing upload of logs for %s', job)
+                result_url = upload.finish()
+            finally:
+                upload.abandon()
             self.log.info('Uploaded results for %s', job)
-            job.update(self.db, result=result,
-                       logs_url=result_url,
-                       report_url=result_url,
-                       failed=fail_stdout)
-            job.update(self.db, state=constants.COLLECTED)
+            FailedTest.record(self.db, job.id, failures)
+            fields = dict(result=result, logs_url=result_url,
+                          report_url=result_url, failed=fail_stdout,
+                          state=constants.COLLECTED)
+            # The logs are safe in swift, so unless the node is one that
+            # KEEP_FAILED may hold on to, nodepool can have it back now.
+            # node_id is cleared first, so DeleteNodeThread still deletes
+            # the node if the deletion below fails.
+            release_node = job.node_id
+            if release_node and self.keepsNode(result):
+                self.log.info('Holding node %s of %s', release_node, job)
+                release_node = None
+            elif release_node:
+                fields['node_id'] = 0
+            job.update(self.db, **fields)
+            wakeup.notify()
         finally:
+            # Nothing else needs to talk to the node once results are in
+            job.closeConnections()
             self.filesystem.rmtree(tmpPath)
 
+        if release_node:
+            self.log.info('Releasing node %s of %s', release_node, job)
+            try:
+                self.nodepool.deleteNode(release_node)
+            except Exception, e:
+                self.log.exception(e)
+
+    def keepsNode(self, result):
+        """Whether KEEP_FAILED may keep the node of a job with this result"""
+        return (Configuration().get_int('KEEP_FAILED') > 0 and
+                result == 'Failed')
+
+    def collectJob(self, job_id):
+        allJobs = Job.getAllWhere(self.db, id=job_id)
+        for job in allJobs:
+            # Another collector may have finished with it already
+            if job.state == constants.COLLECTING:
+                self.uploadResults(job)
+
+    def collectResults(self):
+        job_ids = []
+        with self.collecting_lock:
+            for job in Job.getAllWhere(self.db, state=constants.COLLECTING):
+                if job.id in self.collecting:
+                    self.log.debug('Job %s is still being collected', job)
+                    continue
+                self.collecting.add(job.id)
+                job_ids.append(job.id)
+            in_progress = len(self.collecting) - len(job_ids)
+
+        workers = Configuration().get_int('COLLECT_WORKERS')
+        self.log.info('Collect queue: %d jobs to collect, %d in progress, '
+                      '%d workers', len(job_ids), in_progress, workers)
+        concurrency.run_concurrently(self._collect, job_ids, workers,
+                                     Configuration().get_int('COLLECT_TIMEOUT'),
+                                     name='collect',
+                                     finalizer=self.db.remove_session)
+
+    def _collect(self, job_id):
+        # As with dispatch, the claim is held until the collection really
+        # finishes, even if run_concurrently gave up waiting for it
+        try:
+            self.collectJob(job_id)
+        finally:
+            with self.collecting_lock:
+                self.collecting.discard(job_id)
+
     def processResults(self):
         allJobs = Job.getAllWhere(self.db, state=constants.RUNNING)
         self.log.info('%d jobs running...'%len(allJobs))
-        for job in allJobs:
-            if job.isRunning(self.db):
-                continue
 
-            job.update(self.db, state=constants.COLLECTING)
-            self.log.info('Tests for %s are done! Collecting'%job)
+        checked = []
+        to_probe = []
+        with self.probing_lock:
+            for job in allJobs:
+                running, result = job.checkRunningByAge()
+                if running is not None:
+                    checked.append((job, (running, result)))
+                elif job.id in self.probing:
+                    self.log.info('Job %s is still being probed', job)
+                else:
+                    self.probing.add(job.id)
+                    to_probe.append(job)
+
+        # The jobs were loaded above, so the probes never need this
+        # thread's session; probes that time out are retried once they
+        # have finished
+        checked.extend(concurrency.run_concurrently(
+            self._probe, to_probe,
+            Configuration().get_int('PROBE_WORKERS'),
+            Configuration().get_int('PROBE_TIMEOUT'),
+            name='probe'))
+
+        changes = []
+        for job, (running, result) in checked:
+            fields = {}
+            if result:
+                fields['result'] = result
+            if not running:
+                fields['state'] = constants.COLLECTING
+                self.log.info('Tests for %s are done! Collecting'%job)
+            if fields:
+                changes.append((job, fields))
+        Job.updateMany(self.db, changes)
+        if [fields for _, fields in changes if 'state' in fields]:
+            self.collect_event.set()
+
+    def _probe(self, job):
+        try:
+            return job.probeRunning()
+        finally:
+            with self.probing_lock:
+                self.probing.discard(job.id)
 
     def postResults(self):
         allJobs = Job.getAllWhere(self.db, state=constants.COLLECTED)
@@ -237,4 +373,4 @@ class JobQueue(object):
                     job.update(self.db, state=constants.FINISHED)
 
     def flush(self):
-        Job.deleteWhere(self.db)
+        Job.deleteWhere(self.db, include_archive=True)
@@ -1,3 +1,21 @@
+# tar options selecting the decompressor, by compressor name
+DECOMPRESS_OPTIONS = {
+    'gzip': ['-z'],
+    'zstd': ['-I', 'zstd'],
+    'none': [],
+}
+
+
 class Localhost(object):
     def commands_to_extract_stdout_tgz_to(self, target):
         return 'tar -xzf - -C {0}'.format(target).split()
+
+    def commands_to_extract_stdout_archive_to(self, target, compressor='gzip',
+                                              verbose=False):
+        # With verbose, each member's name is printed as it is extracted
+        return (
+            ['tar', '-x']
+            + (['-v'] if verbose else [])
+            + DECOMPRESS_OPTIONS[compressor]
+            + '-f - -C {0}'.format(target).split()
+        )
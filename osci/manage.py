@@ -1,7 +1,6 @@
 import logging
 import optparse
 import re
-import time
 
 from prettytable import PrettyTable
 from threading import Event
@@ -15,6 +14,7 @@ from osci import utils
 from osci import db
 from osci import filesystem_services
 from osci import swift_upload
+from osci import wakeup
 
 
 def get_parser():
@@ -36,11 +36,8 @@ def get_parser():
 
     return parser
 
-def main():
-    parser = get_parser()
-    (options, _) = parser.parse_args()
-
-    level = logging.DEBUG if options.verbose else logging.INFO
+def setup_logging(verbose):
+    level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(
         format=u'%(asctime)s %(levelname)s %(name)s %(message)s',
         level=level)
@@ -51,15 +48,48 @@ def main():
                         'swiftclient']:
         logging.getLogger(logger_name).setLevel(logging.WARNING)
 
+def create_queue():
     database = db.DB(Configuration().DATABASE_URL)
 
-    queue = JobQueue(
+    return JobQueue(
         database=database,
         nodepool=NodePool(Configuration().NODEPOOL_IMAGE),
         filesystem=filesystem_services.RealFilesystem(),
         uploader=swift_upload.SwiftUploader(),
         executor=utils.execute_command)
-    
+
+def run_scheduler(queue):
+    queue.startCleanupThreads()
+
+    # New jobs and collected results wake us straight away; POLL is only
+    # a fallback for anything that does not notify (e.g. timeouts)
+    listener = wakeup.Listener()
+    try:
+        while True:
+            try:
+                queue.postResults()
+                queue.processResults()
+                queue.triggerJobs()
+                Configuration().check_reload()
+            except Exception, e:
+                logging.exception(e)
+                # Ignore exception and try again; keeps the app polling
+            # Start each cycle with a fresh session and connection
+            queue.db.remove_session()
+            listener.wait(Configuration().get_int('POLL'))
+    except KeyboardInterrupt:
+        logging.info("Terminated by user")
+    finally:
+        listener.close()
+
+def main():
+    parser = get_parser()
+    (options, _) = parser.parse_args()
+
+    setup_logging(options.verbose)
+
+    queue = create_queue()
+
     if options.flush:
         queue.flush()
         return
@@ -80,19 +110,4 @@ def main():
             queue.recheckJob(jobnum)
         return
 
-    queue.startCleanupThreads()
-
-    try:
-        while True:
-            try:
-                queue.postResults()
-                queue.processResults()
-                queue.triggerJobs()
-                Configuration().check_reload()
-            except Exception, e:
-                logging.exception(e)
-                # Ignore exception and try again; keeps the app polling
-            time.sleep(Configuration().get_int('POLL'))
-    except KeyboardInterrupt:
-        logging.info("Terminated by user")
-
+    run_scheduler(queue)
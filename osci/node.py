@@ -3,6 +3,14 @@ from osci import executor
 from osci import common_ssh_options
 
 
+# Commands compressing stdin to stdout, by compressor name and level
+COMPRESSORS = {
+    'gzip': lambda level: ['gzip', '-%s' % level, '-c'],
+    'zstd': lambda level: ['zstd', '-%s' % level, '-q', '-c'],
+    'none': lambda level: ['cat'],
+}
+
+
 class Node(server.Server):
 
     USERNAME = 'node_username'
@@ -29,3 +37,13 @@ class Node(server.Server):
                 sources).split()
         )
 
+
+    def command_to_get_files_as_archive_to_stdout(self, sources, compressor='gzip', level=6):
+        # Only regular files are archived and their directories are
+        # stripped, giving the same flat layout as copying them one by one
+        return self.run(
+            ['find'] + sources.split()
+            + '-maxdepth 0 -type f -print0 2>/dev/null |'.split()
+            + "tar --null -T - --ignore-failed-read '--transform=s,.*/,,' -cf - |".split()
+            + COMPRESSORS[compressor](level)
+        )
@@ -3,9 +3,13 @@ import threading
 import Queue
 from osci.config import Configuration
 from osci import time_services
+from osci import utils
 
 class NodePool():
     log = logging.getLogger('citrix.nodepool')
+    # Jobs are dispatched from several threads; serialise allocation
+    # so the same READY node is never handed out twice
+    lock = threading.RLock()
 
     def __init__(self, image):
         self.image = image
@@ -25,7 +29,7 @@ class NodePool():
         return self.pool.getDB().getSession()
 
     def getNode(self):
-        with self.getSession() as session:
+        with self.lock, self.getSession() as session:
             for node in session.getNodes():
                 if node.label_name != self.image:
                     continue
@@ -51,8 +55,17 @@ class NodePool():
     def deleteNode(self, node_id):
         if not node_id:
             return
-        self.pool.reconfigureManagers(self.pool.config)
-        with self.getSession() as session:
-            node = session.getNode(node_id)
-            if node:
-                self.pool._deleteNode(session, node)
+        with self.lock:
+            self.pool.reconfigureManagers(self.pool.config)
+            with self.getSession() as session:
+                node = session.getNode(node_id)
+                if node:
+                    # Nodepool may hand the IP out again, and a new node
+                    # must not be reached through this one's ssh master
+                    try:
+                        utils.close_node_connections(
+                            node.ip, Configuration().NODE_USERNAME,
+                            Configuration().NODE_KEY)
+                    except Exception, e:
+                        self.log.exception(e)
+                    self.pool._deleteNode(session, node)
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
 import argparse
+import csv
+import datetime
+import json
 import logging
-import re
+import StringIO
+import sys
 import time
 
 from prettytable import PrettyTable
@@ -11,10 +15,29 @@ from osci.nodepool_manager import NodePool
 from osci.config import Configuration
 from osci.job_queue import JobQueue
 from osci import constants
-from osci.job import Job
+from osci.job import Job, ArchivedJob, FailedTest
 from osci import db
+from osci import time_services
 
 
+FORMATS = ['text', 'json', 'ndjson', 'csv']
+
+# Columns of the machine readable formats
+LIST_COLUMNS = ['id', 'project_name', 'change_num', 'change_ref', 'state',
+                'node_id', 'node_ip', 'result', 'logs_url', 'created',
+                'updated', 'test_started', 'test_stopped']
+SHOW_COLUMNS = LIST_COLUMNS + ['commit_id', 'report_url', 'branch', 'failed']
+FAILED_JOB_COLUMNS = ['id', 'project_name', 'change_num', 'state', 'result',
+                      'logs_url', 'updated', 'test_started', 'test_stopped']
+FAILURE_COLUMNS = ['test_name', 'count']
+
+
+def add_format_argument(parser):
+    parser.add_argument('--format', dest='format', choices=FORMATS,
+                        default='text',
+                        help="Output format; the machine readable formats "
+                        "are streamed one row at a time")
+
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
@@ -31,18 +54,29 @@ def get_parser():
     parser_list.add_argument('--recent', dest='recent',
                              action='store', default="24",
                              help="Include only recent jobs (hours)")
+    parser_list.add_argument('--archive', dest='archive',
+                             action='store_true', default=False,
+                             help="Include archived jobs")
+    add_format_argument(parser_list)
 
     parser_show = subparsers.add_parser('show')
     parser_show.set_defaults(func=func_show)
     parser_show.add_argument('change_ref',
                              help="One time job on a change-ref "+\
                              "e.g. refs/changes/55/7155/1")
+    parser_show.add_argument('--archive', dest='archive',
+                             action='store_true', default=False,
+                             help="Include archived jobs")
+    add_format_argument(parser_show)
 
     parser_fail = subparsers.add_parser('failures')
     parser_fail.set_defaults(func=func_failures)
     parser_fail.add_argument('--recent', dest='recent',
                              action='store', default="24",
                              help="Include only recent jobs (hours)")
+    parser_fail.add_argument('--archive', dest='archive',
+                             action='store_true', default=False,
+                             help="Include archived jobs")
     parser_fail.add_argument('--with-fail', dest='withfail',
                              action='store', default=None,
                              help="Include only jobs with this failure")
@@ -52,34 +86,156 @@ def get_parser():
     parser_fail.add_argument('--min-dup', dest='min_dup',
                              action='store', default="2",
                              help="Include only fails with at least this number of duplicates")
+    add_format_argument(parser_fail)
 
     return parser
 
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def stream_rows(output_format, columns, rows):
+    """Render rows, sequences of values for `columns`, as they arrive"""
+    if output_format == 'csv':
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf)
+        def line(values):
+            writer.writerow([_csv_value(value) for value in values])
+            text = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return text
+        yield line(columns)
+        for row in rows:
+            yield line(row)
+    elif output_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), default=_json_value) + '\n'
+    elif output_format == 'json':
+        separator = '\n'
+        yield '['
+        for row in rows:
+            yield separator + json.dumps(dict(zip(columns, row)),
+                                         default=_json_value)
+            separator = ',\n'
+        yield '\n]\n'
+    else:
+        raise ValueError('Unknown format %s' % output_format)
+
+def stream_sections(output_format, sections):
+    """Render several (name, columns, rows) sections as one document.
+
+    JSON has an array per section, keyed by name; each NDJSON line names
+    its section; CSV has a header per section, with a blank line between.
+    """
+    if output_format == 'json':
+        separator = '\n'
+        yield '{'
+        for name, columns, rows in sections:
+            yield separator + json.dumps(name) + ': '
+            for chunk in stream_rows(output_format, columns, rows):
+                yield chunk.rstrip('\n')
+            separator = ',\n'
+        yield '\n}\n'
+    elif output_format == 'ndjson':
+        for name, columns, rows in sections:
+            for chunk in stream_rows(output_format, ['section'] + columns,
+                                     ([name] + list(row) for row in rows)):
+                yield chunk
+    elif output_format == 'csv':
+        separator = ''
+        for name, columns, rows in sections:
+            yield separator
+            for chunk in stream_rows(output_format, columns, rows):
+                yield chunk
+            separator = '\r\n'
+    else:
+        raise ValueError('Unknown format %s' % output_format)
+
+def _stream_jobs(job_queries, columns, batch=1000):
+    """Yield the `columns` of each job straight from the cursor"""
+    state_column = columns.index('state')
+    for model, query in job_queries:
+        rows = (query.with_entities(*[getattr(model, column)
+                                      for column in columns])
+                     .order_by(model.updated).yield_per(batch))
+        for row in rows:
+            row = list(row)
+            row[state_column] = constants.STATES[row[state_column]]
+            yield row
+
+def _models(options):
+    # Archived jobs first, since those are the older ones
+    return [ArchivedJob, Job] if options.archive else [Job]
+
+def _recent_jobs(session, model, recent):
+    recent_date = time_services.now() - datetime.timedelta(hours=recent)
+    return (session.query(model).options(db.defer(model.failed))
+                   .filter(model.updated > recent_date))
+
+def _count_states(session, job_queries):
+    """Count jobs by state and by result, in the database"""
+    state_dict = {}
+    result_dict = {}
+    for model, query in job_queries:
+        counts = (query.with_entities(model.state, model.result,
+                                      db.func.count())
+                       .group_by(model.state, model.result))
+        for state, result, count in counts:
+            state_name = constants.STATES[state]
+            state_dict[state_name] = state_dict.get(state_name, 0) + count
+            result_dict[result] = result_dict.get(result, 0) + count
+    return state_dict, result_dict
+
+def _stream_list(options, queue, state_ids):
+    with queue.db.get_session() as session:
+        job_queries = [(model, _recent_jobs(session, model, int(options.recent))
+                               .filter(model.state.in_(state_ids)))
+                       for model in _models(options)]
+        for chunk in stream_rows(options.format, LIST_COLUMNS,
+                                 _stream_jobs(job_queries, LIST_COLUMNS)):
+            yield chunk
+
 def func_list(options, queue):
     table = PrettyTable(["ID", "Project", "Change", "State", "IP", "Result",
                          "Age (hours)", "Duration"])
     table.align = 'l'
     now = time.time()
-    all_jobs = Job.getRecent(queue.db, int(options.recent))
-    state_dict = {}
-    result_dict = {}
     if options.states and len(options.states) > 0:
         states = options.states.split(',')
     else:
         # Default should be everything except obsolete jobs
         states = constants.STATES.values()
         states.remove(constants.STATES[constants.OBSOLETE])
+    state_ids = [state for state, name in constants.STATES.items()
+                 if name in states]
+    if options.format != 'text':
+        return _stream_list(options, queue, state_ids)
+
+    models = _models(options)
+    with queue.db.get_session() as session:
+        job_queries = [(model, _recent_jobs(session, model, int(options.recent)))
+                       for model in models]
+        state_dict, result_dict = _count_states(session, job_queries)
+        all_jobs = []
+        for model, query in job_queries:
+            all_jobs.extend(query.filter(model.state.in_(state_ids))
+                                 .order_by(model.updated).all())
+        all_jobs.sort(key=lambda job: job.updated)
 
     for job in all_jobs:
         updated = time.mktime(job.updated.timetuple())
         age_hours = (now - updated) / 3600
-        state_count = state_dict.get(constants.STATES[job.state], 0) + 1
-        state_dict[constants.STATES[job.state]] = state_count
-        result_count = result_dict.get(job.result, 0)+1
-        result_dict[job.result] = result_count
-
-        if states and constants.STATES[job.state] not in states:
-            continue
         if job.node_id:
             node_ip = job.node_ip
         else:
@@ -100,9 +256,21 @@ def func_list(options, queue):
     output_str = output_str + str(table)
     return output_str
 
+def _stream_show(options, queue):
+    with queue.db.get_session() as session:
+        job_queries = [(model, session.query(model).filter(
+                            model.change_ref == options.change_ref))
+                       for model in _models(options)]
+        for chunk in stream_rows(options.format, SHOW_COLUMNS,
+                                 _stream_jobs(job_queries, SHOW_COLUMNS)):
+            yield chunk
+
 def func_show(options, queue):
+    if options.format != 'text':
+        return _stream_show(options, queue)
     output_str = ''
-    jobs = Job.getAllWhere(queue.db, change_ref=options.change_ref)
+    jobs = Job.getAllWhere(queue.db, include_archive=options.archive,
+                           change_ref=options.change_ref)
     for job in jobs:
         table = PrettyTable()
         table.add_column('Key', ['ID', 'Project name', 'Change num', 'Change ref',
@@ -120,18 +288,108 @@ def func_show(options, queue):
         output_str = output_str + str(table)+'\n'
     return output_str
 
+def _failed_jobs(session, model, recent, withfail):
+    """Query the failed or aborted jobs of `model` to report on"""
+    query = (_recent_jobs(session, model, recent)
+             .filter(db.or_(model.result == 'Failed',
+                            model.result.like('Aborted%'))))
+    failures = session.query(FailedTest).filter(FailedTest.job_id == model.id)
+    if withfail is not None:
+        if len(withfail) == 0:
+            query = query.filter(db.not_(failures.exists()))
+        else:
+            query = query.filter(failures.filter(
+                FailedTest.test_name.contains(withfail)).exists())
+    return query
+
+def _count_failures(session, job_queries, max_fails, min_dup):
+    """Count duplicate failures across the jobs in `job_queries`.
+
+    Jobs with no failed tests, or more than `max_fails` of them, are
+    counted as such rather than by test; tests failing in fewer than
+    `min_dup` jobs are counted together.
+    """
+    in_jobs = db.or_(*[FailedTest.job_id.in_(query.with_entities(model.id))
+                       for model, query in job_queries])
+    per_job = (session.query(FailedTest.job_id,
+                             db.func.count().label('failures'))
+                      .filter(in_jobs).group_by(FailedTest.job_id))
+    counts = {}
+
+    no_failures = sum(query.filter(db.not_(
+        session.query(FailedTest).filter(FailedTest.job_id == model.id)
+               .exists())).count() for model, query in job_queries)
+    if no_failures:
+        counts['No tempest failures detected'] = no_failures
+
+    per_test = session.query(FailedTest.test_name,
+                             db.func.count().label('count')).filter(in_jobs)
+    if max_fails > 0:
+        too_many = per_job.having(db.func.count() > max_fails)
+        many_count = too_many.from_self().count()
+        if many_count:
+            counts['More than %s failures' % max_fails] = many_count
+        per_test = per_test.filter(~FailedTest.job_id.in_(
+            too_many.from_self(FailedTest.job_id)))
+    per_test = per_test.group_by(FailedTest.test_name)
+
+    if min_dup:
+        rare = per_test.having(db.func.count() < min_dup).from_self().count()
+        per_test = per_test.having(db.func.count() >= min_dup)
+        # The summary lines are subject to the same threshold
+        for name in list(counts.keys()):
+            if counts[name] < min_dup:
+                rare += 1
+                del counts[name]
+        if rare:
+            counts['Fewer than %s duplicates' % min_dup] = rare
+
+    counts.update(per_test.all())
+    return counts
+
+def _stream_failures(options, queue):
+    with queue.db.get_session() as session:
+        job_queries = [(model, _failed_jobs(session, model, int(options.recent),
+                                            options.withfail))
+                       for model in _models(options)]
+
+        def failure_rows():
+            # A generator, so the counting waits until the jobs are streamed
+            counts = _count_failures(session, job_queries,
+                                     int(options.max_fails),
+                                     int(options.min_dup or 0))
+            for row in sorted(counts.items(), key=lambda item: item[1],
+                              reverse=True):
+                yield row
+
+        sections = [('jobs', FAILED_JOB_COLUMNS,
+                     _stream_jobs(job_queries, FAILED_JOB_COLUMNS)),
+                    ('failures', FAILURE_COLUMNS, failure_rows())]
+        for chunk in stream_sections(options.format, sections):
+            yield chunk
+
 def func_failures(options, queue):
+    if options.format != 'text':
+        return _stream_failures(options, queue)
     output_str = ''
     table = PrettyTable(["ID", "Project", "Change", "State", "Result", "Age",
                              "Duration", "URL"])
     table.align = 'l'
     now = time.time()
-    all_jobs = Job.getRecent(queue.db, int(options.recent))
-    all_failed_tests = {}
+    models = _models(options)
+    with queue.db.get_session() as session:
+        job_queries = [(model, _failed_jobs(session, model, int(options.recent),
+                                            options.withfail))
+                       for model in models]
+        all_jobs = []
+        for model, query in job_queries:
+            all_jobs.extend(query.order_by(model.updated).all())
+        all_jobs.sort(key=lambda job: job.updated)
+        all_failed_tests = _count_failures(session, job_queries,
+                                           int(options.max_fails),
+                                           int(options.min_dup or 0))
+
     for job in all_jobs:
-        if not job.result or (job.result != 'Failed' and
-                              job.result.find('Aborted') != 0):
-            continue
         updated = time.mktime(job.updated.timetuple())
         age_hours = (now - updated) / 3600
         age = '%.02f' % (age_hours)
@@ -142,47 +400,15 @@ def func_failures(options, queue):
             stopped = time.mktime(job.test_stopped.timetuple())
             duration = "%.02f"%((stopped - started)/3600)
 
-        job_failed = job.failed if job.failed is not None else ''
-        failed_tests = [m.group(0) for m in re.finditer('tempest.[^ ()]+', job_failed)]
-
-        if options.withfail is not None:
-            if len(options.withfail) == 0:
-                if len(failed_tests) != 0:
-                    continue
-            else:
-                if options.withfail not in job.failed:
-                    continue
-
         table.add_row([job.id, job.project_name, job.change_num,
                        constants.STATES[job.state], job.result, age,
                        duration, job.logs_url])
 
-        if len(failed_tests) == 0:
-            failed_tests = ['No tempest failures detected']
-        elif int(options.max_fails) > 0 and len(failed_tests) > int(options.max_fails):
-            failed_tests = ['More than %s failures'%options.max_fails]
-
-        for failed_test in failed_tests:
-            # Treat JSON and XML as the same since we're only interested in driver failures
-            failed_test = failed_test.replace('JSON', '')
-            failed_test = failed_test.replace('XML', '')
-            cur_count = all_failed_tests.get(failed_test, 0)
-            all_failed_tests[failed_test] = cur_count + 1
-
-    if options.min_dup:
-        msg='Fewer than %s duplicates'%options.min_dup
-        for failed_test in list(all_failed_tests.keys()):
-            if all_failed_tests[failed_test] < int(options.min_dup):
-                cur_count = all_failed_tests.get(msg, 0)
-                all_failed_tests[msg] = cur_count + 1
-                del all_failed_tests[failed_test]
-
     output_str += str(table) + '\n'
     output_str += '\n'
     output_str += 'Failures\n'
     output_str += '-------------------\n'
 
-    single_count =0
     sorted_tests = sorted(all_failed_tests, key=all_failed_tests.get, reverse=True)
     for failed_test in sorted_tests:
         output_str += "%3d %s\n"%(all_failed_tests[failed_test], failed_test)
@@ -212,4 +438,9 @@ def main():
         uploader=None,
         executor=None)
 
-    print(options.func(options, queue))
+    output = options.func(options, queue)
+    if options.format == 'text':
+        print(output)
+    else:
+        for chunk in output:
+            sys.stdout.write(chunk)
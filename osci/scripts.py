@@ -34,9 +34,9 @@ def run_tests():
     sys.exit(run_command(commands.RunTests))
 
 
-def watch_gerrit():
+def watch_gerrit_env():
     c = config.Configuration()
-    env = dict(
+    return dict(
         gerrit_client='pygerrit',
         gerrit_host=c.get('GERRIT_HOST'),
         event_target='queue',
@@ -49,7 +49,10 @@ def watch_gerrit():
         recent_event_time=c.get('GERRIT_EVENT_TIMEOUT'),
         sleep_timeout=c.get('POLL')
     )
-    sys.exit(run_command(commands.WatchGerrit, env=env))
+
+
+def watch_gerrit():
+    sys.exit(run_command(commands.WatchGerrit, env=watch_gerrit_env()))
 
 def create_dbschema():
     env = dict(
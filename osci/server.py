@@ -11,6 +11,7 @@ class Server(object):
         self.username = env.get(self.USERNAME, self.USERNAME.upper())
         self.host = env.get(self.HOST, self.HOST.upper())
         self.keyfile = env.get(self.KEYFILE, None)
+        self.ssh_options = env.get('ssh_options', [])
 
     @classmethod
     def add_arguments_to(cls, parser):
@@ -21,6 +22,7 @@ class Server(object):
         return (
             ['ssh']
             + common_ssh_options.COMMON_SSH_OPTS
+            + self.ssh_options
             + [part for part in ['-i', self.keyfile] if self.keyfile]
             + ['{0}@{1}'.format(self.username, self.host)]
         )
@@ -0,0 +1,63 @@
+import logging
+import optparse
+import threading
+import time
+
+from osci.config import Configuration
+from osci import commands
+from osci import manage
+from osci import scripts
+
+
+class GerritWatcherThread(threading.Thread):
+    """Feed gerrit events straight into the scheduler's job queue
+
+    Jobs added here wake the scheduler in the same process, so there is
+    no polling delay between an event arriving and its job starting.
+    """
+    log = logging.getLogger('citrix.GerritWatcherThread')
+
+    # The event stream is an in-memory queue, so checking it often is cheap
+    EVENT_POLL = 1
+
+    def __init__(self, queue):
+        threading.Thread.__init__(self, name='GerritWatcherThread')
+        self.daemon = True
+        self.queue = queue
+
+    def get_env(self):
+        return dict(scripts.watch_gerrit_env(), queue=self.queue,
+                    sleep_timeout=self.EVENT_POLL)
+
+    def _continue(self):
+        return True
+
+    def run(self):
+        while self._continue():
+            try:
+                # Returns once the stream has been quiet for
+                # GERRIT_EVENT_TIMEOUT, so reconnect
+                commands.WatchGerrit(self.get_env())()
+            except Exception, e:
+                self.log.exception(e)
+                time.sleep(Configuration().get_int('POLL'))
+
+
+def get_parser():
+    usage = "usage: %prog [options]"
+
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      default=False, help='enable verbose (debug) logging')
+    return parser
+
+def main():
+    """Run osci-watch-gerrit and osci-manage as one process"""
+    parser = get_parser()
+    (options, _) = parser.parse_args()
+
+    manage.setup_logging(options.verbose)
+
+    queue = manage.create_queue()
+    GerritWatcherThread(queue).start()
+    manage.run_scheduler(queue)
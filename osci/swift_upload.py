@@ -1,10 +1,15 @@
+import hashlib
+import json
 import logging
 import optparse
 import os
 import sys
+import threading
 import time
+import zlib
 
 from osci.config import Configuration
+from osci import concurrency
 import pyrax.exceptions
 import pyrax
 
@@ -39,6 +44,31 @@ def get_content_type(filepath):
         return 'text/html'
     return None
 
+def is_compressible(filepath, size):
+    if not Configuration().get_bool('SWIFT_COMPRESS_LOGS'):
+        return False
+    if get_content_encoding(filepath) is not None:
+        return False
+    if get_content_type(filepath) != 'text/plain':
+        return False
+    return size >= Configuration().get_int('SWIFT_COMPRESS_THRESHOLD')
+
+def gzip_chunks(source, md5, level=6, chunk_size=64*1024):
+    """Yield the gzip compressed contents of source, updating md5 as we go"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(source, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            if data:
+                md5.update(data)
+                yield data
+    data = compressor.flush()
+    md5.update(data)
+    yield data
+
 def get_icon(filepath):
     content_type = get_content_type(filepath)
     type_to_icon = {
@@ -58,7 +88,7 @@ _START_STANSA = """
   <tr><th></th><th>Name</th><th>Last Modified</th><th>Size</th></tr>
 """
 _FILE_STANSA = """
-  <tr><td><img src="/apaxy/icons/%(icon)s"></td><td><a href="%(filename)s">%(filename)s</a></td><td>%(modified)s</td><td>%(size)s</td></tr>
+  <tr><td><img src="/apaxy/icons/%(icon)s"></td><td><a href="%(href)s">%(filename)s</a></td><td>%(modified)s</td><td>%(size)s</td></tr>
 """
 _DIR_STANSA = """
   <tr><td><img src="/apaxy/icons/folder.png"></td><td><a href="%(location)s/index.html">%(displayname)s</a></td><td>-</td><td>-</td></tr>
@@ -70,9 +100,10 @@ _END_STANSA = """  </table>
 def _html_start_stansa(prefix):
     return _START_STANSA % locals()
 
-def _html_file_stansa(filename, modified, size):
+def _html_file_stansa(filename, modified, size, href=None):
     icon = filename
     params = locals()
+    params["href"] = href or filename
     params["icon"] = get_icon(filename)
     return _FILE_STANSA % params
 
@@ -85,6 +116,95 @@ def _html_end_stansa():
 class UploadException(Exception):
     pass
 
+
+def content_addressed_name(digest):
+    return '%s/%s/%s'%(Configuration().SWIFT_DEDUP_PREFIX, digest[:2], digest)
+
+
+class DedupIndex(object):
+    """Local record of the content-addressed objects already in Swift
+
+    One "<container> <md5> <etag>" line per stored object.  The index is
+    trusted, so it must be removed if those objects are deleted.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.objects = {}
+        if os.path.exists(path):
+            with open(path, 'r') as index:
+                for line in index:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        self.objects[(fields[0], fields[1])] = fields[2]
+        elif not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    def get(self, container_name, digest):
+        with self.lock:
+            return self.objects.get((container_name, digest))
+
+    def add(self, container_name, digest, etag):
+        with self.lock:
+            if (container_name, digest) in self.objects:
+                return
+            self.objects[(container_name, digest)] = etag
+            with open(self.path, 'a') as index:
+                index.write('%s %s %s\n'%(container_name, digest, etag))
+
+
+class DirectoryIndex(object):
+    """Entries of one uploaded directory, rendered once the upload is done
+
+    Entries are recorded as the tree is walked; the index page and the
+    JSON manifest are each produced in a single pass over them.
+    """
+    def __init__(self, cf_path, parent=None):
+        self.cf_path = cf_path
+        self.parent = parent
+        self.entries = []
+
+    def add_directory(self, name):
+        self.entries.append({'type': 'directory', 'name': name})
+
+    def add_file(self, name, size, mtime, cf_name):
+        self.entries.append({'type': 'file', 'name': name, 'size': size,
+                             'mtime': mtime, 'cf_name': cf_name})
+
+    def _html_parts(self, stored):
+        yield _html_start_stansa(self.cf_path)
+        if self.parent is not None:
+            yield _html_dir_stansa(self.parent, 'Parent directory')
+        for entry in self.entries:
+            if entry['type'] == 'directory':
+                yield _html_dir_stansa(entry['name'], entry['name'])
+            else:
+                location, _ = stored.get(entry['cf_name'], (None, None))
+                href = None
+                if location and location != entry['cf_name']:
+                    href = '/' + location
+                yield _html_file_stansa(entry['name'],
+                                        time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(entry['mtime'])),
+                                        sizeof_fmt(entry['size']), href)
+        yield _html_end_stansa()
+
+    def html(self, stored=None):
+        return ''.join(self._html_parts(stored or {}))
+
+    def manifest(self, stored):
+        files = []
+        for entry in self.entries:
+            item = {'name': entry['name'], 'type': entry['type']}
+            if entry['type'] == 'file':
+                location, etag = stored.get(entry['cf_name'], (None, None))
+                item['size'] = entry['size']
+                item['mtime'] = entry['mtime']
+                item['etag'] = etag
+                if location and location != entry['cf_name']:
+                    item['object'] = location
+            files.append(item)
+        return json.dumps({'path': self.cf_path, 'files': files}, indent=1)
+
 def sizeof_fmt(num, suffix='B'):
     if abs(num) < 1024.0:
         return "%3d %s" % (num, suffix)
@@ -97,21 +217,53 @@ def sizeof_fmt(num, suffix='B'):
 class SwiftUploader(object):
     logger = logging.getLogger('citrix.swiftupload')
 
-    def upload_one_file(self, container, source, target, attempt=0):
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.dedup_index = None
+        # Several jobs may be collected, and so uploaded, at once
+        self.setup_lock = threading.Lock()
+
+    def _upload_compressed(self, container, source, target, content_type):
+        # The compressed size is not known up front, so stream it chunked
+        # and check the etag against what we actually sent
+        md5 = hashlib.md5()
+        level = Configuration().get_int('SWIFT_COMPRESS_LEVEL')
+        obj = container.create(obj_name=target,
+                               data=gzip_chunks(source, md5, level),
+                               chunked=True, content_encoding='gzip',
+                               content_type=content_type)
+        return obj, md5.hexdigest()
+
+    def upload_one_file(self, container, source, target, compress=False,
+                        chksum=None):
+        """Upload source to target; chksum, if the caller has already
+        computed the source's MD5, saves reading it again"""
         self.logger.info('Uploading %s to %s', source, target)
-        chksum = pyrax.utils.get_checksum(source)
         content_encoding=get_content_encoding(source)
         content_type=get_content_type(source)
+        if not compress and chksum is None:
+            chksum = pyrax.utils.get_checksum(source)
 
-        obj = container.upload_file(source, target,
-                                    content_encoding=content_encoding,
-                                    content_type=content_type, etag=chksum)
-        if chksum != obj.etag:
-            if attempt < Configuration().get_int('SWIFT_UPLOAD_ATTEMPTS'):
-                self.logger.error('Upload of %s to %s failed - retrying'%(source, target))
-                self.upload_one_file(container, source, target, attempt+1)
-            else:
-                raise UploadException('Failed to upload %s'%source)
+        attempts = Configuration().get_int('SWIFT_UPLOAD_ATTEMPTS')
+        backoff = Configuration().get_int('SWIFT_UPLOAD_BACKOFF')
+        for attempt in range(attempts + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                if compress:
+                    obj, chksum = self._upload_compressed(container, source,
+                                                          target, content_type)
+                else:
+                    obj = container.upload_file(source, target,
+                                                content_encoding=content_encoding,
+                                                content_type=content_type, etag=chksum)
+            except Exception, e:
+                self.logger.exception(e)
+                continue
+            if chksum == obj.etag:
+                return chksum
+            self.logger.error('Upload of %s to %s failed - retrying'%(source, target))
+        raise UploadException('Failed to upload %s'%source)
 
     def _order_files(self, filenames):
         filenames.sort()
@@ -119,64 +271,241 @@ class SwiftUploader(object):
             filenames.remove('run_tests.log')
             filenames.insert(0, 'run_tests.log')
 
-    def _upload(self, local_dir, filename, cf_prefix, container):
+    def _walk(self, local_dir, filename, cf_prefix, directory, uploads, indexes):
         full_path = os.path.join(local_dir, filename)
+        name = os.path.split(filename)[-1]
         if os.path.isdir(full_path):
-            index = _html_start_stansa(os.path.join(cf_prefix, filename))
-            index = index + _html_dir_stansa(os.path.join('/', cf_prefix, os.path.dirname(filename)), 'Parent directory')
+            subdirectory = DirectoryIndex(os.path.join(cf_prefix, filename),
+                                          os.path.join('/', cf_prefix, os.path.dirname(filename)))
             dir_listing = os.listdir(full_path)
             self._order_files(dir_listing)
             for subfile in dir_listing:
-                index = index + self._upload(local_dir,
-                                             os.path.join(filename, subfile),
-                                             cf_prefix, container)
-            index = index + _html_end_stansa()
-            container.store_object('%s/index.html'%(os.path.join(cf_prefix, filename)), index)
-            self.logger.info('Added index page at %s', os.path.join(cf_prefix, filename))
-            return _html_dir_stansa(os.path.split(filename)[-1], os.path.split(filename)[-1])
+                self._walk(local_dir, os.path.join(filename, subfile),
+                           cf_prefix, subdirectory, uploads, indexes)
+            indexes.append(subdirectory)
+            directory.add_directory(name)
         else:
             cf_name = os.path.join(cf_prefix, filename)
-            self.upload_one_file(container, full_path, cf_name)
             stats = os.stat(full_path)
-            return _html_file_stansa(os.path.split(filename)[-1],
-                                     time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(stats.st_mtime)),
-                                     sizeof_fmt(stats.st_size))
+            uploads.append((full_path, cf_name,
+                            is_compressible(full_path, stats.st_size),
+                            stats.st_size))
+            directory.add_file(name, stats.st_size, stats.st_mtime, cf_name)
 
-    def upload(self, local_files, cf_prefix, region=None, container_name=None):
-        pyrax.set_setting('identity_type', 'rackspace')
-        try:
-            if not region:
-                region = Configuration().SWIFT_REGION
-            pyrax.set_credentials(Configuration().SWIFT_USERNAME,
-                                  Configuration().SWIFT_API_KEY,
-                                  region=region)
-        except pyrax.exceptions.AuthenticationFailed, e:
-            self.logger.exception(e)
-            raise
-        cf = pyrax.cloudfiles
-
-        if not container_name:
-            container_name = Configuration().SWIFT_CONTAINER
-        container = cf.create_container(container_name)
-
-        contents = _html_start_stansa(cf_prefix)
+    def _store(self, container, source, target, compress, size):
+        """Upload source, returning the object name it is stored under and its etag"""
+        if (not Configuration().get_bool('SWIFT_DEDUP') or
+                size > Configuration().get_int('SWIFT_DEDUP_MAX_SIZE')):
+            return target, self.upload_one_file(container, source, target, compress)
+
+        digest = pyrax.utils.get_checksum(source)
+        location = content_addressed_name(digest)
+        etag = self.dedup_index.get(container.name, digest)
+        if etag is None:
+            etag = self.upload_one_file(container, source, location, compress,
+                                        chksum=digest)
+            self.dedup_index.add(container.name, digest, etag)
+        else:
+            self.logger.debug('%s already stored as %s', source, location)
+        return location, etag
+
+    def _upload_files(self, container, uploads):
+        workers = self.workers or Configuration().get_int('SWIFT_UPLOAD_WORKERS')
+        uploaded = concurrency.run_concurrently(
+            lambda (source, target, compress, size): self._store(
+                container, source, target, compress, size),
+            uploads, workers, name='swift-upload')
+        if len(uploaded) != len(uploads):
+            raise UploadException('Failed to upload %d of %d files'%(
+                len(uploads) - len(uploaded), len(uploads)))
+        return dict((upload[1], stored) for upload, stored in uploaded)
+
+    def _connect(self, region, container_name):
+        # pyrax keeps its credentials in module globals
+        with self.setup_lock:
+            pyrax.set_setting('identity_type', 'rackspace')
+            try:
+                if not region:
+                    region = Configuration().SWIFT_REGION
+                pyrax.set_credentials(Configuration().SWIFT_USERNAME,
+                                      Configuration().SWIFT_API_KEY,
+                                      region=region)
+            except pyrax.exceptions.AuthenticationFailed, e:
+                self.logger.exception(e)
+                raise
+            cf = pyrax.cloudfiles
+
+            if not container_name:
+                container_name = Configuration().SWIFT_CONTAINER
+            container = cf.create_container(container_name)
+            if (Configuration().get_bool('SWIFT_DEDUP') and
+                    self.dedup_index is None):
+                self.dedup_index = DedupIndex(Configuration().SWIFT_DEDUP_INDEX)
+            return container
+
+    def _plan(self, local_files, cf_prefix):
+        # Walk the tree first, so the files can be uploaded concurrently
+        # and the index pages stored once everything they link to exists
+        uploads = []
+        indexes = []
+        top = DirectoryIndex(cf_prefix)
         self._order_files(local_files)
         for filename in local_files:
             if not os.path.exists(filename):
                 self.logger.warn('File %s does not exist', filename)
                 continue
             filename = filename.rstrip('/')
-            contents = contents + self._upload(os.path.dirname(filename), os.path.basename(filename), cf_prefix, container)
+            self._walk(os.path.dirname(filename), os.path.basename(filename),
+                       cf_prefix, top, uploads, indexes)
+        indexes.append(top)
+        return uploads, indexes
 
-        contents = contents + _html_end_stansa()
-        container.store_object('%s/index.html'%cf_prefix, contents)
-        self.logger.info('Added index page at %s', os.path.join(cf_prefix))
+    def _store_indexes(self, container, indexes, stored, cf_prefix):
+        for index in indexes:
+            container.store_object('%s/index.html'%index.cf_path, index.html(stored))
+            container.store_object('%s/manifest.json'%index.cf_path,
+                                   index.manifest(stored),
+                                   content_type='application/json')
+            self.logger.info('Added index page at %s', index.cf_path)
 
         uri = container.cdn_uri
         result_url = "%s/%s/index.html"%(uri, cf_prefix)
         self.logger.info('Result URL: %s', result_url)
         return result_url
 
+    def upload(self, local_files, cf_prefix, region=None, container_name=None):
+        container = self._connect(region, container_name)
+        uploads, indexes = self._plan(local_files, cf_prefix)
+        stored = self._upload_files(container, uploads)
+        return self._store_indexes(container, indexes, stored, cf_prefix)
+
+    def start_upload(self, local_files, cf_prefix, region=None,
+                     container_name=None):
+        """Begin an upload that files can be handed to while they are
+        still being downloaded; see PipelinedUpload"""
+        return PipelinedUpload(self, local_files, cf_prefix, region,
+                               container_name)
+
+
+class PipelinedUpload(object):
+    """An upload of local_files to cf_prefix, started before they all exist.
+
+    add_file() is called with each file as soon as it is complete locally,
+    and starts uploading it straight away.  finish() then walks the tree
+    as upload() would, uploads anything that was not handed over (or has
+    changed size or mtime since), stores the index pages and returns the
+    result URL.
+
+    Swift is only connected to once there is something to store, so an
+    upload that is abandoned before any file is handed over costs nothing.
+    """
+    logger = logging.getLogger('citrix.swiftupload')
+
+    def __init__(self, uploader, local_files, cf_prefix, region=None,
+                 container_name=None):
+        self.uploader = uploader
+        self.region = region
+        self.container_name = container_name
+        self.container = None
+        self.connect_lock = threading.Lock()
+        self.local_files = list(local_files)
+        self.roots = [filename.rstrip('/') for filename in local_files]
+        self.cf_prefix = cf_prefix
+        self.lock = threading.Lock()
+        # The (size, mtime) last handed over for each target, the upload
+        # waiting to follow the one in progress, and the version each
+        # target was last stored at
+        self.submitted = {}
+        self.queued = {}
+        self.uploading = set()
+        self.stored = {}
+        workers = (uploader.workers or
+                   Configuration().get_int('SWIFT_UPLOAD_WORKERS'))
+        self.pool = concurrency.TaskPool(self._store, workers,
+                                         name='swift-upload')
+
+    def _container(self):
+        with self.connect_lock:
+            if self.container is None:
+                self.container = self.uploader._connect(self.region,
+                                                        self.container_name)
+            return self.container
+
+    def _store(self, target):
+        # Uploads of the same target run one after another, so an older
+        # version can never overwrite a newer one
+        while True:
+            with self.lock:
+                if target not in self.queued:
+                    self.uploading.discard(target)
+                    return
+                upload, version = self.queued.pop(target)
+            source, target, compress, size = upload
+            try:
+                result = self.uploader._store(self._container(), source, target,
+                                              compress, size)
+            except Exception, e:
+                self.logger.exception(e)
+                continue
+            with self.lock:
+                self.stored[target] = (version, result)
+
+    def _cf_names(self, path):
+        for root in self.roots:
+            name = os.path.basename(root)
+            if path == root:
+                yield os.path.join(self.cf_prefix, name)
+            elif path.startswith(root + os.sep):
+                yield os.path.join(self.cf_prefix, name,
+                                   os.path.relpath(path, root))
+
+    def _submit(self, upload, mtime):
+        source, target, _, size = upload
+        version = (size, mtime)
+        with self.lock:
+            if self.submitted.get(target) == version:
+                return
+            self.submitted[target] = version
+            self.queued[target] = (upload, version)
+            if target in self.uploading:
+                return
+            self.uploading.add(target)
+        self.pool.submit(target)
+
+    def add_file(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError, e:
+            self.logger.warn('Not uploading %s early: %s', path, e)
+            return
+        for cf_name in self._cf_names(path):
+            self._submit((path, cf_name, is_compressible(path, stat.st_size),
+                          stat.st_size), stat.st_mtime)
+
+    def finish(self):
+        uploads, indexes = self.uploader._plan(self.local_files, self.cf_prefix)
+        for upload in uploads:
+            try:
+                mtime = os.stat(upload[0]).st_mtime
+            except OSError:
+                mtime = None
+            self._submit(upload, mtime)
+        self.pool.join()
+        # Only the upload of a file as it was last seen counts
+        stored = dict((target, result)
+                      for target, (version, result) in self.stored.items()
+                      if self.submitted.get(target) == version)
+        missing = [upload for upload in uploads if upload[1] not in stored]
+        if missing:
+            raise UploadException('Failed to upload %d of %d files'%(
+                len(missing), len(uploads)))
+        return self.uploader._store_indexes(self._container(), indexes, stored,
+                                            self.cf_prefix)
+
+    def abandon(self):
+        """Wait for the uploads already started, without storing indexes"""
+        self.pool.join()
+
 
 def main():
     parser = get_parser()
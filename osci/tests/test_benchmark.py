@@ -0,0 +1,17 @@
+import unittest
+
+from osci import benchmark
+from osci import db
+from osci.job import Job
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_queries_timed(self):
+        database = db.DB('sqlite://')
+        database.create_schema()
+        benchmark.populate(database, 200, batch=64)
+
+        self.assertEqual(200, len(Job.getAllWhere(database)))
+        timings = benchmark.time_queries(database, 1)
+        self.assertEqual([name for name, _ in benchmark.get_queries()],
+                         [name for name, _ in timings])
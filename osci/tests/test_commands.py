@@ -138,6 +138,14 @@ class TestWatchGerrit(unittest.TestCase):
         cmd = commands.WatchGerrit()
         self.assertEquals('Client', cmd.gerrit_client)
 
+    def test_shared_queue(self):
+        queue = mock.Mock()
+        cmd = commands.WatchGerrit(dict(event_target='queue', queue=queue,
+                                        dburl='someurl'))
+        self.assertEquals(queue, cmd.queue)
+        self.assertEquals(queue.db, cmd.database)
+        self.assertEquals(queue, cmd.event_target.queue)
+
     def test_event_target(self):
         cmd = commands.WatchGerrit(dict(event_target='fake'))
         self.assertEquals('FakeTarget', cmd.event_target.__class__.__name__)
@@ -0,0 +1,137 @@
+import threading
+import unittest
+
+from osci import concurrency
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def test_serial_results_in_order(self):
+        results = concurrency.run_concurrently(lambda x: x * 2, [1, 2, 3], 1)
+        self.assertEqual([(1, 2), (2, 4), (3, 6)], results)
+
+    def test_parallel_results_in_order(self):
+        results = concurrency.run_concurrently(lambda x: x * 2, range(20), 4)
+        self.assertEqual([(x, x * 2) for x in range(20)], results)
+
+    def test_calls_run_concurrently(self):
+        barrier = threading.Event()
+        seen = []
+        lock = threading.Lock()
+
+        def wait_for_others(item):
+            with lock:
+                seen.append(item)
+                if len(seen) == 3:
+                    barrier.set()
+            return barrier.wait(5)
+
+        results = concurrency.run_concurrently(wait_for_others, [1, 2, 3], 3)
+        self.assertEqual([(1, True), (2, True), (3, True)], results)
+
+    def test_exceptions_are_left_out(self):
+        def fail_on_two(item):
+            if item == 2:
+                raise Exception('failed')
+            return item
+
+        for workers in [1, 3]:
+            results = concurrency.run_concurrently(fail_on_two, [1, 2, 3], workers)
+            self.assertEqual([(1, 1), (3, 3)], results)
+
+    def test_hung_call_is_abandoned(self):
+        release = threading.Event()
+
+        def hang_on_one(item):
+            if item == 1:
+                release.wait(10)
+            return item
+
+        results = concurrency.run_concurrently(hang_on_one, [1, 2, 3], 2,
+                                               timeout=1)
+        release.set()
+        self.assertEqual([(2, 2), (3, 3)], results)
+
+    def test_finalizer_called_per_thread(self):
+        finalized = []
+        concurrency.run_concurrently(lambda x: x, [1, 2, 3], 2,
+                                     finalizer=lambda: finalized.append(1))
+        self.assertEqual(2, len(finalized))
+
+    def test_single_hung_call_is_abandoned(self):
+        release = threading.Event()
+
+        for workers, items in [(1, [1, 2]), (4, [1])]:
+            results = concurrency.run_concurrently(
+                lambda item: release.wait(10) if item == 1 else item,
+                items, workers, timeout=1)
+            self.assertEqual([], results)
+        release.set()
+
+    def test_finalizer_called_for_single_item(self):
+        finalized = []
+        concurrency.run_concurrently(lambda x: x, [1], 4,
+                                     finalizer=lambda: finalized.append(1))
+        self.assertEqual(1, len(finalized))
+
+
+class TestTaskPool(unittest.TestCase):
+    def test_results_in_submission_order(self):
+        pool = concurrency.TaskPool(lambda x: x * 2, 4)
+        for x in range(20):
+            pool.submit(x)
+        self.assertEqual([(x, x * 2) for x in range(20)], pool.join())
+
+    def test_runs_while_items_are_submitted(self):
+        started = threading.Event()
+        pool = concurrency.TaskPool(lambda x: started.set(), 2)
+
+        pool.submit(1)
+
+        self.assertTrue(started.wait(5))
+        pool.join()
+
+    def test_exceptions_are_left_out(self):
+        def func(x):
+            if x == 2:
+                raise Exception('boom')
+            return x
+        pool = concurrency.TaskPool(func, 2)
+        for x in [1, 2, 3]:
+            pool.submit(x)
+        self.assertEqual([(1, 1), (3, 3)], pool.join())
+
+    def test_threads_bounded(self):
+        pool = concurrency.TaskPool(lambda x: x, 2)
+        for x in range(10):
+            pool.submit(x)
+        pool.join()
+        self.assertEqual(2, len(pool.threads))
+
+    def test_empty(self):
+        self.assertEqual([], concurrency.TaskPool(lambda x: x, 2).join())
+
+
+class TestCallInParallel(unittest.TestCase):
+    def test_results_in_order(self):
+        self.assertEqual([1, 2], concurrency.call_in_parallel(
+            [lambda: 1, lambda: 2]))
+
+    def test_calls_overlap(self):
+        started = threading.Event()
+        def first():
+            return started.wait(5)
+        def second():
+            started.set()
+            return True
+        self.assertEqual([True, True],
+                         concurrency.call_in_parallel([first, second]))
+
+    def test_exception_raised_after_all_finish(self):
+        finished = []
+        def fail():
+            raise ValueError('failed')
+        def succeed():
+            finished.append(True)
+        self.assertRaises(ValueError, concurrency.call_in_parallel,
+                          [succeed, fail])
+        self.assertEqual([True], finished)
@@ -1,3 +1,5 @@
+import mock
+import threading
 import unittest
 
 from osci import db
@@ -23,3 +25,80 @@ class TestDB(unittest.TestCase):
             self.assertEquals(
                 [("12",)], session.execute("SELECT * FROM A").fetchall())
 
+
+    def test_indexes_created(self):
+        database = db.DB("sqlite://")
+        database.create_schema()
+
+        indexes = [index['name'] for index in
+                   db.inspect(database.engine).get_indexes('test')]
+        self.assertIn('ix_test_state_updated', indexes)
+        self.assertIn('ix_test_project_change', indexes)
+
+    def test_indexes_added_to_existing_table(self):
+        database = db.DB("sqlite://")
+        database.create_schema()
+        with database.get_session() as session:
+            session.execute("DROP INDEX ix_test_state_updated")
+            session.execute("INSERT INTO test (state) VALUES (1)")
+
+        database.create_schema()
+
+        indexes = [index['name'] for index in
+                   db.inspect(database.engine).get_indexes('test')]
+        self.assertIn('ix_test_state_updated', indexes)
+        with database.get_session() as session:
+            self.assertEquals(
+                [(1,)], session.execute("SELECT state FROM test").fetchall())
+
+    def test_rollback_on_error(self):
+        database = db.DB("sqlite://")
+        with database.get_session() as session:
+            session.execute("CREATE TABLE A (col VARCHAR)")
+
+        def fail():
+            with database.get_session() as session:
+                session.execute("INSERT INTO A VALUES (12)")
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+
+        with database.get_session() as session:
+            self.assertEquals([], session.execute("SELECT * FROM A").fetchall())
+        stats = database.session_stats()[threading.current_thread().name]
+        self.assertEquals(dict(sessions=3, commits=2, rollbacks=1, removals=0), stats)
+
+    def test_remove_session(self):
+        database = db.DB("sqlite://")
+        first = database.Session()
+        database.remove_session()
+        self.assertIsNot(first, database.Session())
+        self.assertEquals(
+            1, database.session_stats()[threading.current_thread().name]['removals'])
+
+    def test_stats_per_thread(self):
+        database = db.DB("sqlite://")
+        def use_session():
+            with database.get_session():
+                pass
+            database.remove_session()
+        thread = threading.Thread(target=use_session, name='worker')
+        thread.start()
+        thread.join()
+        with database.get_session():
+            pass
+
+        stats = database.session_stats()
+        self.assertEquals(1, stats['worker']['removals'])
+        self.assertEquals(0, stats[threading.current_thread().name]['removals'])
+
+    @mock.patch('osci.db.create_engine')
+    def test_pool_configured(self, mock_create_engine):
+        db.DB("mysql://root:@127.0.0.1/openstack_ci")
+        mock_create_engine.assert_called_once_with(
+            "mysql://root:@127.0.0.1/openstack_ci", pool_size=10,
+            max_overflow=10, pool_recycle=3600, pool_pre_ping=True)
+
+    @mock.patch('osci.db.create_engine')
+    def test_sqlite_not_pooled(self, mock_create_engine):
+        db.DB("sqlite://")
+        mock_create_engine.assert_called_once_with("sqlite://")
@@ -9,3 +9,18 @@ class TestExecutorFactory(unittest.TestCase):
         self.assertEquals('PrintExecutor', exc.__class__.__name__)
 
 
+
+
+class TestRealExecutor(unittest.TestCase):
+    def test_pipe_run_output(self):
+        lines = []
+        executor.RealExecutor().pipe_run(['printf', 'a\\nb\\n'], ['cat'],
+                                         on_output=lines.append)
+        self.assertEqual(['a\n', 'b\n'], lines)
+
+    def test_pipe_run_returns_both_return_codes(self):
+        self.assertEqual(
+            (3, 0), executor.RealExecutor().pipe_run(['sh', '-c', 'exit 3'],
+                                                     ['cat']))
+        self.assertEqual(
+            (0, 1), executor.RealExecutor().pipe_run(['true'], ['false']))
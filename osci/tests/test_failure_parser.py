@@ -0,0 +1,177 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from osci import failure_parser
+
+
+TESTR_LOG = """\
+tempest.api.compute.test_a.ServersTestJSON.test_one[id-1,smoke] ... ok
+tempest.api.compute.test_a.ServersTestJSON.test_two[id-2] ... FAIL
+setUpClass (tempest.api.volume.test_b.VolumesTestXML) ... FAIL
+tempest.api.compute.test_a.ServersTestJSON.test_three ... SKIPPED: no
+
+======================================================================
+FAIL: tempest.api.compute.test_a.ServersTestJSON.test_two[id-2]
+----------------------------------------------------------------------
+Traceback (most recent call last):
+  File "tempest/api/compute/test_a.py", line 10, in test_two
+    self.assertEqual(1, 2)
+MismatchError: 1 != 2
+
+======================================================================
+ERROR: setUpClass (tempest.api.volume.test_b.VolumesTestXML)
+----------------------------------------------------------------------
+Traceback (most recent call last):
+TimeoutException: Request timed out
+
+----------------------------------------------------------------------
+Ran 4 tests in 12.000s
+
+FAILED (failures=2)
+"""
+
+SUBUNIT_TRACE_LOG = """\
+{0} tempest.api.compute.test_a.ServersTestJSON.test_one [0.500000s] ... ok
+{1} tempest.api.compute.test_a.ServersTestJSON.test_two [12.250000s] ... FAILED
+
+==============================
+Failed 1 tests - output below:
+==============================
+
+tempest.api.compute.test_a.ServersTestJSON.test_two
+---------------------------------------------------
+
+Captured traceback:
+~~~~~~~~~~~~~~~~~~~
+    Traceback (most recent call last):
+    MismatchError: 1 != 2
+
+
+======
+Totals
+======
+"""
+
+
+def tsfilter(log):
+    # As devstack-gate's tsfilter writes run_tests.log on the node
+    return ''.join('2015-03-04 12:00:01.123 | %s' % line
+                   for line in log.splitlines(True))
+
+
+class TestParseLines(unittest.TestCase):
+    def test_testr_output(self):
+        failures = failure_parser.parse_lines(TESTR_LOG.splitlines(True))
+
+        self.assertEqual(
+            ['tempest.api.compute.test_a.ServersTestJSON.test_two[id-2]',
+             'setUpClass (tempest.api.volume.test_b.VolumesTestXML)'],
+            [failure.test_id for failure in failures])
+        self.assertEqual([None, None], [failure.duration for failure in failures])
+        self.assertEqual('Traceback (most recent call last):\n'
+                         '  File "tempest/api/compute/test_a.py", line 10, in test_two\n'
+                         '    self.assertEqual(1, 2)\n'
+                         'MismatchError: 1 != 2', failures[0].traceback)
+        self.assertEqual('Traceback (most recent call last):\n'
+                         'TimeoutException: Request timed out',
+                         failures[1].traceback)
+
+    def test_subunit_trace_output(self):
+        failures = failure_parser.parse_lines(SUBUNIT_TRACE_LOG.splitlines())
+
+        self.assertEqual(1, len(failures))
+        self.assertEqual('tempest.api.compute.test_a.ServersTestJSON.test_two',
+                         failures[0].test_id)
+        self.assertEqual(12.25, failures[0].duration)
+        self.assertIn('MismatchError: 1 != 2', failures[0].traceback)
+        self.assertNotIn('Totals', failures[0].traceback)
+
+    def test_timestamped_testr_output(self):
+        failures = failure_parser.parse_lines(
+            tsfilter(TESTR_LOG).splitlines(True))
+
+        self.assertEqual(
+            ['tempest.api.compute.test_a.ServersTestJSON.test_two[id-2]',
+             'setUpClass (tempest.api.volume.test_b.VolumesTestXML)'],
+            [failure.test_id for failure in failures])
+        self.assertEqual('Traceback (most recent call last):\n'
+                         'TimeoutException: Request timed out',
+                         failures[1].traceback)
+
+    def test_timestamped_subunit_trace_output(self):
+        failures = failure_parser.parse_lines(
+            tsfilter(SUBUNIT_TRACE_LOG).splitlines())
+
+        self.assertEqual(1, len(failures))
+        self.assertEqual('tempest.api.compute.test_a.ServersTestJSON.test_two',
+                         failures[0].test_id)
+        self.assertEqual(12.25, failures[0].duration)
+        self.assertEqual('Captured traceback:\n'
+                         '~~~~~~~~~~~~~~~~~~~\n'
+                         '    Traceback (most recent call last):\n'
+                         '    MismatchError: 1 != 2', failures[0].traceback)
+        self.assertEqual(
+            'tempest.api.compute.test_a.ServersTestJSON.test_two '
+            '[12.250000s] ... FAILED\n', failure_parser.summary(failures))
+
+    def test_summary_matches_result_lines(self):
+        failures = failure_parser.parse_lines(TESTR_LOG.splitlines())
+
+        self.assertEqual(
+            'tempest.api.compute.test_a.ServersTestJSON.test_two[id-2] ... FAIL\n'
+            'setUpClass (tempest.api.volume.test_b.VolumesTestXML) ... FAIL\n',
+            failure_parser.summary(failures))
+
+    def test_summary_round_trips(self):
+        failures = failure_parser.parse_lines(TESTR_LOG.splitlines())
+        summary = failure_parser.summary(failures)
+
+        reparsed = failure_parser.parse_lines(summary.splitlines())
+
+        self.assertEqual([f.test_id for f in failures],
+                         [f.test_id for f in reparsed])
+
+    def test_traceback_truncated(self):
+        lines = ['tempest.a ... FAIL', '=' * 70, 'FAIL: tempest.a', '-' * 70]
+        lines += ['x' * 99] * 1000
+
+        failures = failure_parser.parse_lines(lines)
+
+        traceback = failures[0].traceback
+        self.assertTrue(traceback.endswith('... (truncated)'))
+        self.assertTrue(len(traceback) < failure_parser.MAX_TRACEBACK + 100)
+
+    def test_no_failures(self):
+        self.assertEqual([], failure_parser.parse_lines(['tempest.a ... ok']))
+
+
+class TestParseLogs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_run_tests_log(self):
+        with open(os.path.join(self.tmpdir, 'run_tests.log'), 'w') as f:
+            f.write(tsfilter(TESTR_LOG))
+
+        failures = failure_parser.parse_logs(self.tmpdir)
+
+        self.assertEqual(2, len(failures))
+
+    def test_missing_log(self):
+        self.assertEqual([], failure_parser.parse_logs(self.tmpdir))
+
+    def test_unusable_subunit_falls_back(self):
+        with open(os.path.join(self.tmpdir, 'run_tests.log'), 'w') as f:
+            f.write(TESTR_LOG)
+        stream = gzip.open(os.path.join(self.tmpdir,
+                                        'testrepository.subunit.gz'), 'wb')
+        stream.write('not subunit')
+        stream.close()
+
+        failures = failure_parser.parse_logs(self.tmpdir)
+
+        self.assertEqual(2, len(failures))
@@ -5,11 +5,13 @@ import datetime
 
 from osci import constants
 from osci import utils
-from osci.job import Job
+from osci.job import Job, ArchivedJob, FailedTest
+from osci import job as job_module
 from osci.config import Configuration
 from osci.db import DB
 from osci import time_services
 from osci import instructions
+from osci import failure_parser
 
 
 PAST = datetime.datetime(1980, 1, 1, 1, 2, 3)
@@ -107,6 +109,43 @@ class TestDBMethods(unittest.TestCase):
         recent_jobs = Job.getRecent(db, 200000)
         self.assertEqual(len(recent_jobs), 2)
 
+    @mock.patch('osci.time_services.now')
+    def test_update_many(self, now):
+        now.return_value = NOW
+        db = DB('sqlite://')
+        db.create_schema()
+        job1 = Job(change_num="change_num1", project_name="project")
+        job2 = Job(change_num="change_num2", project_name="project")
+        with db.get_session() as session:
+            session.add(job1)
+            session.add(job2)
+            job1.state = constants.RUNNING
+
+        Job.updateMany(db, [(job1, dict(state=constants.COLLECTING)),
+                            (job2, dict(result='result'))])
+
+        with db.get_session() as session:
+            job1, job2 = sorted(session.query(Job).all(), key=lambda x: x.id)
+        self.assertEqual(constants.COLLECTING, job1.state)
+        self.assertEqual(NOW, job1.test_stopped)
+        self.assertEqual(NOW, job1.updated)
+        self.assertEqual(constants.QUEUED, job2.state)
+        self.assertEqual('result', job2.result)
+        self.assertEqual(NOW, job2.updated)
+
+    def test_update_many_detached(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        job = Job(change_num="change_num", project_name="project")
+        with db.get_session() as session:
+            session.add(job)
+        db.remove_session()
+
+        Job.updateMany(db, [(job, dict(result='result'))])
+
+        job, = Job.getAllWhere(db)
+        self.assertEqual('result', job.result)
+
     def test_delete(self):
         db = DB('sqlite://')
         db.create_schema()
@@ -124,6 +163,241 @@ class TestDBMethods(unittest.TestCase):
         jobs = Job.getAllWhere(db)
         self.assertEqual(len(jobs), 0)
 
+class TestBulkTransition(unittest.TestCase):
+    def setUp(self):
+        self.db = DB('sqlite://')
+        self.db.create_schema()
+
+    def _add_job(self, change_num, state):
+        job = Job(change_num=change_num, project_name="project")
+        job.state = state
+        job.updated = PAST
+        job.test_started = PAST
+        with self.db.get_session() as session:
+            session.add(job)
+        return job.id
+
+    def _jobs(self):
+        return dict((job.change_num, job) for job in Job.getAllWhere(self.db))
+
+    @mock.patch('osci.time_services.now')
+    def test_fields_set(self, now):
+        now.return_value = NOW
+        ids = [self._add_job('1', constants.FINISHED),
+               self._add_job('2', constants.FINISHED)]
+        self._add_job('3', constants.FINISHED)
+
+        self.assertEqual(2, Job.bulk_transition(self.db, ids, node_id=0, result='Passed'))
+
+        jobs = self._jobs()
+        self.assertEqual([0, 0, None], [jobs[n].node_id for n in '123'])
+        self.assertEqual(['Passed', 'Passed', None], [jobs[n].result for n in '123'])
+        self.assertEqual([NOW, NOW, PAST], [jobs[n].updated for n in '123'])
+
+    @mock.patch('osci.time_services.now')
+    def test_transition_where(self, now):
+        now.return_value = NOW
+        self._add_job('1', constants.RUNNING)
+        self._add_job('2', constants.QUEUED)
+        self._add_job('3', constants.FINISHED)
+
+        self.assertEqual(2, Job.bulk_transition_where(
+            self.db, Job.state != constants.FINISHED, state=constants.OBSOLETE))
+
+        jobs = self._jobs()
+        self.assertEqual([constants.OBSOLETE, constants.OBSOLETE, constants.FINISHED],
+                         [jobs[n].state for n in '123'])
+        self.assertEqual(NOW, jobs['1'].test_stopped)
+
+    @mock.patch('osci.time_services.now')
+    def test_stopping_running_jobs(self, now):
+        now.return_value = NOW
+        ids = [self._add_job('1', constants.RUNNING),
+               self._add_job('2', constants.QUEUED)]
+
+        Job.bulk_transition(self.db, ids, state=constants.OBSOLETE)
+
+        jobs = self._jobs()
+        self.assertEqual(constants.OBSOLETE, jobs['1'].state)
+        self.assertEqual(NOW, jobs['1'].test_stopped)
+        self.assertEqual(None, jobs['2'].test_stopped)
+
+    @mock.patch('osci.time_services.now')
+    def test_starting_jobs(self, now):
+        now.return_value = NOW
+        ids = [self._add_job('1', constants.QUEUED)]
+
+        Job.bulk_transition(self.db, ids, state=constants.RUNNING)
+
+        job, = Job.getAllWhere(self.db)
+        self.assertEqual(NOW, job.test_started)
+        self.assertEqual(None, job.test_stopped)
+
+    def test_no_ids(self):
+        self.assertEqual(0, Job.bulk_transition(self.db, [], node_id=0))
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.db = DB('sqlite://')
+        self.db.create_schema()
+
+    def _add_job(self, change_num, state, days_old, node_id=0):
+        job = Job(change_num=change_num, project_name="project")
+        job.state = state
+        job.node_id = node_id
+        job.updated = NOW - datetime.timedelta(days=days_old)
+        job.result = 'Passed'
+        with self.db.get_session() as session:
+            session.add(job)
+        return job.id
+
+    @mock.patch('osci.time_services.now')
+    def test_archive_moves_old_completed_jobs(self, now):
+        now.return_value = NOW
+        old_finished = self._add_job('1', constants.FINISHED, 40)
+        old_obsolete = self._add_job('2', constants.OBSOLETE, 40)
+        self._add_job('3', constants.FINISHED, 10)
+        self._add_job('4', constants.FINISHED, 40, node_id=12)
+        self._add_job('5', constants.QUEUED, 40)
+
+        self.assertEqual(2, Job.archive(self.db, 30, batch=1))
+
+        live = Job.getAllWhere(self.db)
+        self.assertEqual(['3', '4', '5'], sorted(j.change_num for j in live))
+        with self.db.get_session() as session:
+            archived = session.query(ArchivedJob).order_by(ArchivedJob.id).all()
+            self.assertEqual([old_finished, old_obsolete], [j.id for j in archived])
+            self.assertEqual('Passed', archived[0].result)
+            self.assertEqual(NOW - datetime.timedelta(days=40), archived[0].updated)
+
+        self.assertEqual(0, Job.archive(self.db, 30))
+
+    @mock.patch('osci.time_services.now')
+    def test_queries_include_archive(self, now):
+        now.return_value = NOW
+        self._add_job('1', constants.FINISHED, 40)
+        self._add_job('2', constants.FINISHED, 1)
+        Job.archive(self.db, 30)
+
+        self.assertEqual(['2'], [j.change_num for j in Job.getAllWhere(self.db)])
+        self.assertEqual(['1', '2'], [j.change_num for j in Job.getAllWhere(
+            self.db, include_archive=True)])
+        self.assertEqual(['1', '2'], [j.change_num for j in Job.getRecent(
+            self.db, 24*50, include_archive=True)])
+        self.assertEqual(['1'], [j.change_num for j in Job.getAllWhere(
+            self.db, include_archive=True, change_num='1')])
+
+    @mock.patch('osci.time_services.now')
+    def test_delete_with_archive(self, now):
+        now.return_value = NOW
+        self._add_job('1', constants.FINISHED, 40)
+        self._add_job('2', constants.FINISHED, 1)
+        Job.archive(self.db, 30)
+
+        Job.deleteWhere(self.db, include_archive=True)
+
+        self.assertEqual([], Job.getAllWhere(self.db, include_archive=True))
+
+    @mock.patch('osci.time_services.now')
+    def test_repr(self, now):
+        now.return_value = NOW
+        job_id = self._add_job('1', constants.FINISHED, 40)
+        job, = Job.getAllWhere(self.db)
+        self.assertEqual('%d (project/1) %d' % (job_id, constants.FINISHED),
+                         repr(job))
+
+        Job.archive(self.db, 30)
+
+        archived, = Job.getAllWhere(self.db, include_archive=True)
+        self.assertEqual('%d (project/1) %d' % (job_id, constants.FINISHED),
+                         repr(archived))
+
+class TestFailedTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DB('sqlite://')
+        self.db.create_schema()
+
+    def _names(self, job_id=None):
+        with self.db.get_session() as session:
+            query = session.query(FailedTest.test_name)
+            if job_id is not None:
+                query = query.filter(FailedTest.job_id == job_id)
+            return sorted(name for name, in query.all())
+
+    def test_names_normalized(self):
+        failed = ('FAIL: tempest.api.compute.test_servers.ServersTestJSON.test_a\n'
+                  'FAIL: tempest.api.volume.test_volumes.VolumesTestXML.test_b '
+                  '(tempest.api.volume.test_volumes)')
+        self.assertEqual(['tempest.api.compute.test_servers.ServersTest.test_a',
+                          'tempest.api.volume.test_volumes.VolumesTest.test_b',
+                          'tempest.api.volume.test_volumes'],
+                         job_module.failed_test_names(failed))
+        self.assertEqual([], job_module.failed_test_names(None))
+
+    def _failures(self, *test_ids):
+        return [failure_parser.Failure(test_id) for test_id in test_ids]
+
+    def test_record_replaces(self):
+        FailedTest.record(self.db, 1, self._failures('tempest.a', 'tempest.b'))
+        FailedTest.record(self.db, 2, self._failures('tempest.a'))
+        FailedTest.record(self.db, 1, self._failures('tempest.c'))
+
+        self.assertEqual(['tempest.c'], self._names(1))
+        self.assertEqual(['tempest.a'], self._names(2))
+
+    def test_record_details(self):
+        failure = failure_parser.Failure('tempest.aJSON.test_b[smoke]', 1.5)
+        failure.traceback = 'Traceback'
+        FailedTest.record(self.db, 1, [failure, failure_parser.Failure('unit.c')])
+
+        with self.db.get_session() as session:
+            rows = session.query(FailedTest).all()
+            self.assertEqual([('tempest.a.test_b[smoke]', 1.5, 'Traceback')],
+                             [(row.test_name, row.duration, row.traceback)
+                              for row in rows])
+
+    def test_backfill_skips_recorded_jobs(self):
+        with self.db.get_session() as session:
+            for change_num, failed in [('1', 'tempest.a ... FAIL\n'),
+                                       ('2', 'tempest.b ... FAIL\n'),
+                                       ('3', None)]:
+                job = Job(change_num=change_num, project_name='project')
+                job.failed = failed
+                session.add(job)
+        FailedTest.record(self.db, 2, self._failures('tempest.b'))
+
+        self.assertEqual(1, FailedTest.backfill(self.db))
+        self.assertEqual(['tempest.a', 'tempest.b'], self._names())
+
+    def test_backfill_ignores_jobs_without_tempest_failures(self):
+        with self.db.get_session() as session:
+            for change_num, failed in [('1', 'tempest.a ... FAIL\n'),
+                                       ('2', ''),
+                                       ('3', 'unit.b ... FAIL\n'),
+                                       ('4', 'tempest.c passed\n')]:
+                job = Job(change_num=change_num, project_name='project')
+                job.failed = failed
+                session.add(job)
+
+        with mock.patch.object(FailedTest, 'record',
+                               wraps=FailedTest.record) as mock_record:
+            self.assertEqual(1, FailedTest.backfill(self.db))
+            self.assertEqual(0, FailedTest.backfill(self.db))
+        self.assertEqual(1, mock_record.call_count)
+        self.assertEqual(['tempest.a'], self._names())
+
+    def test_delete_removes_failed_tests(self):
+        with self.db.get_session() as session:
+            job = Job(change_num='1', project_name='project')
+            session.add(job)
+        FailedTest.record(self.db, job.id, self._failures('tempest.a'))
+
+        Job.deleteWhere(self.db)
+
+        self.assertEqual([], self._names())
+
+
 class TestRun(unittest.TestCase):
     @mock.patch.object(Job, 'update')
     @mock.patch.object(utils, 'getSSHObject')
@@ -174,6 +448,49 @@ class TestRun(unittest.TestCase):
         update_call2 = mock.call("DB", state=constants.RUNNING)
         mock_update.assert_has_calls([update_call1, update_call2])
 
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'testSSH')
+    @mock.patch.object(utils, 'execute_command')
+    def test_runTest_single_connection(self, mock_execute_command,
+                                       mock_testSSH, mock_update):
+        job = Job(change_num="change_num", change_ref='change_ref',
+                  project_name="project")
+
+        nodepool = mock.Mock()
+        nodepool.getNode.return_value = ('new_node', 'ip')
+        mock_testSSH.return_value = True
+        mock_execute_command.return_value = True
+
+        job.runJob("DB", nodepool)
+
+        self.assertEqual(1, mock_execute_command.call_count)
+        args, kwargs = mock_execute_command.call_args
+        self.assertIn('jenkins@ip$cat > run_tests_env', args[0])
+        self.assertIn('kill -0 $!', args[0])
+        script = kwargs['stdin_data']
+        self.assertTrue(script.startswith('#!/bin/bash\n'))
+        self.assertIn('ZUUL_REF=change_ref', script)
+        self.assertIn('/home/jenkins/xenapi-os-testing/run_tests.sh\n', script)
+
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'testSSH')
+    @mock.patch.object(utils, 'execute_command')
+    def test_runTest_start_not_confirmed(self, mock_execute_command,
+                                         mock_testSSH, mock_update):
+        job = Job(change_num="change_num", project_name="project")
+
+        nodepool = mock.Mock()
+        nodepool.getNode.return_value = ('new_node', 'ip')
+        mock_testSSH.return_value = True
+        mock_execute_command.return_value = False
+
+        job.runJob("DB", nodepool)
+
+        nodepool.deleteNode.assert_called_once_with('new_node')
+        mock_update.assert_called_with("DB", node_id=0)
+        self.assertNotIn(mock.call("DB", state=constants.RUNNING),
+                         mock_update.mock_calls)
+
     @mock.patch.object(time, 'sleep')
     @mock.patch.object(Job, 'update')
     @mock.patch.object(utils, 'execute_command')
@@ -234,14 +551,27 @@ class TestRunning(unittest.TestCase):
         delta = datetime.timedelta(seconds=350)
         job.updated = datetime.datetime.now() - delta
 
-        mock_execute_command.return_value = False
+        mock_execute_command.return_value = (1, '', '')
         self.assertFalse(job.isRunning("DB"))
         self.assertEqual(0, mock_update.call_count)
 
-        mock_execute_command.return_value = True
+        mock_execute_command.return_value = (0, '', '')
         self.assertTrue(job.isRunning("DB"))
         self.assertEqual(0, mock_update.call_count)
 
+    @mock.patch.object(utils, 'execute_command')
+    def test_probe_killed_after_timeout(self, mock_execute_command):
+        job = Job(change_num="change_num", project_name="project")
+        job.node_ip = 'ip'
+        mock_execute_command.return_value = (job_module.PROBE_TIMED_OUT, '', '')
+
+        self.assertEqual((True, None), job.probeRunning())
+
+        command = mock_execute_command.call_args[0][0].split(' ')
+        self.assertEqual(['timeout', Configuration().PROBE_TIMEOUT],
+                         command[:2])
+        self.assertEqual('ssh', command[2])
+
 
 class TestRetrieveResults(unittest.TestCase):
     def setUp(self):
@@ -279,10 +609,38 @@ class TestRetrieveResults(unittest.TestCase):
             'ssh -q -o BatchMode=yes'
             ' -o UserKnownHostsFile=/dev/null'
             ' -o StrictHostKeyChecking=no'
+            ' -o ControlMaster=auto'
+            ' -o ControlPath=/tmp/osci-ssh-%r@%h:%p'
+            ' -o ControlPersist=300'
+            ' -o ServerAliveInterval=15'
+            ' -E /dev/null'
             ' -i .ssh/jenkins'
             ' jenkins@ip cat result.txt',
             silent=True, return_streams=True)
 
+    @mock.patch('osci.job.utils')
+    def test_downloaded_logs_handed_over(self, fake_utils):
+        self.job.node_ip = 'ip'
+        fake_utils.execute_command.return_value = (0, 'Passed\n', '')
+        on_file = mock.Mock()
+
+        self.job.retrieveResults('ignored', on_file=on_file)
+
+        self.assertEqual(
+            on_file,
+            fake_utils.copy_logs_as_archive.call_args[1]['on_file'])
+
+    @mock.patch('osci.job.utils')
+    def test_logs_not_handed_over_without_result(self, fake_utils):
+        self.job.node_ip = 'ip'
+        fake_utils.execute_command.return_value = (0, '\n', '')
+
+        result = self.job.retrieveResults('ignored', on_file=mock.Mock())
+
+        self.assertEqual('', result)
+        self.assertEqual(
+            None, fake_utils.copy_logs_as_archive.call_args[1]['on_file'])
+
     @mock.patch('osci.job.utils')
     def test_dom0_logs_copied(self, fake_utils):
         self.job.node_ip = 'ip'
@@ -334,6 +692,31 @@ class TestRetrieveResults(unittest.TestCase):
 
         self.assertEquals(constants.NORESULT, result)
 
+    @mock.patch('osci.job.utils')
+    def test_node_log_copy_fails(self, fake_utils):
+        self.job.node_ip = 'ip'
+        fake_utils.execute_command.return_value = (
+            0, 'Reported status\nAnd some\nRubbish', 'err')
+
+        fake_utils.copy_logs_as_archive.side_effect = Exception()
+
+        result = self.run_retrieve_results()
+
+        self.assertEquals(constants.COPYFAIL, result)
+        self.assertEqual(1, fake_utils.copy_dom0_logs.call_count)
+
+    @mock.patch.object(utils, 'execute_command')
+    @mock.patch('osci.utils.Executor')
+    def test_node_log_producer_fails(self, executor_cls, execute_command):
+        self.job.node_ip = 'ip'
+        execute_command.return_value = (0, 'Passed\n', '')
+        # ssh exiting non-zero as the connection to the node drops
+        executor_cls.return_value.pipe_run.return_value = (255, 0)
+
+        result = self.run_retrieve_results()
+
+        self.assertEquals(constants.COPYFAIL, result)
+
     @mock.patch('osci.job.utils')
     def test_exception_raised(self, fake_utils):
         self.job.node_ip = 'ip'
@@ -343,3 +726,47 @@ class TestRetrieveResults(unittest.TestCase):
         result = self.run_retrieve_results()
 
         self.assertEquals(constants.COPYFAIL, result)
+
+
+class TestCopyNodeLogs(unittest.TestCase):
+    def setUp(self):
+        self.job = Job()
+        self.job.node_ip = 'ip'
+
+    @mock.patch('osci.job.utils')
+    def test_archive_collection(self, fake_utils):
+        self.job.copyNodeLogs('dest')
+
+        fake_utils.copy_logs_as_archive.assert_called_once_with(
+            job_module.NODE_LOGS, 'dest', 'ip', 'jenkins', '.ssh/jenkins',
+            compressor='gzip', level='6', on_file=None)
+        self.assertEqual(0, fake_utils.copy_logs.call_count)
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.job.utils')
+    def test_sftp_collection(self, fake_utils, mock_conf_file):
+        mock_conf_file.return_value = 'LOG_COLLECTION=sftp'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+
+        self.job.copyNodeLogs('dest')
+
+        fake_utils.copy_logs.assert_called_once_with(
+            job_module.NODE_LOGS, 'dest', 'ip', 'jenkins', '.ssh/jenkins',
+            upload=False, on_file=None)
+        self.assertEqual(0, fake_utils.copy_logs_as_archive.call_count)
+
+
+class TestConnections(unittest.TestCase):
+    @mock.patch.object(utils, 'close_node_connections')
+    def test_close_connections(self, mock_close):
+        job = Job()
+        job.node_ip = 'ip'
+        job.closeConnections()
+        mock_close.assert_called_once_with('ip', 'jenkins', '.ssh/jenkins')
+
+    @mock.patch.object(utils, 'close_node_connections')
+    def test_close_connections_no_ip(self, mock_close):
+        job = Job()
+        job.closeConnections()
+        self.assertEqual(0, mock_close.call_count)
@@ -62,6 +62,12 @@ class TestInit(unittest.TestCase, QueueHelpers):
         test, = job.Job.getAllWhere(q.db)
         self.assertTrue(test.queued)
 
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_add_test_wakes_scheduler(self, mock_notify):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit')
+        mock_notify.assert_called_once_with()
+
     def test_add_test_if_job_already_exists(self):
         q = self._make_queue()
         q.addJob('refs/changes/61/65261/7', 'project', 'commit')
@@ -317,43 +323,376 @@ class TestInit(unittest.TestCase, QueueHelpers):
         mock_sleep.assert_called_with(60)
 
 
+class TestReleaseNodes(unittest.TestCase, QueueHelpers):
+    def test_one_update_for_all_jobs(self):
+        q = self._make_queue()
+        for i in range(20):
+            q.addJob('refs/changes/61/6526%d/7' % i, 'project', 'commit')
+        with q.db.get_session() as session:
+            for i, j in enumerate(session.query(job.Job).all()):
+                j.state = constants.FINISHED
+                j.node_id = i + 1
+                j.result = 'Passed'
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(q.db.engine, 'before_cursor_execute', record)
+        self.addCleanup(db.event.remove, q.db.engine, 'before_cursor_execute', record)
+
+        job_queue.DeleteNodeThread(q).update_finished_jobs()
+
+        self.assertEqual(1, len([s for s in statements if s.startswith('UPDATE')]))
+        self.assertEqual([0] * 20, [j.node_id for j in job.Job.getAllWhere(q.db)])
+
+    @mock.patch.object(config.Configuration, '_conf_file_contents')
+    def test_keep_failed_selected_in_one_query(self, mock_conf_file):
+        mock_conf_file.return_value = 'KEEP_FAILED=3'
+        config.Configuration().reread()
+        self.addCleanup(config.Configuration().reread)
+        q = self._make_queue()
+        for i in range(20):
+            q.addJob('refs/changes/61/6526%d/7' % i, 'project', 'commit')
+        with q.db.get_session() as session:
+            for i, j in enumerate(session.query(job.Job).all()):
+                j.state = constants.FINISHED
+                j.node_id = i + 1
+                j.result = 'Failed'
+                j.updated = time_services.now() - datetime.timedelta(minutes=i)
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(q.db.engine, 'before_cursor_execute', record)
+        self.addCleanup(db.event.remove, q.db.engine, 'before_cursor_execute', record)
+
+        job_queue.DeleteNodeThread(q).update_finished_jobs()
+
+        self.assertEqual(['SELECT', 'UPDATE'],
+                         [s.split()[0] for s in statements])
+        self.assertEqual([1, 2, 3] + [0] * 17, [j.node_id for j in sorted(
+            job.Job.getAllWhere(q.db), key=lambda j: j.id)])
+
+    @mock.patch.object(config.Configuration, '_conf_file_contents')
+    def test_failure_after_select_not_released(self, mock_conf_file):
+        mock_conf_file.return_value = 'KEEP_FAILED=1'
+        config.Configuration().reread()
+        self.addCleanup(config.Configuration().reread)
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+        with q.db.get_session() as session:
+            old, new = sorted(session.query(job.Job).all(), key=lambda j: j.id)
+            old.state = constants.FINISHED
+            old.node_id = 1
+            old.result = 'Failed'
+            old.updated = time_services.now() - datetime.timedelta(minutes=1)
+            new.state = constants.RUNNING
+            new.node_id = 2
+        new_id = new.id
+
+        bulk_transition_where = job.Job.bulk_transition_where
+        def fail_new_job(database, criterion, **fields):
+            # The new job fails between the SELECT and the UPDATE
+            bulk_transition_where(q.db, job.Job.id == new_id,
+                                  state=constants.COLLECTED, result='Failed')
+            return bulk_transition_where(database, criterion, **fields)
+        with mock.patch.object(job.Job, 'bulk_transition_where',
+                               side_effect=fail_new_job):
+            job_queue.DeleteNodeThread(q).update_finished_jobs()
+
+        self.assertEqual([1, 2], [j.node_id for j in sorted(
+            job.Job.getAllWhere(q.db), key=lambda j: j.id)])
+
+
+class TestArchive(unittest.TestCase, QueueHelpers):
+    @mock.patch.object(job.Job, 'archive')
+    @mock.patch.object(config.Configuration, '_conf_file_contents')
+    def test_archive_days_configured(self, mock_conf_file, mock_archive):
+        self.addCleanup(config.Configuration().reread)
+        q = self._make_queue()
+        dnt = job_queue.DeleteNodeThread(q)
+
+        mock_conf_file.return_value = "ARCHIVE_AFTER_DAYS=7"
+        config.Configuration().reread()
+        dnt.archive_old_jobs()
+        mock_archive.assert_called_once_with(q.db, 7)
+
+        mock_conf_file.return_value = "ARCHIVE_AFTER_DAYS=0"
+        config.Configuration().reread()
+        dnt.archive_old_jobs()
+        self.assertEqual(1, mock_archive.call_count)
+
+
+class TestTriggerJobs(unittest.TestCase, QueueHelpers):
+    @mock.patch.object(job_queue.JobQueue, 'triggerJob')
+    def test_trigger_jobs_dispatches_queued(self, mock_trigger_job):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+        ids = sorted(j.id for j in job.Job.getAllWhere(q.db))
+
+        q.triggerJobs()
+
+        self.assertEqual(ids, sorted(call[0][0] for call in
+                                     mock_trigger_job.call_args_list))
+        self.assertEqual(set(), q.dispatching)
+
+    @mock.patch.object(job_queue.JobQueue, 'triggerJob')
+    def test_trigger_jobs_skips_jobs_being_dispatched(self, mock_trigger_job):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+        j1, j2 = sorted(job.Job.getAllWhere(q.db), key=lambda x: x.id)
+        q.dispatching.add(j1.id)
+
+        q.triggerJobs()
+
+        mock_trigger_job.assert_called_once_with(j2.id)
+        self.assertEqual(set([j1.id]), q.dispatching)
+
+
+class TestCollectResults(unittest.TestCase, QueueHelpers):
+    def _add_collecting_jobs(self, q, count):
+        for i in range(count):
+            q.addJob('refs/changes/61/6526%d/7' % i, 'project', 'commit%d' % i)
+        jobs = sorted(job.Job.getAllWhere(q.db), key=lambda x: x.id)
+        job.Job.bulk_transition(q.db, [j.id for j in jobs],
+                                state=constants.COLLECTING)
+        return [j.id for j in jobs]
+
+    @mock.patch.object(job_queue.JobQueue, 'collectJob')
+    def test_collects_all_jobs(self, mock_collect_job):
+        q = self._make_queue()
+        ids = self._add_collecting_jobs(q, 3)
+
+        q.collectResults()
+
+        self.assertEqual(ids, sorted(call[0][0] for call in
+                                     mock_collect_job.call_args_list))
+        self.assertEqual(set(), q.collecting)
+
+    @mock.patch.object(job_queue.JobQueue, 'collectJob')
+    def test_skips_jobs_being_collected(self, mock_collect_job):
+        q = self._make_queue()
+        j1, j2 = self._add_collecting_jobs(q, 2)
+        q.collecting.add(j1)
+
+        q.collectResults()
+
+        mock_collect_job.assert_called_once_with(j2)
+        self.assertEqual(set([j1]), q.collecting)
+
+    @mock.patch.object(job_queue.JobQueue, 'collectJob')
+    def test_claim_released_on_failure(self, mock_collect_job):
+        q = self._make_queue()
+        self._add_collecting_jobs(q, 2)
+        mock_collect_job.side_effect = Exception('boom')
+
+        q.collectResults()
+
+        self.assertEqual(set(), q.collecting)
+
+    @mock.patch.object(job_queue.JobQueue, 'uploadResults')
+    def test_collect_job_skips_collected(self, mock_upload):
+        q = self._make_queue()
+        j1, j2 = self._add_collecting_jobs(q, 2)
+        job.Job.bulk_transition(q.db, [j1], state=constants.COLLECTED)
+
+        q.collectJob(j1)
+        q.collectJob(j2)
+
+        self.assertEqual([j2], [call[0][0].id for call in
+                                mock_upload.call_args_list])
+
+
+class TestProcessResults(unittest.TestCase, QueueHelpers):
+    def _add_running_jobs(self, q, count, age):
+        for i in range(count):
+            q.addJob('refs/changes/61/6526%d/7' % i, 'project', 'commit%d' % i)
+        with q.db.get_session() as session:
+            jobs = session.query(job.Job).all()
+            jobs.sort(key=lambda x: x.id)
+            for i, j in enumerate(jobs):
+                j.state = constants.RUNNING
+                j.node_ip = 'ip%d' % i
+                j.updated = time_services.now() - age
+        return [j.id for j in jobs]
+
+    @mock.patch.object(job.Job, 'probeRunning', autospec=True)
+    def test_finished_jobs_collected(self, mock_probe):
+        q = self._make_queue()
+        ids = self._add_running_jobs(q, 3, datetime.timedelta(minutes=10))
+        mock_probe.side_effect = lambda j: (j.node_ip != 'ip1', None)
+
+        q.processResults()
+
+        self.assertEqual(3, mock_probe.call_count)
+        states = dict((j.id, j.state) for j in job.Job.getAllWhere(q.db))
+        self.assertEqual(constants.RUNNING, states[ids[0]])
+        self.assertEqual(constants.COLLECTING, states[ids[1]])
+        self.assertEqual(constants.RUNNING, states[ids[2]])
+        self.assertTrue(q.collect_event.is_set())
+
+    @mock.patch.object(job.Job, 'probeRunning', autospec=True)
+    def test_collector_not_woken_while_running(self, mock_probe):
+        q = self._make_queue()
+        self._add_running_jobs(q, 2, datetime.timedelta(minutes=10))
+        mock_probe.return_value = (True, None)
+
+        q.processResults()
+
+        self.assertFalse(q.collect_event.is_set())
+
+    @mock.patch.object(job.Job, 'probeRunning', autospec=True)
+    def test_probe_failure_recorded(self, mock_probe):
+        q = self._make_queue()
+        self._add_running_jobs(q, 1, datetime.timedelta(minutes=10))
+        mock_probe.return_value = (False, 'Aborted: Exception checking for pid')
+
+        q.processResults()
+
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEqual(constants.COLLECTING, j.state)
+        self.assertEqual('Aborted: Exception checking for pid', j.result)
+
+    @mock.patch.object(job.Job, 'probeRunning', autospec=True)
+    def test_job_still_being_probed_skipped(self, mock_probe):
+        q = self._make_queue()
+        ids = self._add_running_jobs(q, 2, datetime.timedelta(minutes=10))
+        mock_probe.return_value = (True, None)
+        # A probe from an earlier cycle that has not returned yet
+        q.probing.add(ids[0])
+
+        q.processResults()
+
+        self.assertEqual([ids[1]], [j.id for (j,), _ in mock_probe.call_args_list])
+        self.assertEqual(set([ids[0]]), q.probing)
+
+    @mock.patch.object(job.Job, 'probeRunning', autospec=True)
+    def test_young_and_timed_out_jobs_not_probed(self, mock_probe):
+        q = self._make_queue()
+        self._add_running_jobs(q, 1, datetime.timedelta(minutes=1))
+        q.processResults()
+        self.assertEqual(0, mock_probe.call_count)
+
+        q = self._make_queue()
+        self._add_running_jobs(q, 1, datetime.timedelta(days=1))
+        q.processResults()
+        self.assertEqual(0, mock_probe.call_count)
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEqual(constants.COLLECTING, j.state)
+        self.assertEqual('Aborted: Timed out', j.result)
+
+
 class TestUploadResults(unittest.TestCase, QueueHelpers):
     def test_job_has_no_results(self):
         q = self._make_queue()
+        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
 
         t = mock.Mock(spec=job.Job)
+        t.change_ref = 'refs/changes/1/2/3'
         t.retrieveResults.return_value = False
 
         q.uploadResults(t)
 
         self.assertEquals({}, q.filesystem.contents)
+        upload = q.uploader.start_upload.return_value
+        self.assertEqual(0, upload.finish.call_count)
+        upload.abandon.assert_called_once_with()
 
-    def test_job_has_results(self):
-        q = self._make_queue()
-        q.executor = mock.Mock(spec=utils.execute_command)
-        q.executor.return_value = ("code", "fail_stdout", "fail_stderr")
-        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
-        q.nodepool.node_ids = [12]
-
+    def _make_job(self, result):
         t = job.Job()
         t.node_id = 12
         t.retrieveResults = mock.Mock()
-        t.retrieveResults.return_value = "jobresult"
+        t.retrieveResults.return_value = result
         t.change_num = 98
         t.change_ref = 'refs/changes/1/2/3'
         t.id = 33
+        return t
+
+    def _make_collecting_queue(self):
+        q = self._make_queue()
+        q.executor = mock.Mock(spec=utils.execute_command)
+        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
+        q.nodepool.node_ids = set([12])
+        return q
+
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_job_has_results(self, mock_notify):
+        q = self._make_collecting_queue()
+        t = self._make_job("jobresult")
 
         q.uploadResults(t)
 
         self.assertEquals(
             {}, q.filesystem.contents, msg="Filesystem not cleaned up")
         self.assertEquals(
-            [12], q.nodepool.node_ids, msg="Node must still exist")
+            set(), q.nodepool.node_ids, msg="Node must be released")
+        self.assertEquals(0, t.node_id)
         self.assertEquals(
             constants.COLLECTED, t.state, msg="Node must be collected")
-        q.uploader.upload.assert_called_once_with(
+        q.uploader.start_upload.assert_called_once_with(
             ["RANDOMPATH-98/logs/run_tests.log", "RANDOMPATH-98/logs"], "1/2/3/33"
         )
+        upload = q.uploader.start_upload.return_value
+        t.retrieveResults.assert_called_once_with(
+            "RANDOMPATH-98/logs", on_file=upload.add_file)
+        upload.finish.assert_called_once_with()
+        self.assertEqual(upload.finish.return_value, t.logs_url)
+        mock_notify.assert_called_once_with()
+        self.assertFalse(q.executor.called, msg="Failures parsed in-process")
+
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_failed_job_node_kept(self, mock_notify):
+        q = self._make_collecting_queue()
+        t = self._make_job("Failed")
+
+        q.uploadResults(t)
+
+        self.assertEquals(set([12]), q.nodepool.node_ids,
+                          msg="KEEP_FAILED may want this node")
+        self.assertEquals(12, t.node_id)
+        self.assertEquals(constants.COLLECTED, t.state)
+
+    @mock.patch.object(config.Configuration, '_conf_file_contents')
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_failed_job_node_released_without_keep_failed(self, mock_notify,
+                                                          mock_conf_file):
+        mock_conf_file.return_value = 'KEEP_FAILED=0'
+        config.Configuration().reread()
+        self.addCleanup(config.Configuration().reread)
+        q = self._make_collecting_queue()
+        t = self._make_job("Failed")
+
+        q.uploadResults(t)
+
+        self.assertEquals(set(), q.nodepool.node_ids)
+        self.assertEquals(0, t.node_id)
+
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_delete_failure_left_to_cleanup_thread(self, mock_notify):
+        q = self._make_collecting_queue()
+        q.nodepool.deleteNode = mock.Mock(side_effect=Exception('nodepool'))
+        t = self._make_job("Passed")
+
+        q.uploadResults(t)
+
+        self.assertEquals(constants.COLLECTED, t.state)
+        self.assertEquals(0, t.node_id, msg="Node is no longer in use")
+        q.nodepool.deleteNode.assert_called_once_with(12)
+
+    @mock.patch('osci.job_queue.wakeup.notify')
+    def test_upload_failure_keeps_node(self, mock_notify):
+        q = self._make_collecting_queue()
+        upload = q.uploader.start_upload.return_value
+        upload.finish.side_effect = swift_upload.UploadException('swift')
+        t = self._make_job("Passed")
+
+        self.assertRaises(swift_upload.UploadException, q.uploadResults, t)
+
+        self.assertEquals(set([12]), q.nodepool.node_ids)
+        self.assertEquals(12, t.node_id)
 
 
 class FakeQueue(object):
@@ -13,3 +13,23 @@ class TestLocalHost(unittest.TestCase):
         self.assertEquals(
             'tar -xzf - -C tgtdir'.split(),
             commands)
+
+    def test_extract_stdout_archive_to_dir(self):
+        host = localhost.Localhost()
+
+        self.assertEquals(
+            'tar -x -z -f - -C tgtdir'.split(),
+            host.commands_to_extract_stdout_archive_to('tgtdir'))
+        self.assertEquals(
+            'tar -x -I zstd -f - -C tgtdir'.split(),
+            host.commands_to_extract_stdout_archive_to('tgtdir', 'zstd'))
+        self.assertEquals(
+            'tar -x -f - -C tgtdir'.split(),
+            host.commands_to_extract_stdout_archive_to('tgtdir', 'none'))
+
+    def test_extract_stdout_archive_verbose(self):
+        host = localhost.Localhost()
+
+        self.assertEquals(
+            'tar -x -v -z -f - -C tgtdir'.split(),
+            host.commands_to_extract_stdout_archive_to('tgtdir', verbose=True))
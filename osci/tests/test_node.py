@@ -36,3 +36,25 @@ class TestNode(unittest.TestCase):
         """).strip().split()
         self.assertEquals(expected, cmds)
 
+
+    def test_get_files_as_archive(self):
+        n = node.Node()
+
+        cmds = n.command_to_get_files_as_archive_to_stdout('/a/* /b', 'zstd', 3)
+        expected = textwrap.dedent("""
+        ssh -q
+        -o BatchMode=yes
+        -o UserKnownHostsFile=/dev/null
+        -o StrictHostKeyChecking=no
+        NODE_USERNAME@NODE_HOST
+        find /a/* /b -maxdepth 0 -type f -print0 2>/dev/null |
+        tar --null -T - --ignore-failed-read '--transform=s,.*/,,' -cf - |
+        zstd -3 -q -c
+        """).strip().split()
+        self.assertEquals(expected, cmds)
+
+    def test_get_files_as_archive_default_gzip(self):
+        n = node.Node()
+
+        cmds = n.command_to_get_files_as_archive_to_stdout('/a/*')
+        self.assertEquals(['gzip', '-6', '-c'], cmds[-3:])
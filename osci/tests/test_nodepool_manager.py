@@ -67,7 +67,8 @@ class TestNodepoolManager(unittest.TestCase):
         self.assertEquals((1, 'ip_1'), self.npm.getNode())
         self.assertEquals(self.npm.nodes[0].state, self.npm.nodedb.HOLD)
 
-    def test_delete_calls_pool_delete(self):
+    @mock.patch.object(utils, 'close_node_connections')
+    def test_delete_calls_pool_delete(self, mock_close):
         self.npm = FakeNodePool('image')
         self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
         node = self.npm.nodes[0]
@@ -75,6 +76,18 @@ class TestNodepoolManager(unittest.TestCase):
         self.npm.pool._deleteNode.assert_called_with(self.npm.mock_session, node)
         self.assertEquals(0, len(self.npm.nodes))
 
+    @mock.patch.object(utils, 'close_node_connections')
+    def test_delete_closes_connections_first(self, mock_close):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+        mock_close.side_effect = lambda *args: self.assertEqual(
+            0, self.npm.pool._deleteNode.call_count)
+
+        self.npm.deleteNode(1)
+
+        mock_close.assert_called_once_with('ip_1', 'jenkins', '.ssh/jenkins')
+        self.assertEquals(0, len(self.npm.nodes))
+
     @mock.patch('osci.time_services.time')
     def test_held_state_age(self, mock_time):
         self.npm = FakeNodePool('image')
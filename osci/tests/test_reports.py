@@ -0,0 +1,246 @@
+import csv
+import datetime
+import json
+import mock
+import unittest
+
+from osci import constants
+from osci import db
+from osci import failure_parser
+from osci import reports
+from osci import time_services
+from osci.job import Job, FailedTest
+
+
+class TestStatementCount(unittest.TestCase):
+    def _make_queue(self, count):
+        database = db.DB('sqlite://')
+        database.create_schema()
+        with database.get_session() as session:
+            for i in range(count):
+                job = Job(change_num=str(i), change_ref='refs/changes/%d/1' % i,
+                          project_name='project')
+                job.state = constants.FINISHED
+                job.result = 'Failed' if i % 2 else 'Passed'
+                job.failed = 'tempest.api.test_%d' % (i % 3)
+                job.test_started = time_services.now() - datetime.timedelta(hours=1)
+                job.test_stopped = time_services.now()
+                session.add(job)
+                session.flush()
+                session.add(FailedTest(job.id, job.failed))
+        # Start from a clean session, as a new osci-view process would
+        database.remove_session()
+        return mock.Mock(db=database)
+
+    def _count_statements(self, func, queue, **options):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(queue.db.engine, 'before_cursor_execute', record)
+        self.addCleanup(db.event.remove, queue.db.engine,
+                        'before_cursor_execute', record)
+        func(mock.Mock(recent='24', states=None, archive=False, withfail=None,
+                       max_fails='10', min_dup='2', format='text', **options),
+             queue)
+        return len(statements)
+
+    def test_list_is_constant(self):
+        small = self._count_statements(reports.func_list, self._make_queue(10))
+        large = self._count_statements(reports.func_list, self._make_queue(1000))
+        self.assertEqual(small, large)
+
+    def test_failures_is_constant(self):
+        small = self._count_statements(reports.func_failures, self._make_queue(10))
+        large = self._count_statements(reports.func_failures, self._make_queue(1000))
+        self.assertEqual(small, large)
+
+
+class TestList(unittest.TestCase):
+    def setUp(self):
+        self.db = db.DB('sqlite://')
+        self.db.create_schema()
+
+    def _add_job(self, change_num, state, result):
+        with self.db.get_session() as session:
+            job = Job(change_num=change_num,
+                      change_ref='refs/changes/%s/1' % change_num,
+                      project_name='project')
+            job.state = state
+            job.result = result
+            session.add(job)
+
+    def _list(self, states=None):
+        return reports.func_list(
+            mock.Mock(recent='24', states=states, archive=False,
+                      format='text'),
+            mock.Mock(db=self.db)).splitlines()
+
+    def test_summary_counts_all_states(self):
+        self._add_job('1', constants.FINISHED, 'Passed')
+        self._add_job('2', constants.FINISHED, 'Failed')
+        self._add_job('3', constants.OBSOLETE, 'Passed')
+        self._add_job('4', constants.QUEUED, None)
+
+        lines = self._list()
+
+        self.assertEqual({'Finished': 2, 'Obsolete': 1, 'Queued': 1},
+                         eval(lines[0]))
+        self.assertEqual({'Passed': 2, 'Failed': 1, None: 1}, eval(lines[1]))
+        rows = '\n'.join(lines[2:])
+        self.assertIn('refs/changes/1/1', rows)
+        self.assertIn('refs/changes/4/1', rows)
+        self.assertNotIn('refs/changes/3/1', rows)
+
+    def test_states_filter(self):
+        self._add_job('1', constants.FINISHED, 'Passed')
+        self._add_job('2', constants.QUEUED, None)
+        self._add_job('3', constants.OBSOLETE, 'Passed')
+
+        rows = '\n'.join(self._list(states='Queued,Obsolete')[2:])
+
+        self.assertNotIn('refs/changes/1/1', rows)
+        self.assertIn('refs/changes/2/1', rows)
+        self.assertIn('refs/changes/3/1', rows)
+
+
+class TestFailures(unittest.TestCase):
+    def setUp(self):
+        self.db = db.DB('sqlite://')
+        self.db.create_schema()
+
+    def _add_job(self, failed, result='Failed'):
+        with self.db.get_session() as session:
+            job = Job(change_num='1', change_ref='refs/changes/1/1',
+                      project_name='project')
+            job.state = constants.FINISHED
+            job.result = result
+            job.failed = failed
+            session.add(job)
+        FailedTest.record(self.db, job.id, [failure_parser.Failure(test_id)
+                                            for test_id in failed.split()])
+        return job.id
+
+    def _failures(self, withfail=None, max_fails='2', min_dup='2'):
+        output = reports.func_failures(
+            mock.Mock(recent='24', archive=False, withfail=withfail,
+                      max_fails=max_fails, min_dup=min_dup, format='text'),
+            mock.Mock(db=self.db))
+        return output.split('-------------------\n')[1].splitlines()
+
+    def test_counts(self):
+        self._add_job('tempest.a tempest.b')
+        self._add_job('tempest.aJSON')
+        self._add_job('tempest.a tempest.b tempest.c')
+        self._add_job('')
+        self._add_job('')
+        self._add_job('tempest.d', result='Passed')
+        self._add_job('tempest.e', result='Aborted: timeout')
+
+        # tempest.b, tempest.e and the job with too many failures are rare
+        self.assertEqual(['  3 Fewer than 2 duplicates',
+                          '  2 No tempest failures detected',
+                          '  2 tempest.a'],
+                         sorted(self._failures(), key=lambda line: line[4:]))
+
+    def test_no_limits(self):
+        self._add_job('tempest.a tempest.b')
+        self._add_job('tempest.a tempest.b tempest.c')
+
+        self.assertEqual(['  1 tempest.c', '  2 tempest.a', '  2 tempest.b'],
+                         sorted(self._failures(max_fails='0', min_dup='0')))
+
+    def test_with_fail(self):
+        self._add_job('tempest.a tempest.b')
+        self._add_job('tempest.c')
+        self._add_job('')
+
+        self.assertEqual(['  1 tempest.a', '  1 tempest.b'], sorted(
+            self._failures(withfail='tempest.a', min_dup='0')))
+        self.assertEqual(['  1 No tempest failures detected'],
+                         self._failures(withfail='', min_dup='0'))
+
+
+class TestFormats(unittest.TestCase):
+    def setUp(self):
+        self.db = db.DB('sqlite://')
+        self.db.create_schema()
+        for change_num, state in [('1', constants.FINISHED),
+                                  ('2', constants.QUEUED)]:
+            with self.db.get_session() as session:
+                job = Job(change_num=change_num,
+                          change_ref='refs/changes/%s/1' % change_num,
+                          project_name='project')
+                job.state = state
+                job.result = 'Failed'
+                job.failed = 'tempest.a'
+                session.add(job)
+            FailedTest.record(self.db, job.id, [failure_parser.Failure('tempest.a')])
+
+    def _run(self, func, output_format, **options):
+        defaults = dict(recent='24', states='Finished,Queued', archive=False,
+                        withfail=None, max_fails='10', min_dup='0')
+        defaults.update(options)
+        output = func(mock.Mock(format=output_format, **defaults),
+                      mock.Mock(db=self.db))
+        self.assertFalse(isinstance(output, basestring),
+                         msg="Output must be streamed")
+        return ''.join(output)
+
+    def test_list_json(self):
+        jobs = json.loads(self._run(reports.func_list, 'json'))
+
+        self.assertEqual(['1', '2'], [job['change_num'] for job in jobs])
+        self.assertEqual('Finished', jobs[0]['state'])
+        self.assertEqual(sorted(reports.LIST_COLUMNS), sorted(jobs[0].keys()))
+
+    def test_list_ndjson(self):
+        lines = self._run(reports.func_list, 'ndjson',
+                          states='Queued').splitlines()
+
+        self.assertEqual(1, len(lines))
+        self.assertEqual('2', json.loads(lines[0])['change_num'])
+
+    def test_list_csv(self):
+        rows = list(csv.reader(self._run(reports.func_list, 'csv').splitlines()))
+
+        self.assertEqual(reports.LIST_COLUMNS, rows[0])
+        self.assertEqual(3, len(rows))
+
+    def test_show_json(self):
+        jobs = json.loads(self._run(reports.func_show, 'json',
+                                    change_ref='refs/changes/2/1'))
+
+        self.assertEqual(1, len(jobs))
+        self.assertEqual('tempest.a', jobs[0]['failed'])
+
+    def test_failures_ndjson(self):
+        lines = self._run(reports.func_failures, 'ndjson').splitlines()
+        rows = [json.loads(line) for line in lines]
+
+        self.assertEqual(['jobs', 'jobs', 'failures'],
+                         [row['section'] for row in rows])
+        self.assertEqual({'section': 'failures', 'test_name': 'tempest.a',
+                          'count': 2}, rows[-1])
+
+    def test_failures_json_includes_jobs(self):
+        report = json.loads(self._run(reports.func_failures, 'json'))
+
+        self.assertEqual(['1', '2'],
+                         sorted(job['change_num'] for job in report['jobs']))
+        self.assertEqual(sorted(reports.FAILED_JOB_COLUMNS),
+                         sorted(report['jobs'][0].keys()))
+        self.assertEqual([{'test_name': 'tempest.a', 'count': 2}],
+                         report['failures'])
+
+    def test_failures_csv_includes_jobs(self):
+        rows = list(csv.reader(
+            self._run(reports.func_failures, 'csv').splitlines()))
+
+        self.assertEqual(reports.FAILED_JOB_COLUMNS, rows[0])
+        self.assertEqual([], rows[3])
+        self.assertEqual([reports.FAILURE_COLUMNS, ['tempest.a', '2']],
+                         rows[4:])
+
+    def test_empty_json(self):
+        self.assertEqual([], json.loads(self._run(reports.func_list, 'json',
+                                                  states='Running')))
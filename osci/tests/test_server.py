@@ -29,6 +29,15 @@ class TestServer(unittest.TestCase):
             ).split(),
             srv.run(['cmd1', 'cmd2']))
 
+    def test_run_with_ssh_options(self):
+        srv = Server(dict(ssh_options=['-o', 'ControlMaster=auto']))
+        self.assertEquals(
+            (
+                'ssh {ssh_options} -o ControlMaster=auto USERNAME@HOST cmd1'.format(
+                    ssh_options=' '.join(common_ssh_options.COMMON_SSH_OPTS))
+            ).split(),
+            srv.run(['cmd1']))
+
     def test_scp(self):
         srv = Server()
         self.assertEquals(
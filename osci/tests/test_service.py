@@ -0,0 +1,44 @@
+import mock
+import unittest
+
+from osci import service
+
+
+class TestGerritWatcherThread(unittest.TestCase):
+    def test_env_shares_queue(self):
+        thread = service.GerritWatcherThread('queue')
+        env = thread.get_env()
+        self.assertEqual('queue', env['queue'])
+        self.assertEqual('queue', env['event_target'])
+        self.assertEqual(service.GerritWatcherThread.EVENT_POLL,
+                         env['sleep_timeout'])
+
+    @mock.patch('osci.service.time.sleep')
+    @mock.patch('osci.service.commands.WatchGerrit')
+    def test_reconnects(self, mock_watch, mock_sleep):
+        mock_watch.return_value.side_effect = [None, Exception('Lost stream'), None]
+        thread = service.GerritWatcherThread('queue')
+        thread.get_env = mock.Mock(return_value='env')
+        thread._continue = mock.Mock(side_effect=[True, True, True, False])
+
+        thread.run()
+
+        self.assertEqual([mock.call('env')] * 3, mock_watch.call_args_list)
+        self.assertEqual(3, mock_watch.return_value.call_count)
+        # Only wait before reconnecting after an error
+        self.assertEqual(1, mock_sleep.call_count)
+
+
+class TestMain(unittest.TestCase):
+    @mock.patch('osci.service.get_parser')
+    @mock.patch('osci.service.manage')
+    @mock.patch('osci.service.GerritWatcherThread')
+    def test_watcher_and_scheduler_share_queue(self, mock_thread, mock_manage, mock_parser):
+        mock_parser.return_value.parse_args.return_value = (mock.Mock(verbose=False), [])
+        mock_manage.create_queue.return_value = 'queue'
+
+        service.main()
+
+        mock_thread.assert_called_once_with('queue')
+        mock_thread.return_value.start.assert_called_once_with()
+        mock_manage.run_scheduler.assert_called_once_with('queue')
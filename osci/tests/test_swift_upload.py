@@ -1,5 +1,12 @@
 import datetime
+import gzip
+import hashlib
+import json
 import mock
+import shutil
+import StringIO
+import tempfile
+import threading
 import time
 import stat
 import unittest
@@ -62,6 +69,46 @@ class TestUtilities(unittest.TestCase):
         self.assertEqual('text/plain', swift_upload.get_content_type('var/log/messages'))
         self.assertEqual('text/plain', swift_upload.get_content_type('var/log/SMlog'))
 
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(Configuration().reread)
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_compressible(self, conf):
+        conf.return_value = 'SWIFT_COMPRESS_THRESHOLD=100'
+        Configuration().reread()
+        self.assertTrue(swift_upload.is_compressible('screen-n-cpu.txt', 100))
+        self.assertTrue(swift_upload.is_compressible('var/log/messages', 1000))
+        self.assertFalse(swift_upload.is_compressible('run_tests.log', 99))
+        self.assertFalse(swift_upload.is_compressible('messages.1.gz', 1000))
+        self.assertFalse(swift_upload.is_compressible('index.html', 1000))
+        self.assertFalse(swift_upload.is_compressible('image.vhd', 1000))
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_compression_disabled(self, conf):
+        conf.return_value = 'SWIFT_COMPRESS_LOGS=False'
+        Configuration().reread()
+        self.assertFalse(swift_upload.is_compressible('run_tests.log', 10**9))
+
+    def test_gzip_chunks(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        source = os.path.join(tmpdir, 'run_tests.log')
+        contents = ''.join('%d INFO nova.compute.manager Instance spawned\n' % i
+                           for i in range(100000))
+        with open(source, 'wb') as f:
+            f.write(contents)
+
+        md5 = hashlib.md5()
+        chunks = list(swift_upload.gzip_chunks(source, md5, chunk_size=4096))
+        compressed = ''.join(chunks)
+
+        self.assertTrue(len(compressed) < len(contents) / 5)
+        self.assertEqual(contents,
+                         gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read())
+        self.assertEqual(hashlib.md5(compressed).hexdigest(), md5.hexdigest())
+
+
 class TestSwiftUploader(unittest.TestCase):
     def setUp(self):
         self.mock_stat_file = mock.Mock()
@@ -81,10 +128,12 @@ class TestSwiftUploader(unittest.TestCase):
         self.assertRaises(AuthenticationFailed, swift_upload.SwiftUploader().upload, 'a', 'b')
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os')
+    @mock.patch('osci.swift_upload.os.listdir')
+    @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
-    def test_upload_no_files(self, mock_one_file, mock_os, mock_pyrax):
-        mock_os.listdir.return_value=[]
+    def test_upload_no_files(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_os_listdir.return_value=[]
+        mock_os_stat.return_value = self.mock_stat_dir
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
@@ -98,17 +147,18 @@ class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_ordered(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
         mock_os_listdir.return_value=['b', 'd', 'c', 'a']
         mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
-        result = swift_upload.SwiftUploader().upload(['localdir'], 'prefix')
+        result = swift_upload.SwiftUploader(workers=1).upload(['localdir'], 'prefix')
         self.assertEqual(result, 'uri/prefix/index.html')
-        expected_calls = [mock.call(mock_container, 'localdir/a', 'prefix/localdir/a')]
-        expected_calls.append(mock.call(mock_container, 'localdir/b', 'prefix/localdir/b'))
-        expected_calls.append(mock.call(mock_container, 'localdir/c', 'prefix/localdir/c'))
-        expected_calls.append(mock.call(mock_container, 'localdir/d', 'prefix/localdir/d'))
+        expected_calls = [mock.call(mock_container, 'localdir/a', 'prefix/localdir/a', False)]
+        expected_calls.append(mock.call(mock_container, 'localdir/b', 'prefix/localdir/b', False))
+        expected_calls.append(mock.call(mock_container, 'localdir/c', 'prefix/localdir/c', False))
+        expected_calls.append(mock.call(mock_container, 'localdir/d', 'prefix/localdir/d', False))
         mock_one_file.assert_has_calls(expected_calls)
 
     @mock.patch('osci.swift_upload.pyrax')
@@ -116,6 +166,7 @@ class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_subdir(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
         mock_os_listdir.side_effect=[['subdir'], ['file']]
         mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
         mock_container = mock.Mock()
@@ -123,7 +174,7 @@ class TestSwiftUploader(unittest.TestCase):
         mock_container.cdn_uri = 'uri'
         result = swift_upload.SwiftUploader().upload(['localdir'], 'prefix')
         self.assertEqual(result, 'uri/prefix/index.html')
-        expected_calls = [mock.call(mock_container, 'localdir/subdir/file', 'prefix/localdir/subdir/file')]
+        expected_calls = [mock.call(mock_container, 'localdir/subdir/file', 'prefix/localdir/subdir/file', False)]
         mock_one_file.assert_has_calls(expected_calls)
 
     @mock.patch('osci.swift_upload.pyrax')
@@ -131,16 +182,17 @@ class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_run_tests_first(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
         mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
-        result = swift_upload.SwiftUploader().upload(['b', 'c', 'run_tests.log', 'a'], 'prefix')
+        result = swift_upload.SwiftUploader(workers=1).upload(['b', 'c', 'run_tests.log', 'a'], 'prefix')
         self.assertEqual(result, 'uri/prefix/index.html')
-        expected_calls = [mock.call(mock_container, 'run_tests.log', 'prefix/run_tests.log')]
-        expected_calls.append(mock.call(mock_container, 'a', 'prefix/a'))
-        expected_calls.append(mock.call(mock_container, 'b', 'prefix/b'))
-        expected_calls.append(mock.call(mock_container, 'c', 'prefix/c'))
+        expected_calls = [mock.call(mock_container, 'run_tests.log', 'prefix/run_tests.log', False)]
+        expected_calls.append(mock.call(mock_container, 'a', 'prefix/a', False))
+        expected_calls.append(mock.call(mock_container, 'b', 'prefix/b', False))
+        expected_calls.append(mock.call(mock_container, 'c', 'prefix/c', False))
         mock_one_file.assert_has_calls(expected_calls)
 
     @mock.patch('osci.swift_upload.pyrax')
@@ -148,6 +200,7 @@ class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_html(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
         mock_os_listdir.return_value=['b', 'c', 'run_tests.log', 'a.txt']
         mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
         mock_container = mock.Mock()
@@ -179,9 +232,10 @@ class TestSwiftUploader(unittest.TestCase):
                                                       content_encoding=None,
                                                       content_type='text/plain')
 
+    @mock.patch('osci.swift_upload.time.sleep')
     @mock.patch('osci.swift_upload.pyrax')
     @mock.patch('osci.config.Configuration.get_int')
-    def test_upload_one_failed(self, mock_get_int, mock_pyrax):
+    def test_upload_one_failed(self, mock_get_int, mock_pyrax, mock_sleep):
         mock_pyrax.utils.get_checksum.return_value = 'calc_checksum'
         mock_container = mock.Mock()
         mock_get_int.return_value = 1
@@ -197,6 +251,87 @@ class TestSwiftUploader(unittest.TestCase):
         expected = mock.call('source.txt', 'target.txt', etag='calc_checksum',
                              content_encoding=None, content_type='text/plain') 
         mock_container.upload_file.assert_has_calls([expected, expected])
+        mock_sleep.assert_called_once_with(1)
+
+    @mock.patch('osci.swift_upload.time.sleep')
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.config.Configuration.get_int')
+    def test_upload_one_backs_off(self, mock_get_int, mock_pyrax, mock_sleep):
+        mock_pyrax.utils.get_checksum.return_value = 'calc_checksum'
+        mock_container = mock.Mock()
+        mock_get_int.side_effect = lambda key: {'SWIFT_UPLOAD_ATTEMPTS': 3,
+                                                'SWIFT_UPLOAD_BACKOFF': 2}[key]
+        mock_obj_ok = mock.Mock()
+        mock_obj_ok.etag = 'calc_checksum'
+        mock_obj_fail = mock.Mock()
+        mock_obj_fail.etag = 'bad_checksum'
+        mock_container.upload_file.side_effect = [Exception('Timeout'),
+                                                  mock_obj_fail, mock_obj_ok]
+        result = swift_upload.SwiftUploader().upload_one_file(mock_container,
+                                                              'source.txt', 'target.txt')
+        self.assertEqual('calc_checksum', result)
+        self.assertEqual(3, mock_container.upload_file.call_count)
+        self.assertEqual([mock.call(2), mock.call(4)], mock_sleep.call_args_list)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    def test_upload_one_compressed(self, mock_pyrax):
+        mock_container = mock.Mock()
+
+        def create(obj_name, data, **kwargs):
+            self.compressed = ''.join(data)
+            obj = mock.Mock()
+            obj.etag = hashlib.md5(self.compressed).hexdigest()
+            return obj
+        mock_container.create.side_effect = create
+
+        with tempfile.NamedTemporaryFile(suffix='.log') as source:
+            source.write('log line\n' * 10000)
+            source.flush()
+            result = swift_upload.SwiftUploader().upload_one_file(
+                mock_container, source.name, 'target.log', True)
+
+        self.assertEqual(hashlib.md5(self.compressed).hexdigest(), result)
+        self.assertEqual(0, mock_container.upload_file.call_count)
+        self.assertEqual(0, mock_pyrax.utils.get_checksum.call_count)
+        _, kwargs = mock_container.create.call_args
+        self.assertEqual('target.log', kwargs['obj_name'])
+        self.assertEqual('gzip', kwargs['content_encoding'])
+        self.assertEqual('text/plain', kwargs['content_type'])
+        self.assertTrue(kwargs['chunked'])
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.os.listdir')
+    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_compresses_large_logs(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
+        mock_os_listdir.return_value = ['big.log', 'small.log', 'big.dat']
+        large_file = mock.Mock()
+        large_file.st_mode = stat.S_IFREG
+        large_file.st_size = 10 * 1024 * 1024
+        large_file.st_mtime = 1.0
+        mock_os_stat.side_effect = lambda x: (self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else
+                                              large_file if 'big' in x else self.mock_stat_file)
+        mock_container = mock.Mock()
+        mock_pyrax.cloudfiles.create_container.return_value = mock_container
+        swift_upload.SwiftUploader(workers=1).upload(['localdir'], 'prefix')
+        mock_one_file.assert_has_calls([
+            mock.call(mock_container, 'localdir/big.dat', 'prefix/localdir/big.dat', False),
+            mock.call(mock_container, 'localdir/big.log', 'prefix/localdir/big.log', True),
+            mock.call(mock_container, 'localdir/small.log', 'prefix/localdir/small.log', False)])
+
+    @mock.patch('osci.swift_upload.pyrax')
+    def test_upload_reuses_checksum(self, mock_pyrax):
+        mock_container = mock.Mock()
+        mock_container.upload_file.return_value.etag = 'abcdef'
+
+        etag = swift_upload.SwiftUploader().upload_one_file(
+            mock_container, 'source.txt', 'target.txt', chksum='abcdef')
+
+        self.assertEqual('abcdef', etag)
+        self.assertEqual(0, mock_pyrax.utils.get_checksum.call_count)
+        self.assertEqual('abcdef',
+                         mock_container.upload_file.call_args[1]['etag'])
 
     @mock.patch('osci.swift_upload.pyrax')
     @mock.patch('osci.config.Configuration.get_int')
@@ -221,6 +356,7 @@ class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_subdir2(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
         fake_dirs = {'dir1': ['filea', 'dir2'],
                      'dir1/dir2': ['fileb']}
         mock_os_listdir.side_effect = lambda x: fake_dirs[x.strip('/')]
@@ -228,9 +364,351 @@ class TestSwiftUploader(unittest.TestCase):
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
-        result = swift_upload.SwiftUploader().upload(['dir1', 'filec'], 'prefix')
+        result = swift_upload.SwiftUploader(workers=1).upload(['dir1', 'filec'], 'prefix')
         self.assertEqual(result, 'uri/prefix/index.html')
-        expected_calls = [mock.call(mock_container, 'dir1/dir2/fileb', 'prefix/dir1/dir2/fileb'),
-                          mock.call(mock_container, 'dir1/filea', 'prefix/dir1/filea'),
-                          mock.call(mock_container, 'filec', 'prefix/filec')]
+        expected_calls = [mock.call(mock_container, 'dir1/dir2/fileb', 'prefix/dir1/dir2/fileb', False),
+                          mock.call(mock_container, 'dir1/filea', 'prefix/dir1/filea', False),
+                          mock.call(mock_container, 'filec', 'prefix/filec', False)]
         mock_one_file.assert_has_calls(expected_calls)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.os.listdir')
+    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_parallel(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
+        fake_dirs = {'dir1': ['filea', 'dir2'],
+                     'dir1/dir2': ['fileb']}
+        mock_os_listdir.side_effect = lambda x: fake_dirs[x.strip('/')]
+        mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
+        mock_container = mock.Mock()
+        mock_pyrax.cloudfiles.create_container.return_value = mock_container
+        mock_container.cdn_uri = 'uri'
+
+        serial = swift_upload.SwiftUploader(workers=1)
+        serial.upload(['dir1', 'filec'], 'prefix')
+        serial_pages = mock_container.store_object.call_args_list
+        mock_container.reset_mock()
+        mock_one_file.reset_mock()
+
+        result = swift_upload.SwiftUploader(workers=3).upload(['dir1', 'filec'], 'prefix')
+        self.assertEqual(result, 'uri/prefix/index.html')
+        expected_calls = [mock.call(mock_container, 'dir1/dir2/fileb', 'prefix/dir1/dir2/fileb', False),
+                          mock.call(mock_container, 'dir1/filea', 'prefix/dir1/filea', False),
+                          mock.call(mock_container, 'filec', 'prefix/filec', False)]
+        mock_one_file.assert_has_calls(expected_calls, any_order=True)
+        self.assertEqual(3, mock_one_file.call_count)
+        # Index pages are identical and stored in the same order
+        self.assertEqual(serial_pages, mock_container.store_object.call_args_list)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.os.listdir')
+    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_parallel_failure(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        mock_one_file.return_value = 'etag'
+        mock_os_listdir.return_value = ['a', 'b', 'c']
+        mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
+        mock_container = mock.Mock()
+        mock_pyrax.cloudfiles.create_container.return_value = mock_container
+
+        def upload_one_file(container, source, target, compress):
+            if source == 'localdir/b':
+                raise swift_upload.UploadException('Failed to upload %s' % source)
+            return 'etag'
+        mock_one_file.side_effect = upload_one_file
+
+        self.assertRaises(swift_upload.UploadException,
+                          swift_upload.SwiftUploader(workers=2).upload,
+                          ['localdir'], 'prefix')
+        # No index pages are published for a partial upload
+        self.assertEqual(0, mock_container.store_object.call_count)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.os.listdir')
+    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_manifest(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
+        fake_dirs = {'dir1': ['filea', 'dir2'],
+                     'dir1/dir2': ['fileb']}
+        mock_os_listdir.side_effect = lambda x: fake_dirs[x.strip('/')]
+        mock_os_stat.side_effect = lambda x: self.mock_stat_dir if 'dir' in os.path.split(x)[-1] else self.mock_stat_file
+        mock_one_file.side_effect = lambda container, source, target, compress: 'etag-%s' % source
+        mock_container = mock.Mock()
+        mock_pyrax.cloudfiles.create_container.return_value = mock_container
+        swift_upload.SwiftUploader(workers=1).upload(['dir1', 'filec'], 'prefix')
+
+        stored = [args for args, _ in mock_container.store_object.call_args_list]
+        self.assertEqual(['prefix/dir1/dir2/index.html', 'prefix/dir1/dir2/manifest.json',
+                          'prefix/dir1/index.html', 'prefix/dir1/manifest.json',
+                          'prefix/index.html', 'prefix/manifest.json'],
+                         [args[0] for args in stored])
+        manifest = json.loads(stored[3][1])
+        self.assertEqual('prefix/dir1', manifest['path'])
+        self.assertEqual([{'name': 'dir2', 'type': 'directory'},
+                          {'name': 'filea', 'type': 'file', 'size': 1024,
+                           'mtime': 1.0, 'etag': 'etag-dir1/filea'}],
+                         manifest['files'])
+
+
+class TestPipelinedUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.logs = os.path.join(self.tmpdir, 'logs')
+        os.mkdir(self.logs)
+        self.run_tests = self._write('run_tests.log', 'tempest output')
+        self.container = mock.Mock()
+        self.container.cdn_uri = 'uri'
+        patcher = mock.patch('osci.swift_upload.pyrax')
+        self.mock_pyrax = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_pyrax.cloudfiles.create_container.return_value = self.container
+
+    def _write(self, name, contents):
+        path = os.path.join(self.logs, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def _start(self):
+        return swift_upload.SwiftUploader(workers=2).start_upload(
+            [self.run_tests, self.logs], 'prefix')
+
+    def _targets(self, mock_one_file):
+        return sorted(call[0][2] for call in mock_one_file.call_args_list)
+
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_starts_before_finish(self, mock_one_file):
+        started = threading.Event()
+        def upload_one_file(container, source, target, compress):
+            started.set()
+            return 'etag'
+        mock_one_file.side_effect = upload_one_file
+        upload = self._start()
+
+        upload.add_file(self.run_tests)
+
+        self.assertTrue(started.wait(5))
+        self.assertEqual('uri/prefix/index.html', upload.finish())
+
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_finish_uploads_the_rest_once(self, mock_one_file):
+        mock_one_file.return_value = 'etag'
+        upload = self._start()
+        upload.add_file(self.run_tests)
+        self._write('syslog.txt', 'syslog')
+
+        upload.finish()
+
+        self.assertEqual(['prefix/logs/run_tests.log', 'prefix/logs/syslog.txt',
+                          'prefix/run_tests.log'],
+                         self._targets(mock_one_file))
+        stored = [call[0][0] for call in self.container.store_object.call_args_list]
+        self.assertIn('prefix/index.html', stored)
+        self.assertIn('prefix/logs/index.html', stored)
+
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_changed_file_uploaded_again(self, mock_one_file):
+        uploaded = {}
+        def upload_one_file(container, source, target, compress):
+            with open(source) as f:
+                uploaded[target] = f.read()
+            return 'etag'
+        mock_one_file.side_effect = upload_one_file
+        upload = self._start()
+        upload.add_file(self.run_tests)
+        self._write('run_tests.log', 'tempest output, and more')
+
+        upload.finish()
+
+        # The first version may or may not have been uploaded by then
+        self.assertEqual({'prefix/logs/run_tests.log': 'tempest output, and more',
+                          'prefix/run_tests.log': 'tempest output, and more'},
+                         uploaded)
+
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_rewritten_file_uploaded_after_earlier_upload(self, mock_one_file):
+        release = threading.Event()
+        lock = threading.Lock()
+        running = set()
+        overlapped = []
+        uploaded = []
+        both_started = threading.Event()
+        def upload_one_file(container, source, target, compress):
+            with lock:
+                overlapped.append(target in running)
+                running.add(target)
+                if len(running) == 2:
+                    both_started.set()
+            with open(source) as f:
+                contents = f.read()
+            release.wait(5)
+            with lock:
+                running.discard(target)
+                uploaded.append((target, contents))
+            return 'etag'
+        mock_one_file.side_effect = upload_one_file
+        upload = self._start()
+        upload.add_file(self.run_tests)
+        self.assertTrue(both_started.wait(5))
+
+        # The same size, so only the mtime shows it has changed
+        self._write('run_tests.log', 'tempest OUTPUT')
+        os.utime(self.run_tests, (0, 0))
+        upload.add_file(self.run_tests)
+        release.set()
+        upload.finish()
+
+        self.assertEqual([False] * 4, overlapped)
+        last = dict(uploaded)
+        self.assertEqual('tempest OUTPUT', last['prefix/logs/run_tests.log'])
+        self.assertEqual('tempest OUTPUT', last['prefix/run_tests.log'])
+
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_failed_upload_raises(self, mock_one_file):
+        mock_one_file.side_effect = swift_upload.UploadException('failed')
+        upload = self._start()
+        upload.add_file(self.run_tests)
+
+        self.assertRaises(swift_upload.UploadException, upload.finish)
+        self.assertEqual(0, self.container.store_object.call_count)
+
+    def test_connects_once_only_when_needed(self):
+        upload = self._start()
+        self.assertEqual(0, self.mock_pyrax.set_credentials.call_count)
+        upload.abandon()
+        self.assertEqual(0, self.mock_pyrax.set_credentials.call_count)
+
+        upload = self._start()
+        with mock.patch('osci.swift_upload.SwiftUploader.upload_one_file',
+                        return_value='etag'):
+            upload.add_file(self.run_tests)
+            upload.finish()
+        self.assertEqual(1, self.mock_pyrax.set_credentials.call_count)
+
+    def test_files_outside_roots_ignored(self):
+        other = os.path.join(self.tmpdir, 'other')
+        open(other, 'w').close()
+        upload = self._start()
+        upload.add_file(other)
+        self.assertEqual({}, upload.submitted)
+        upload.abandon()
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def test_html_matches_stansas(self):
+        index = swift_upload.DirectoryIndex('prefix/logs', '/prefix')
+        index.add_file('run_tests.log', 2048, 0.0, 'prefix/logs/run_tests.log')
+        index.add_directory('etc')
+        expected = (swift_upload._html_start_stansa('prefix/logs') +
+                    swift_upload._html_dir_stansa('/prefix', 'Parent directory') +
+                    swift_upload._html_file_stansa('run_tests.log', '1970-01-01 00:00:00', '2.0 KiB') +
+                    swift_upload._html_dir_stansa('etc', 'etc') +
+                    swift_upload._html_end_stansa())
+        self.assertEqual(expected, index.html())
+
+    def test_top_level_has_no_parent(self):
+        index = swift_upload.DirectoryIndex('prefix')
+        self.assertNotIn('Parent directory', index.html())
+
+    def test_manifest_missing_etag(self):
+        index = swift_upload.DirectoryIndex('prefix')
+        index.add_file('a.txt', 1, 2.0, 'prefix/a.txt')
+        manifest = json.loads(index.manifest({}))
+        self.assertEqual(None, manifest['files'][0]['etag'])
+
+    def test_html_links_deduplicated_file(self):
+        index = swift_upload.DirectoryIndex('prefix')
+        index.add_file('nova.conf', 1, 0.0, 'prefix/nova.conf')
+        index.add_file('run_tests.log', 1, 0.0, 'prefix/run_tests.log')
+        stored = {'prefix/nova.conf': ('objects/ab/abcd', 'etag1'),
+                  'prefix/run_tests.log': ('prefix/run_tests.log', 'etag2')}
+        html = index.html(stored)
+        self.assertIn('<a href="/objects/ab/abcd">nova.conf</a>', html)
+        self.assertIn('<a href="run_tests.log">run_tests.log</a>', html)
+        files = json.loads(index.manifest(stored))['files']
+        self.assertEqual('objects/ab/abcd', files[0]['object'])
+        self.assertNotIn('object', files[1])
+
+
+class TestDedupIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'osci', 'dedup_index')
+
+    def test_empty(self):
+        index = swift_upload.DedupIndex(self.path)
+        self.assertEqual(None, index.get('CILogs', 'abcd'))
+        self.assertTrue(os.path.isdir(os.path.dirname(self.path)))
+
+    def test_persisted(self):
+        index = swift_upload.DedupIndex(self.path)
+        index.add('CILogs', 'abcd', 'etag1')
+        index.add('CILogs', 'abcd', 'etag1')
+        index.add('Other', 'ef01', 'etag2')
+
+        index = swift_upload.DedupIndex(self.path)
+        self.assertEqual('etag1', index.get('CILogs', 'abcd'))
+        self.assertEqual('etag2', index.get('Other', 'ef01'))
+        self.assertEqual(None, index.get('CILogs', 'ef01'))
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.readlines()))
+
+
+class TestDedupUpload(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(Configuration().reread)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.uploader = swift_upload.SwiftUploader(workers=1)
+        self.uploader.dedup_index = swift_upload.DedupIndex(
+            os.path.join(self.tmpdir, 'dedup_index'))
+        self.container = mock.Mock()
+        self.container.name = 'CILogs'
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_duplicate_stored_once(self, mock_one_file, mock_pyrax, conf):
+        conf.return_value = 'SWIFT_DEDUP=True'
+        Configuration().reread()
+        mock_pyrax.utils.get_checksum.return_value = 'abcdef'
+        mock_one_file.return_value = 'etag'
+
+        first = self.uploader._store(self.container, 'job1/nova.conf',
+                                     'prefix1/nova.conf', False, 100)
+        second = self.uploader._store(self.container, 'job2/nova.conf',
+                                      'prefix2/nova.conf', False, 100)
+
+        self.assertEqual(('objects/ab/abcdef', 'etag'), first)
+        self.assertEqual(first, second)
+        mock_one_file.assert_called_once_with(self.container, 'job1/nova.conf',
+                                              'objects/ab/abcdef', False,
+                                              chksum='abcdef')
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_large_files_not_deduplicated(self, mock_one_file, mock_pyrax, conf):
+        conf.return_value = 'SWIFT_DEDUP=True\nSWIFT_DEDUP_MAX_SIZE=1000'
+        Configuration().reread()
+        mock_one_file.return_value = 'etag'
+
+        stored = self.uploader._store(self.container, 'job1/run_tests.log',
+                                      'prefix1/run_tests.log', True, 1001)
+
+        self.assertEqual(('prefix1/run_tests.log', 'etag'), stored)
+        self.assertEqual(0, mock_pyrax.utils.get_checksum.call_count)
+        mock_one_file.assert_called_once_with(self.container, 'job1/run_tests.log',
+                                              'prefix1/run_tests.log', True)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_disabled_by_default(self, mock_one_file, mock_pyrax):
+        mock_one_file.return_value = 'etag'
+        stored = self.uploader._store(self.container, 'job1/nova.conf',
+                                      'prefix1/nova.conf', False, 100)
+        self.assertEqual(('prefix1/nova.conf', 'etag'), stored)
+        self.assertEqual(0, mock_pyrax.utils.get_checksum.call_count)
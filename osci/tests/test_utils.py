@@ -2,6 +2,9 @@ import datetime
 import errno
 import json
 import mock
+import os
+import shutil
+import tempfile
 import unittest
 import time
 import stat
@@ -97,16 +100,189 @@ class TestCopyLogs(unittest.TestCase):
         sftp.stat.return_value = mock_stat
         self.assertRaises(IOError, utils.copy_logs_sftp, sftp, ['source/*'], 'target', 'host', 'username', 'key', upload=True)
 
+    @mock.patch('osci.utils.ssh_pool', new_callable=utils.SSHConnectionPool)
     @mock.patch('osci.utils.getSSHObject')
     @mock.patch('osci.utils.copy_logs_sftp')
-    def test_copy_logs_closes_sftp(self, mock_copy_logs_sftp, mock_get_ssh):
+    def test_copy_logs_closes_sftp(self, mock_copy_logs_sftp, mock_get_ssh, mock_pool):
         mock_ssh = mock.Mock()
         mock_sftp = mock.Mock()
         mock_get_ssh.return_value = mock_ssh
         mock_ssh.open_sftp.return_value = mock_sftp
-        utils.copy_logs(None, None, None, None, None, None)
-        mock_ssh.close.assert_called_with()
+        utils.copy_logs(None, None, None, None, None, upload=True)
         mock_sftp.close.assert_called_with()
+        # The connection itself is kept for reuse
+        self.assertEqual(0, mock_ssh.close.call_count)
+
+    @mock.patch('osci.utils.ssh_pool', new_callable=utils.SSHConnectionPool)
+    @mock.patch('osci.utils.getSSHObject')
+    @mock.patch('osci.utils.copy_logs_sftp')
+    def test_copy_logs_reuses_connection(self, mock_copy_logs_sftp, mock_get_ssh, mock_pool):
+        utils.copy_logs(None, None, 'ip', 'user', 'key', upload=True)
+        utils.copy_logs(None, None, 'ip', 'user', 'key', upload=True)
+        mock_get_ssh.assert_called_once_with('ip', 'user', 'key')
+        # Both copies handed the connection back
+        self.assertEqual(0, mock_pool.connections[('ip', 'user')][2])
+
+
+class TestDownloadLogsParallel(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.ssh = mock.Mock()
+        self.channels = []
+        def open_sftp():
+            sftp = mock.Mock()
+            sftp.listdir_attr.side_effect = self.listdir_attr
+            self.channels.append(sftp)
+            return sftp
+        self.ssh.open_sftp.side_effect = open_sftp
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def listdir_attr(self, path):
+        if path == 'missing':
+            raise IOError(errno.ENOENT, 'No such file or directory')
+        entries = []
+        for name, mode, size in [('match1', stat.S_IFREG, 10),
+                                 ('match2', stat.S_IFREG, 20),
+                                 ('matchdir', stat.S_IFDIR, 0),
+                                 ('nomatch', stat.S_IFREG, 30)]:
+            entry = mock.Mock()
+            entry.filename = name
+            entry.st_mode = mode
+            entry.st_size = size
+            entries.append(entry)
+        return entries
+
+    def _gets(self):
+        calls = []
+        for channel in self.channels:
+            calls.extend(channel.get.call_args_list)
+        return sorted(call[0] for call in calls)
+
+    def test_matching_files_fetched(self):
+        fetched = utils.download_logs_parallel(
+            self.ssh, ['source/match*', 'missing/*'], self.target, 2)
+
+        self.assertEqual(
+            [('source/match1', os.path.join(self.target, 'match1')),
+             ('source/match2', os.path.join(self.target, 'match2'))],
+            self._gets())
+        self.assertEqual(30, sum(size for _, size in fetched))
+        for channel in self.channels:
+            channel.close.assert_called_once_with()
+
+    def test_listing_is_batched(self):
+        utils.download_logs_parallel(self.ssh, ['source/match*'], self.target, 2)
+        for channel in self.channels:
+            self.assertEqual(0, channel.stat.call_count)
+
+    def test_failed_file_skipped(self):
+        def open_sftp():
+            sftp = mock.Mock()
+            sftp.listdir_attr.side_effect = self.listdir_attr
+            def get(source, target):
+                if source.endswith('match2'):
+                    raise IOError(errno.EIO, 'Unknown failure')
+            sftp.get.side_effect = get
+            self.channels.append(sftp)
+            return sftp
+        self.ssh.open_sftp.side_effect = open_sftp
+
+        fetched = utils.download_logs_parallel(
+            self.ssh, ['source/match*'], self.target, 2)
+
+        self.assertEqual([('source/match1', 10)],
+                         [(f[0], size) for f, size in fetched])
+
+    def test_on_file_called_per_download(self):
+        downloaded = []
+        utils.download_logs_parallel(self.ssh, ['source/match*'], self.target,
+                                     2, on_file=downloaded.append)
+        self.assertEqual([os.path.join(self.target, 'match1'),
+                          os.path.join(self.target, 'match2')],
+                         sorted(downloaded))
+
+    def test_existing_files_removed(self):
+        open(os.path.join(self.target, 'old'), 'w').close()
+        utils.download_logs_parallel(self.ssh, ['source/nothing*'], self.target, 2)
+        self.assertEqual([], os.listdir(self.target))
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    @mock.patch('osci.utils.getSSHObject')
+    def test_connection_reused(self, mock_get_ssh):
+        pool = utils.SSHConnectionPool()
+        ssh = pool.get('ip', 'user', 'key')
+        self.assertEqual(ssh, pool.get('ip', 'user', 'key'))
+        mock_get_ssh.assert_called_once_with('ip', 'user', 'key')
+
+    @mock.patch('osci.utils.getSSHObject')
+    def test_connections_per_node(self, mock_get_ssh):
+        mock_get_ssh.side_effect = lambda ip, user, key: mock.Mock(name=ip)
+        pool = utils.SSHConnectionPool()
+        self.assertNotEqual(pool.get('ip1', 'user', 'key'),
+                            pool.get('ip2', 'user', 'key'))
+        self.assertEqual(2, mock_get_ssh.call_count)
+
+    @mock.patch('osci.utils.getSSHObject')
+    def test_broken_connection_replaced(self, mock_get_ssh):
+        broken = mock.Mock()
+        broken.get_transport.return_value.is_active.return_value = False
+        mock_get_ssh.side_effect = [broken, mock.Mock()]
+        pool = utils.SSHConnectionPool()
+        pool.get('ip', 'user', 'key')
+        ssh = pool.get('ip', 'user', 'key')
+        self.assertNotEqual(broken, ssh)
+        broken.close.assert_called_once_with()
+
+    @mock.patch('osci.utils.time.time')
+    @mock.patch('osci.utils.getSSHObject')
+    def test_idle_connection_evicted(self, mock_get_ssh, mock_time):
+        idle = mock.Mock()
+        mock_get_ssh.side_effect = [idle, mock.Mock()]
+        pool = utils.SSHConnectionPool()
+        mock_time.return_value = 1000
+        with pool.connection('ip', 'user', 'key'):
+            pass
+        mock_time.return_value = 1000 + Configuration().get_int('SSH_IDLE_TIMEOUT') + 1
+        ssh = pool.get('ip', 'user', 'key')
+        self.assertNotEqual(idle, ssh)
+        idle.close.assert_called_once_with()
+
+    @mock.patch('osci.utils.time.time')
+    @mock.patch('osci.utils.getSSHObject')
+    def test_connection_in_use_not_evicted(self, mock_get_ssh, mock_time):
+        mock_get_ssh.side_effect = lambda ip, user, key: mock.Mock(name=ip)
+        pool = utils.SSHConnectionPool()
+        idle_timeout = Configuration().get_int('SSH_IDLE_TIMEOUT')
+        mock_time.return_value = 1000
+        with pool.connection('ip1', 'user', 'key') as ssh:
+            # A long download, while other nodes' connections come and go
+            mock_time.return_value = 1000 + idle_timeout + 1
+            pool.get('ip2', 'user', 'key')
+            self.assertEqual(0, ssh.close.call_count)
+            self.assertEqual(ssh, pool.get('ip1', 'user', 'key'))
+            pool.release('ip1', 'user', ssh)
+        # Released, it is idle from then on
+        mock_time.return_value = 1000 + 2 * idle_timeout + 2
+        pool.get('ip2', 'user', 'key')
+        ssh.close.assert_called_once_with()
+
+    @mock.patch('osci.utils.getSSHObject')
+    def test_release_after_close(self, mock_get_ssh):
+        pool = utils.SSHConnectionPool()
+        with pool.connection('ip', 'user', 'key'):
+            pool.close('ip', 'user')
+        self.assertEqual({}, pool.connections)
+
+    @mock.patch('osci.utils.getSSHObject')
+    def test_close(self, mock_get_ssh):
+        pool = utils.SSHConnectionPool()
+        ssh = pool.get('ip', 'user', 'key')
+        pool.close('ip', 'user')
+        ssh.close.assert_called_once_with()
+        self.assertEqual({}, pool.connections)
 
     def test_mkdir(self):
         target = mock.Mock()
@@ -130,7 +306,12 @@ class TestCopyDom0Logs(unittest.TestCase):
         n = node.Node({
             'node_username': 'user',
             'node_host': 'ip',
-            'node_keyfile': 'key'})
+            'node_keyfile': 'key',
+            'ssh_options': ['-o', 'ControlMaster=auto',
+                            '-o', 'ControlPath=/tmp/osci-ssh-%r@%h:%p',
+                            '-o', 'ControlPersist=300',
+                            '-o', 'ServerAliveInterval=15',
+                            '-E', '/dev/null']})
 
         expected_execution.pipe_run(
             n.command_to_get_dom0_files_as_tgz_to_stdout(
@@ -142,3 +323,65 @@ class TestCopyDom0Logs(unittest.TestCase):
         self.assertEquals(
             expected_execution.executed_commands,
             xecutor.executed_commands)
+
+
+class TestCopyLogsAsArchive(unittest.TestCase):
+    @mock.patch('osci.utils.Executor')
+    def test_copying(self, executor_cls):
+        xecutor = executor_cls.return_value = executor.FakeExecutor()
+
+        utils.copy_logs_as_archive(['/a/*', '/b/*'], 'target', 'ip', 'user',
+                                   'key', 'zstd', 3)
+
+        (producer, pipe, consumer), = xecutor.executed_commands
+        self.assertIn('user@ip', producer)
+        self.assertIn('ControlMaster=auto', producer)
+        self.assertEquals(['find', '/a/*', '/b/*'],
+                          producer[producer.index('find'):][:3])
+        self.assertEquals(['zstd', '-3', '-q', '-c'], producer[-4:])
+        self.assertEquals(
+            localhost.Localhost().commands_to_extract_stdout_archive_to('target', 'zstd'),
+            consumer)
+
+    @mock.patch('osci.utils.Executor')
+    def test_extracted_files_reported(self, executor_cls):
+        def pipe_run(args1, args2, on_output=None):
+            # tar -v names each member as it starts extracting it
+            self.assertIn('-v', args2)
+            for name in ['run_tests.log\n', 'syslog.txt\n']:
+                on_output(name)
+                reported.append(list(extracted))
+            return 0, 0
+        executor_cls.return_value.pipe_run.side_effect = pipe_run
+        reported = []
+        extracted = []
+
+        utils.copy_logs_as_archive(['/a/*'], 'target', 'ip', 'user', 'key',
+                                   on_file=extracted.append)
+
+        self.assertEqual([[], ['target/run_tests.log']], reported)
+        self.assertEqual(['target/run_tests.log', 'target/syslog.txt'],
+                         extracted)
+
+    @mock.patch('osci.utils.Executor')
+    def test_failed_producer_raises(self, executor_cls):
+        def pipe_run(args1, args2, on_output=None):
+            on_output('run_tests.log\n')
+            on_output('syslog.txt\n')
+            return 255, 0
+        executor_cls.return_value.pipe_run.side_effect = pipe_run
+        extracted = []
+
+        self.assertRaises(Exception, utils.copy_logs_as_archive,
+                          ['/a/*'], 'target', 'ip', 'user', 'key',
+                          on_file=extracted.append)
+
+        # The member being extracted when the copy failed is not reported
+        self.assertEqual(['target/run_tests.log'], extracted)
+
+    @mock.patch('osci.utils.Executor')
+    def test_failed_consumer_raises(self, executor_cls):
+        executor_cls.return_value.pipe_run.return_value = (0, 2)
+
+        self.assertRaises(Exception, utils.copy_logs_as_archive,
+                          ['/a/*'], 'target', 'ip', 'user', 'key')
@@ -0,0 +1,51 @@
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from osci import wakeup
+
+
+class TestWakeup(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'wakeup.sock')
+
+    def test_notify_wakes_listener(self):
+        listener = wakeup.Listener(self.path)
+        self.addCleanup(listener.close)
+        wakeup.notify(self.path)
+        wakeup.notify(self.path)
+
+        start = time.time()
+        self.assertTrue(listener.wait(10))
+        self.assertTrue(time.time() - start < 5)
+        # Both notifications are consumed by one wakeup
+        self.assertFalse(listener.wait(0))
+
+    def test_wait_times_out(self):
+        listener = wakeup.Listener(self.path)
+        self.addCleanup(listener.close)
+        self.assertFalse(listener.wait(0.01))
+
+    def test_notify_without_listener(self):
+        wakeup.notify(self.path)
+
+    def test_stale_socket_replaced(self):
+        wakeup.Listener(self.path)
+        listener = wakeup.Listener(self.path)
+        wakeup.notify(self.path)
+        self.assertTrue(listener.wait(10))
+        listener.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch('osci.wakeup.time.sleep')
+    def test_disabled(self, mock_sleep):
+        listener = wakeup.Listener('')
+        self.assertFalse(listener.wait(30))
+        mock_sleep.assert_called_once_with(30)
+        wakeup.notify('')
+        listener.close()
@@ -1,3 +1,4 @@
+import contextlib
 import paramiko
 import logging
 import socket
@@ -7,11 +8,15 @@ from stat import S_ISREG
 import subprocess
 import errno
 import json
+import threading
+import time
 
 from osci.config import Configuration
 from osci.executor import RealExecutor
 from osci import localhost
 from osci import node
+from osci import common_ssh_options
+from osci import concurrency
 
 
 Executor = RealExecutor
@@ -24,16 +29,25 @@ def mkdir_recursive(target, target_dir):
         mkdir_recursive(target, os.path.dirname(target_dir))
         target.mkdir(target_dir)
 
-def copy_logs(source_masks, target_dir, host, username, key_filename, upload=True):
-    ssh = getSSHObject(host, username, key_filename)
-    sftp = ssh.open_sftp()
-    try:
-        copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload)
-    finally:
-        sftp.close()
-        ssh.close()
+def copy_logs(source_masks, target_dir, host, username, key_filename, upload=True,
+              on_file=None):
+    """Copy files to or from host; on_file is called with the local path
+    of each file as soon as it has been downloaded"""
+    with ssh_pool.connection(host, username, key_filename) as ssh:
+        workers = Configuration().get_int('COPY_LOGS_WORKERS')
+        if not upload and workers > 1:
+            download_logs_parallel(ssh, source_masks, target_dir, workers,
+                                   on_file=on_file)
+            return
+        sftp = ssh.open_sftp()
+        try:
+            copy_logs_sftp(sftp, source_masks, target_dir, host, username,
+                           key_filename, upload, on_file=on_file)
+        finally:
+            sftp.close()
 
-def copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload):
+def copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload,
+                   on_file=None):
     logger = logging.getLogger('citrix.copy_logs')
     if upload:
         source = os
@@ -65,18 +79,89 @@ def copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename,
                                     os.path.join(target_dir, filename))
                     except IOError, e:
                         logger.exception(e)
+                        continue
+                    if on_file and not upload:
+                        on_file(os.path.join(target_dir, filename))
         except IOError, e:
             if e.errno != errno.ENOENT:
                 raise
             logger.exception(e)
             # Ignore this exception to try again on the next directory
 
-def execute_command(command, delimiter=' ', silent=False, return_streams=False):
+def download_logs_parallel(ssh, source_masks, target_dir, workers, on_file=None):
+    """Download the files matching source_masks over several SFTP channels.
+
+    The directories are listed with listdir_attr, so no file is stat-ed
+    individually, and the files are then fetched largest first by
+    `workers` threads, each with its own channel on the same transport.
+    """
+    logger = logging.getLogger('citrix.copy_logs')
+    sftp = ssh.open_sftp()
+    try:
+        mkdir_recursive(os, target_dir)
+        for filename in os.listdir(target_dir):
+            os.remove(os.path.join(target_dir, filename))
+
+        to_fetch = []
+        for source_mask in source_masks:
+            source_dir = os.path.dirname(source_mask)
+            source_glob = os.path.basename(source_mask)
+            try:
+                entries = sftp.listdir_attr(source_dir)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                logger.exception(e)
+                continue
+            for entry in entries:
+                if not fnmatch.fnmatch(entry.filename, source_glob):
+                    continue
+                if S_ISREG(entry.st_mode):
+                    to_fetch.append((os.path.join(source_dir, entry.filename),
+                                     os.path.join(target_dir, entry.filename),
+                                     entry.st_size))
+    finally:
+        sftp.close()
+    to_fetch.sort(key=lambda x: x[2], reverse=True)
+
+    channels = []
+    local = threading.local()
+    channels_lock = threading.Lock()
+
+    def fetch(file_details):
+        source_file, target_file, size = file_details
+        if not hasattr(local, 'sftp'):
+            local.sftp = ssh.open_sftp()
+            with channels_lock:
+                channels.append(local.sftp)
+        logger.info('Copying %s to %s', source_file, target_dir)
+        local.sftp.get(source_file, target_file)
+        if on_file:
+            on_file(target_file)
+        return size
+
+    started = time.time()
+    try:
+        fetched = concurrency.run_concurrently(fetch, to_fetch, workers,
+                                               name='copy-logs')
+    finally:
+        for channel in channels:
+            channel.close()
+    elapsed = max(time.time() - started, 0.001)
+    total = sum(size for _, size in fetched)
+    logger.info('Copied %d of %d files (%d bytes) in %.1fs: %d bytes/sec',
+                len(fetched), len(to_fetch), total, elapsed, total / elapsed)
+    return fetched
+
+def execute_command(command, delimiter=' ', silent=False, return_streams=False,
+                    stdin_data=None):
     command_as_array = command.split(delimiter)
     if not silent:
         logging.debug("Executing command: %s", command_as_array)
-    p = subprocess.Popen(command_as_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, errors = p.communicate()
+    stdin = subprocess.PIPE if stdin_data is not None else None
+    p = subprocess.Popen(command_as_array, stdin=stdin,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = p.communicate(stdin_data)
     if p.returncode != 0:
         if not silent:
             logging.error("Error: Could not execute command. "+\
@@ -90,19 +175,112 @@ def execute_command(command, delimiter=' ', silent=False, return_streams=False):
     return p.returncode == 0
 
 def testSSH(ip, username, key_filename):
-    return execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null '+\
-                                 '-o StrictHostKeyChecking=no -i %s %s@%s /bin/true'%(
-                                     key_filename, username, ip))
+    return execute_command(' '.join(
+        common_ssh_options.node_ssh_command(ip, username, key_filename)
+        + ['/bin/true']))
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+def _load_key(key_filename):
+    with _keys_lock:
+        if key_filename not in _keys:
+            _keys[key_filename] = paramiko.RSAKey.from_private_key_file(key_filename)
+        return _keys[key_filename]
 
 def getSSHObject(ip, username, key_filename):
     if ip is None:
         raise Exception('Seriously?  The host must have an IP address')
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-    key = paramiko.RSAKey.from_private_key_file(key_filename)
+    key = _load_key(key_filename)
     ssh.connect(ip, username=username, pkey=key)
     return ssh
 
+
+class SSHConnectionPool(object):
+    """Authenticated paramiko connections shared per node.
+
+    A connection is reused while its transport is active.  Connections
+    are handed out by connection(), and one nobody is using is closed once
+    it has been idle for SSH_IDLE_TIMEOUT seconds.
+    """
+    log = logging.getLogger('citrix.SSHConnectionPool')
+
+    def __init__(self):
+        # (ip, username) -> (ssh, last_used, users)
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self, ip, username, key_filename):
+        ssh = self.get(ip, username, key_filename)
+        try:
+            yield ssh
+        finally:
+            self.release(ip, username, ssh)
+
+    def get(self, ip, username, key_filename):
+        """A connection to ip, to be handed back with release()"""
+        key = (ip, username)
+        with self.lock:
+            self._evict_idle()
+            ssh, _, users = self.connections.get(key, (None, None, 0))
+            if ssh is not None and self._is_healthy(ssh):
+                self.connections[key] = (ssh, time.time(), users + 1)
+                return ssh
+            if ssh is not None:
+                self.log.info('Replacing broken connection to %s', ip)
+                del self.connections[key]
+                self._close(ssh)
+        ssh = getSSHObject(ip, username, key_filename)
+        with self.lock:
+            self.connections[key] = (ssh, time.time(), 1)
+        return ssh
+
+    def release(self, ip, username, ssh):
+        key = (ip, username)
+        with self.lock:
+            current, _, users = self.connections.get(key, (None, None, 0))
+            # It may have been closed or replaced while in use
+            if current is ssh:
+                self.connections[key] = (ssh, time.time(), users - 1)
+
+    def close(self, ip, username):
+        with self.lock:
+            ssh, _, _ = self.connections.pop((ip, username), (None, None, 0))
+        if ssh is not None:
+            self._close(ssh)
+
+    def _evict_idle(self):
+        oldest = time.time() - Configuration().get_int('SSH_IDLE_TIMEOUT')
+        for key, (ssh, last_used, users) in self.connections.items():
+            if not users and last_used < oldest:
+                self.log.debug('Closing idle connection to %s', key[0])
+                del self.connections[key]
+                self._close(ssh)
+
+    def _is_healthy(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self, ssh):
+        try:
+            ssh.close()
+        except Exception, e:
+            self.log.exception(e)
+
+
+ssh_pool = SSHConnectionPool()
+
+
+def close_node_connections(ip, username, key_filename):
+    ssh_pool.close(ip, username)
+    if Configuration().get_bool('SSH_CONNECTION_SHARING'):
+        execute_command(' '.join(
+            common_ssh_options.node_ssh_command(ip, username, key_filename)
+            + ['-O', 'exit']), silent=True)
+
 def vote(commitid, vote_num, message):
     #ssh -p 29418 review.example.com gerrit review -m '"Test failed on MegaTestSystem <http://megatestsystem.org/tests/1234>"'
     # --verified=-1 c0ff33
@@ -146,6 +324,39 @@ def get_patchset_details(change_id, patchset_id):
     return matching_patch
 
 
+def copy_logs_as_archive(source_masks, local_directory, host, user, keyfile,
+                         compressor='gzip', level=6, on_file=None):
+    xecutor = Executor()
+    test_node = node.Node(
+        dict(node_username=user, node_host=host, node_keyfile=keyfile,
+             ssh_options=common_ssh_options.connection_sharing_opts()))
+    this_host = localhost.Localhost()
+
+    on_output = None
+    if on_file:
+        # tar names each member as it starts extracting it, so a member
+        # is complete once the next one is named, or tar has exited
+        extracting = []
+        def on_output(line):
+            if extracting:
+                on_file(os.path.join(local_directory, extracting.pop()))
+            extracting.append(line.rstrip('\n'))
+
+    returncodes = xecutor.pipe_run(
+        test_node.command_to_get_files_as_archive_to_stdout(
+            ' '.join(source_masks), compressor, level),
+        this_host.commands_to_extract_stdout_archive_to(
+            local_directory, compressor, verbose=on_file is not None),
+        on_output=on_output
+    )
+    if returncodes != (0, 0):
+        # The last member named may only have been partly extracted
+        raise Exception('Copying logs from %s failed (returned %s, %s)'
+                        % ((host,) + tuple(returncodes)))
+    if on_file and extracting:
+        on_file(os.path.join(local_directory, extracting.pop()))
+
+
 def copy_dom0_logs(host, user, keyfile, local_directory):
     dom0_files = (
         '/var/log/messages* /var/log/SMlog* /var/log/xensource* /opt/nodepool-scripts/*.log'
@@ -153,7 +364,8 @@ def copy_dom0_logs(host, user, keyfile, local_directory):
 
     xecutor = Executor()
     test_node = node.Node(
-        dict(node_username=user, node_host=host, node_keyfile=keyfile))
+        dict(node_username=user, node_host=host, node_keyfile=keyfile,
+             ssh_options=common_ssh_options.connection_sharing_opts()))
     this_host = localhost.Localhost()
 
     xecutor.pipe_run(
@@ -0,0 +1,75 @@
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+from osci.config import Configuration
+
+
+log = logging.getLogger('citrix.wakeup')
+
+
+def notify(path=None):
+    """Wake the process listening on the wakeup socket, if there is one"""
+    if path is None:
+        path = Configuration().WAKEUP_SOCKET
+    if not path:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        sock.sendto('wakeup', path)
+    except socket.error, e:
+        # Either nobody is listening, and they will poll anyway, or their
+        # queue is full, in which case they have already been woken
+        log.debug('No wakeup sent to %s: %s', path, e)
+    finally:
+        sock.close()
+
+
+class Listener(object):
+    """Sleep until notified, or until the timeout expires"""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = Configuration().WAKEUP_SOCKET
+        self.path = path
+        self.sock = None
+        if not self.path:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+
+    def wait(self, timeout):
+        """Returns True if woken by a notification"""
+        if self.sock is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        self._drain()
+        return True
+
+    def _drain(self):
+        # Several notifications sent while we were busy need only one pass
+        while True:
+            try:
+                self.sock.recv(64)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -11,6 +11,7 @@ setup(
             'osci-check-connection = osci.scripts:check_connection',
             'osci-run-tests = osci.scripts:run_tests',
             'osci-manage = osci.manage:main',
+            'osci-service = osci.service:main',
             'osci-watch-gerrit = osci.scripts:watch_gerrit',
             'osci-upload = osci.swift_upload:main',
             'osci-create-dbschema = osci.scripts:create_dbschema',
@@ -21,5 +21,10 @@ osci-view list --states Collected,Finished --recent 24 >> $CI_DIR/recent_finishe
 date > $CI_DIR/all_failures.txt
 osci-view failures --recent 168 >> $CI_DIR/all_failures.txt
 
+# The same data for dashboards
+osci-view list --states Running,Queued,Collecting --format json > $CI_DIR/current_queue.json
+osci-view list --states Collected,Finished --recent 24 --format json > $CI_DIR/recent_finished.json
+osci-view failures --recent 168 --format json > $CI_DIR/all_failures.json
+
 # Upload to the "status" container so the CDN will refresh every 15 minutes
 osci-upload -c status $CI_DIR ci_status